@@ -129,11 +129,13 @@
 ##
 ##
 
-import sys, math
+import sys
+import numpy as np
+import anomaly_engine
 
 # constants
 years  = range(1880,2011)
-months = range(1,13)
+baseline_years = (1951, 1980)
 
 # grid sampling in degrees
 # The grid size is set to 20x20 degrees
@@ -155,53 +157,39 @@ fileinv = "v3.inv" if len(sys.argv) <= 1 else sys.argv[1]
 filedat = "v3.mean" if len(sys.argv) <= 2 else sys.argv[2]
 popcls  = "RSU"     if len(sys.argv) <= 3 else sys.argv[3]
 
-# station data, indexed by station id
-station_locn = {}  # latitude, longitude stored by station id
-station_data = {}  # temperature data stored by station id, year, month
-
-print >> sys.stderr, " "
-print >> sys.stderr, "Grid size: ",grid,"x",grid," degrees..."
-print >> sys.stderr, " "
+print(" ", file=sys.stderr)
+print("Grid size: ",grid,"x",grid," degrees...", file=sys.stderr)
+print(" ", file=sys.stderr)
 
 # Read and store the station metadata -- this has the station ID#'s,
 # the station locations (latitude/longitude), and the station type
 # (rural, suburban, or urban).
-for line in open(fileinv):
-  id = line[0:11]
-  if line[73] in popcls:  # check rural/suburban/urban
-    station_locn[id] = ( float(line[12:20]), float(line[21:30]) )  # location
-    station_data[id] = {}  # initialise temperature data
+stations = anomaly_engine.read_ghcn_v3_inventory(fileinv, popcls)
 
 
-print >> sys.stderr, "Just read in the station metadata..."
-print >> sys.stderr, " "
-print >> sys.stderr, "Now read in the station data (could take some time)..."
-print >> sys.stderr, " "
+print("Just read in the station metadata...", file=sys.stderr)
+print(" ", file=sys.stderr)
+print("Now read in the station data...", file=sys.stderr)
+print(" ", file=sys.stderr)
 
 
 # Read and store the actual temperature data.
-# The temperature data will be indexed by station ID#, year, and month.
+# The temperature data will be stored in one big array indexed by
+# station, year, and month (NaN where there is no valid value).
 #
-# Example:    station_data[47566][1954][3] will contain the March 1954 
-# monthly average temperature for station# 47566.
-# (Note: I just made up the station# for illustrative purposes).
+# Example:    values[i, 1954 - first_year, 3 - 1] will contain the March 1954
+# monthly average temperature for the i-th station in the inventory.
 #
-for line in open(filedat):
-  id = line[0:11]                                 # get station id
-  if id in station_data:
-    year = int( line[11:15] )                     # get year
-    station_data[id][year] = {}
-    for month in months:
-      temp = int( line[11+8*month:16+8*month] )
-      flag = line[16+8*month:19+8*month]
-      if temp != -9999 and flag[0:2] == "  ":     # check for error flags
-        station_data[id][year][month] = 0.01*temp  # if ok, store data
+first_year = min(years[0], baseline_years[0])
+last_year  = max(years[-1], baseline_years[1])
+data   = anomaly_engine.read_ghcn_v3_data(filedat)
+values = anomaly_engine.station_matrix(stations, data, first_year, last_year)
 
 
-print >> sys.stderr, "Just read in the temperature data..."
-print >> sys.stderr, "#Stations and #station locations below..."
-print >> sys.stderr, len(station_locn), len(station_data)
-print >> sys.stderr, " "
+print("Just read in the temperature data...", file=sys.stderr)
+print("#Stations and #station locations below...", file=sys.stderr)
+print(stations.height, len(values), file=sys.stderr)
+print(" ", file=sys.stderr)
 
 # Now calculate monthly baselines for each station.
 # These baseline values will be used to convert the temperature readings 
@@ -247,52 +235,43 @@ print >> sys.stderr, " "
 # that will still be used (way more than enough to compute good
 # global-average temperature estimates, BTW).
 #
-# The python nested "dictionary" capability makes it easy to "skip over"
-# missing months/years for any station without too many coding headaches.  
-
-print >> sys.stderr, "Now start crunching the baselines..."
-print >> sys.stderr, " "
+# Missing months/years are simply NaN in the array, and are skipped
+# when the averages are taken.
 
-baselines = {}
-baselineCount=0
-baselineValid=0
-for id in station_data:
-  # calculate mean temp by month over the years 1951-1980
-  mtemps = {}
-  for month in months:
-    mtemps[month] = []
-  for year in station_data[id]:
-    if year >= 1951 and year <= 1980:
-      for month in station_data[id][year]:
-        mtemps[month].append( station_data[id][year][month] )
+print("Now start crunching the baselines...", file=sys.stderr)
+print(" ", file=sys.stderr)
 
-  # Calculate averages, but only include data if we have a robust baseline 
-  # for this station id/month
-  #
-  # A station must have a minimum of 15 valid temperature values in
-  # the time period 1951-1980 for a baseline to computed for that
-  # station and month.
-  #
-  # For example, if station XXXXXX has only 12 valid average temperatures
-  # for the month of March during the time period 1951-1980, no March baseline
-  # will be computed for that station.  That station will then be excluded from
-  # any temperature calculations for the month of March.  If valid baselines
-  # for station XXXXXX can be computed for other months, station XXXXXX will
-  # be included in the global-average anomaly calculations for those months.        
-  baselines[id] = {}
-  baselineValid=0
-  for month in months:
-    if len(mtemps[month]) >= 15:
-      baselines[id][month] = sum( mtemps[month] ) / len( mtemps[month] )
-      baselineValid=1
-  if baselineValid:
-    baselineCount+=1
+# Calculate averages, but only include data if we have a robust baseline 
+# for this station id/month
+#
+# A station must have a minimum of 15 valid temperature values in
+# the time period 1951-1980 for a baseline to computed for that
+# station and month.
+#
+# For example, if station XXXXXX has only 12 valid average temperatures
+# for the month of March during the time period 1951-1980, no March baseline
+# will be computed for that station.  That station will then be excluded from
+# any temperature calculations for the month of March.  If valid baselines
+# for station XXXXXX can be computed for other months, station XXXXXX will
+# be included in the global-average anomaly calculations for those months.        
+# (The baselines only depend on the data file, so they are cached on disk,
+# keyed by the file's path, size and modification time, and a later run on
+# the same file skips the averaging. The array above is still built: the
+# anomalies below need it.)
+baselines, counts = anomaly_engine.cached_baselines(
+  values,
+  first_year,
+  stations['station_id'].to_numpy(),
+  anomaly_engine.file_fingerprint(filedat),
+  baseline_years=baseline_years,
+)
+baselineCount = int(np.any(~np.isnan(baselines), axis=1).sum())
 
-print >> sys.stderr, "Just finished calculating baselines..."
-print >> sys.stderr, "#stations with valid baseline data = ", baselineCount
-print >> sys.stderr, " "
-print >> sys.stderr, "Now start crunching the anomalies (could take some time)..."
-print >> sys.stderr, " "
+print("Just finished calculating baselines...", file=sys.stderr)
+print("#stations with valid baseline data = ", baselineCount, file=sys.stderr)
+print(" ", file=sys.stderr)
+print("Now start crunching the anomalies...", file=sys.stderr)
+print(" ", file=sys.stderr)
 
 # Below, we will calculate average anomalies by assigning stations to 
 # latitude/longitude grid-cells, averaging the station data in each grid-cell
@@ -374,49 +353,18 @@ print >> sys.stderr, " "
 #
 # It's not perfect, but it's good enough.  And it is also relatively 
 # easy to understand.
+#
+# The whole calculation is done on arrays at once: subtract the
+# baselines from every year/month, then sum and count the anomalies of
+# each grid-cell, then take the cell-area weighted average of the cells.
 
-monthly = {}
-for year in years:
-  print>>sys.stderr, "Crunching temperature data for year", year
-  monthly[year] = {}
-  for month in months:
-    # make a map of grid cells with a list of anomalies in each cell
-    map = [[ [] for i in range(360/grid)] for j in range(180/grid)]
-    # fill in all the anomalies for this month in the map
-    for id in station_data:
-      # store a list of all the station anomalies in every cell in the map
-      if year in station_data[id]:
-        if month in station_data[id][year]:
-          # only include data if we have a baseline
-          if month in baselines[id]:
-            # anomaly = temperature - baseline
-            anom = station_data[id][year][month] - baselines[id][month]
-            # add the anomaly to the list for the given map cell
-            # Compute a latitude and longitude index for each station.
-            # These lat/long indices will be used to assign temperature
-            # stations to lat/long grid-cells.
-            lati = int((station_locn[id][0]+90.0)/grid)
-            lngi = int((station_locn[id][1]+180.0)/grid)
-
-            # Assign the temperature anomaly for this station
-            # to the station's latidude/longitude grid-cell
-            map[lati][lngi].append(anom)
-
-    # Now loop over the grid cells
-    # to compute the global-average anomalies.
-    # The outputs of this averaging procedure are
-    # global average anomalies for every year/month.
-    stemp = 0.0
-    swght = 0.0
-    for lati in range(len(map)):
-      w = math.cos(((lati+0.5)*grid-90.0)*3.1416/180.0)   # weight by cell area
-      for lngi in range(len(map[lati])):
-        if len( map[lati][lngi] ) > 0:
-          t = sum( map[lati][lngi] ) / len( map[lati][lngi] )
-          stemp += w*t
-          swght += w
-    stemp /= max( swght, 1.0e-20 )
-    monthly[year][month] = stemp
+anomalies = values[:, years[0] - first_year:years[-1] - first_year + 1] - baselines[:, None, :]
+monthly = anomaly_engine.grid_average(
+  anomalies,
+  stations['latitude'].to_numpy(),
+  stations['longitude'].to_numpy(),
+  grid,
+)
 
 ## We now have anomalies for every year/month -- 
 ## Now average all monthly anomalies
@@ -425,15 +373,11 @@ for year in years:
 ## to-plot spreadsheet compatible format.
 ## The output will be global-average anomalies
 ## for all years beginning with 1880.
-print "year",",","temp"
-for year in years:
-  yearavg=0
-  for month in months:
-    yearavg=yearavg+monthly[year][month]
-  yearavg=yearavg/len(months)
-  print year,",", yearavg
+print("year",",","temp")
+for year, yearavg in zip(years, monthly.sum(axis=1) / 12):
+  print(year,",", yearavg)
 
 
-print >> sys.stderr, " "
-print >> sys.stderr, "All finished!!"
-print >> sys.stderr, " "
\ No newline at end of file
+print(" ", file=sys.stderr)
+print("All finished!!", file=sys.stderr)
+print(" ", file=sys.stderr)
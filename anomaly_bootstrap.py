@@ -0,0 +1,181 @@
+import argparse
+import os
+import sys
+import tempfile
+import numpy as np
+import polars as pl
+import anomaly_engine
+import ushcn_metrics
+from ushcn_to_polars import run_tasks
+
+# Configuration
+REPLICATES = 1000
+RESAMPLE = ('stations', 'cells')
+LEVEL = 0.95  # Coverage of the band between lower and upper
+SEED = 0
+BATCH = 50  # Replicates generated at a time (memory is about 4 x BATCH x months x 8 bytes)
+MIN_PARALLEL_WORK = 1e10  # Replicates x stations x months below which workers are not used (see below)
+
+# Bootstrap bands for the gridded global-average series of anomaly_engine. The anomaly
+# matrix is built once; every replicate then redraws, with replacement, the stations
+# within each grid cell (as many as the cell has) and/or the occupied cells over the
+# globe (as many as there are), and recomputes the area-weighted average of the cell
+# means. A batch of replicates is one matrix product per cell: the [replicate, station]
+# draw counts times the cell's [station, month] anomalies and value counts. Batches run
+# in parallel (workers), sharing the anomalies through memory-mapped files, once there is
+# enough work to pay for the pool: `benchmarks.py --stages bootstrap` puts the serial rate
+# at about 3e9 replicate x station x months a second and the fixed cost of the pool
+# (spawning the workers, writing the files) at about 1 s, so runs of less than about 3 s
+# stay in this process. Replicate i always draws from the i-th child of the seed's
+# SeedSequence, so the replicates depend on the seed only, not on the batch size or the
+# number of workers.
+#
+#   python anomaly_bootstrap.py v3.inv v3.mean --replicates 1000 --workers 4
+
+# Function to lay the stations out for resampling: stations without any anomaly are
+# dropped and the rest sorted by grid cell. Returns (cells, starts, ends, values, valid),
+# values/valid being the [station, month] anomalies (0 where missing) and 0/1 counts.
+def cell_layout(anomalies, latitude, longitude, grid=anomaly_engine.GRID):
+    flat = anomalies.reshape(len(anomalies), -1)
+    has_data = np.nonzero((~np.isnan(flat)).any(axis=1))[0]
+    keys, _ = anomaly_engine.grid_cells(latitude[has_data], longitude[has_data], grid)
+    order = has_data[np.argsort(keys, kind='stable')]
+    cells, starts = np.unique(np.sort(keys), return_index=True)
+    ends = np.append(starts[1:], len(order))
+    valid = ~np.isnan(flat[order])
+    values = np.where(valid, flat[order], 0.0)
+    return cells, starts, ends, values, valid.astype(np.float64)
+
+# Function to draw how many times each item is picked when every group [starts, ends) of
+# n items is drawn from n times with replacement, one replicate per generator in rngs.
+# Returns [replicate, item].
+def draw_counts(rngs, starts, ends):
+    sizes = ends - starts
+    group = np.repeat(np.arange(len(starts)), sizes)
+    replicates = len(rngs)
+    uniform = np.stack([rng.random(len(group)) for rng in rngs]) if rngs else np.empty((0, len(group)))
+    picks = starts[group] + (uniform * sizes[group]).astype(np.intp)
+    flat = picks + (np.arange(replicates) * len(group))[:, None]
+    return np.bincount(flat.ravel(), minlength=replicates * len(group)).reshape(replicates, len(group)).astype(np.float64)
+
+# Process pool task: the monthly global averages of one batch of replicates, [replicate,
+# month]. values/valid are arrays, or paths of .npy files that are memory-mapped.
+def _replicates_task(task):
+    values, valid, cells, starts, ends, grid, resample, seeds = task
+    if isinstance(values, str):
+        values = np.load(values, mmap_mode='r')
+        valid = np.load(valid, mmap_mode='r')
+    replicates = len(seeds)
+    with ushcn_metrics.stage('bootstrap', replicates=replicates) as record:
+        rngs = [np.random.default_rng(seed) for seed in seeds]
+        station_counts = draw_counts(rngs, starts, ends) if 'stations' in resample else None
+        cell_counts = (draw_counts(rngs, np.array([0]), np.array([len(cells)])) if 'cells' in resample
+                       else np.ones((replicates, len(cells))))
+        cell_weights = cell_counts * anomaly_engine.cell_weights(grid)[cells]
+
+        numerator = np.zeros((replicates, values.shape[1]))
+        denominator = np.zeros((replicates, values.shape[1]))
+        for c, (start, end) in enumerate(zip(starts, ends)):
+            block = np.hstack([values[start:end], valid[start:end]])
+            if station_counts is None:
+                totals = block.sum(axis=0, keepdims=True)
+            else:
+                totals = station_counts[:, start:end] @ block
+            sums, counts = totals[:, :values.shape[1]], totals[:, values.shape[1]:]
+            present = counts > 0
+            w = cell_weights[:, c:c + 1] * present
+            numerator += w * np.where(present, sums / np.maximum(counts, 1.0), 0.0)
+            denominator += w
+        record['rows_in'] = int(replicates * len(values))
+        return numerator / np.maximum(denominator, 1.0e-20)
+
+# Function to generate bootstrap replicates of the annual series from an anomaly matrix
+# ([station, year, month], as anomaly_engine.anomaly_matrix builds it). resample is any of
+# 'stations' (within their grid cells) and 'cells' (over the globe). Returns [replicate, year].
+def bootstrap_replicates(anomalies, latitude, longitude, grid=anomaly_engine.GRID, replicates=REPLICATES,
+                         resample=RESAMPLE, seed=SEED, batch=BATCH, workers=1, min_parallel_work=MIN_PARALLEL_WORK):
+    for kind in resample:
+        if kind not in RESAMPLE:
+            raise ValueError(f'Unknown resampling {kind!r} (expected any of {list(RESAMPLE)})')
+    n_years = anomalies.shape[1]
+    cells, starts, ends, values, valid = cell_layout(anomalies, np.asarray(latitude), np.asarray(longitude), grid)
+    seeds = np.random.SeedSequence(seed).spawn(replicates)
+    if replicates * values.size < min_parallel_work:
+        workers = 1
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        sources = values, valid
+        if workers > 1 and replicates > batch:
+            sources = os.path.join(tmp_dir, 'values.npy'), os.path.join(tmp_dir, 'valid.npy')
+            np.save(sources[0], values)
+            np.save(sources[1], valid)
+            del values, valid
+        tasks = [
+            (*sources, cells, starts, ends, grid, tuple(resample), seeds[start:start + batch])
+            for start in range(0, replicates, batch)
+        ]
+        results = run_tasks(_replicates_task, tasks, workers)
+    if not results:
+        return np.empty((0, n_years))
+    monthly = np.concatenate(results)
+    return monthly.reshape(len(monthly), n_years, 12).sum(axis=2) / 12
+
+# Function to compute the annual series with its bootstrap band. Returns a frame of year,
+# temp (the plain estimate, as compute_anomalies gives it), std (of the replicates), lower
+# and upper (the replicates' percentiles around level).
+def bootstrap_anomalies(stations, data, years=anomaly_engine.YEARS, grid=anomaly_engine.GRID,
+                        baseline_years=anomaly_engine.BASELINE_YEARS, min_samples=anomaly_engine.MIN_SAMPLES,
+                        replicates=REPLICATES, resample=RESAMPLE, level=LEVEL, seed=SEED, batch=BATCH, workers=1,
+                        fingerprint=None, element=None, dataset_type=None):
+    anomalies = anomaly_engine.anomaly_matrix(stations, data, years, baseline_years, min_samples, fingerprint,
+                                              element, dataset_type)
+    latitude = stations['latitude'].to_numpy()
+    longitude = stations['longitude'].to_numpy()
+    monthly = anomaly_engine.grid_average(anomalies, latitude, longitude, grid)
+    samples = bootstrap_replicates(anomalies, latitude, longitude, grid, replicates, resample, seed, batch, workers)
+    lower, upper = np.quantile(samples, [(1 - level) / 2, (1 + level) / 2], axis=0)
+    return pl.DataFrame({
+        'year': list(years),
+        'temp': monthly.sum(axis=1) / 12,
+        'std': samples.std(axis=0, ddof=1),
+        'lower': lower,
+        'upper': upper,
+    })
+
+def main():
+    parser = argparse.ArgumentParser(description='Bootstrap confidence bands for the gridded global-average anomalies.')
+    parser.add_argument('inventory', nargs='?', default='v3.inv', help='GHCN v3 inventory (.inv) file')
+    parser.add_argument('data_file', nargs='?', default='v3.mean', help='GHCN v3 data (.dat/.mean) file')
+    parser.add_argument('--popcls', default='RSU', help='population classes to keep')
+    parser.add_argument('--ushcn', nargs=2, metavar=('ELEMENT', 'DATASET_TYPE'), help='use the USHCN parquet data instead')
+    parser.add_argument('--grid', type=int, default=anomaly_engine.GRID, help='grid cell size in degrees')
+    parser.add_argument('--years', type=int, nargs=2, default=(anomaly_engine.YEARS[0], anomaly_engine.YEARS[-1]), metavar=('FIRST', 'LAST'))
+    parser.add_argument('--baseline', type=int, nargs=2, default=anomaly_engine.BASELINE_YEARS, metavar=('FIRST', 'LAST'))
+    parser.add_argument('--replicates', type=int, default=REPLICATES)
+    parser.add_argument('--resample', nargs='+', default=list(RESAMPLE), choices=RESAMPLE)
+    parser.add_argument('--level', type=float, default=LEVEL, help='coverage of the band')
+    parser.add_argument('--seed', type=int, default=SEED)
+    parser.add_argument('--batch', type=int, default=BATCH, help='replicates per task')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--output', help='also write the series to this parquet file')
+    args = parser.parse_args()
+
+    if args.ushcn:
+        element, dataset_type = args.ushcn
+        stations, data = anomaly_engine.load_ushcn(element, dataset_type)
+        fingerprint = anomaly_engine.ushcn_fingerprint(element, dataset_type)
+    else:
+        element = dataset_type = None
+        stations = anomaly_engine.read_ghcn_v3_inventory(args.inventory, args.popcls)
+        data = anomaly_engine.read_ghcn_v3_data(args.data_file)
+        fingerprint = anomaly_engine.file_fingerprint(args.data_file)
+    series = bootstrap_anomalies(stations, data, range(args.years[0], args.years[1] + 1), args.grid,
+                                 tuple(args.baseline), replicates=args.replicates, resample=args.resample,
+                                 level=args.level, seed=args.seed, batch=args.batch, workers=args.workers,
+                                 fingerprint=fingerprint, element=element, dataset_type=dataset_type)
+    print(series.select('year', 'temp', 'lower', 'upper').write_csv(), end='')
+    if args.output:
+        series.write_parquet(args.output)
+        print(f'Saved the series to {args.output}', file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
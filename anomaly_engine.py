@@ -0,0 +1,311 @@
+import math
+import os
+import numpy as np
+import polars as pl
+import baseline_cache
+import ushcn_metrics
+from session_cache import source_fingerprint
+from ushcn_to_polars import MONTHLY_DATA_DIR, byte_matrix, parse_ints, partition_path, scan_monthly
+
+# Configuration (the defaults of anomalies.py)
+YEARS = range(1880, 2011)
+BASELINE_YEARS = (1951, 1980)  # Inclusive
+MIN_SAMPLES = 15  # Minimum number of baseline values for a station/month baseline
+GRID = 20  # Grid cell size in degrees
+STATIONS_FILE = 'ushcn_stations.parquet'
+
+# Function to read a GHCN v3 inventory (.inv) file, keeping the stations whose
+# population class (R/S/U, column 74) is in popcls
+def read_ghcn_v3_inventory(file_path, popcls='RSU'):
+    with open(file_path, 'rb') as f:
+        matrix = byte_matrix(f.read(), 74)
+
+    def field(start, end):
+        return pl.Series(np.ascontiguousarray(matrix[:, start:end]).view(f'S{end - start}').ravel()).cast(pl.Utf8)
+
+    return (
+        pl.DataFrame({
+            'station_id': field(0, 11),
+            'latitude': field(12, 20).str.strip_chars().cast(pl.Float64),
+            'longitude': field(21, 30).str.strip_chars().cast(pl.Float64),
+            'popcls': field(73, 74),
+        })
+        .filter(pl.col('popcls').is_in(list(popcls)))
+    )
+
+# Function to read a GHCN v3 data (.dat/.mean) file into a long table of the values that
+# have no measurement or quality flag. Like anomalies.py, the last line wins when a
+# station/year appears twice.
+def read_ghcn_v3_data(file_path):
+    with ushcn_metrics.stage('read_ghcn_v3') as record:
+        with open(file_path, 'rb') as f:
+            matrix = byte_matrix(f.read(), 115)
+        data = _ghcn_v3_rows(matrix)
+        record['bytes_in'] = os.path.getsize(file_path)
+        record['rows_out'] = data.height
+    return data
+
+# Function to turn a (lines x 115) GHCN v3 byte matrix into long (station_id, year, month, value) rows
+def _ghcn_v3_rows(matrix):
+    n_lines = len(matrix)
+    months = matrix[:, 19:115].reshape(n_lines, 12, 8)
+    temps = parse_ints(months[:, :, 0:5])
+    unflagged = (months[:, :, 5] == ord(' ')) & (months[:, :, 6] == ord(' '))
+    valid = (temps != -9999) & unflagged
+
+    lines = pl.DataFrame({
+        'station_id': pl.Series(np.ascontiguousarray(matrix[:, 0:11]).view('S11').ravel()).cast(pl.Utf8),
+        'year': parse_ints(matrix[:, 11:15]).astype(np.int32),
+        'line': np.arange(n_lines),
+    }).unique(['station_id', 'year'], keep='last')
+
+    line, month = np.nonzero(valid[lines['line'].to_numpy()])
+    rows = lines['line'].to_numpy()[line]
+    return pl.DataFrame({
+        'station_id': lines['station_id'].gather(line),
+        'year': lines['year'].to_numpy()[line],
+        'month': (month + 1).astype(np.int8),
+        'value': 0.01 * temps[rows, month],
+    })
+
+# Function to load one element/dataset type of the USHCN parquet data as (stations, data),
+# in the same shape as the GHCN readers. Values with a measurement or quality flag are
+# dropped, as anomalies.py does for GHCN.
+def load_ushcn(element='tavg', dataset_type='raw', data_dir=MONTHLY_DATA_DIR, stations_file=STATIONS_FILE):
+    stations = (
+        pl.read_parquet(stations_file, columns=['coop_id', 'latitude', 'longitude'])
+        .rename({'coop_id': 'station_id'})
+    )
+    data = (
+        scan_monthly(data_dir)
+        .filter(
+            pl.col('element') == element,
+            pl.col('dataset_type') == dataset_type,
+            pl.col('value').is_not_null(),
+            pl.col('dmflag').is_null(),
+            pl.col('qcflag').is_null(),
+        )
+        .select(
+            pl.col('coop_id').alias('station_id'),
+            pl.col('year').cast(pl.Int32),
+            pl.col('month').cast(pl.Int8),
+            'value',
+        )
+        .collect()
+    )
+    return stations, data
+
+# Function to fingerprint source files for the baseline cache by absolute path, size and
+# modification time (see session_cache.source_fingerprint): a lookup costs a stat, not a
+# read of the whole file, and any rewrite of the file changes it
+def file_fingerprint(*file_paths):
+    return source_fingerprint(*[os.path.abspath(file_path) for file_path in file_paths])
+
+# Function to fingerprint the USHCN partition an element/dataset type is read from
+def ushcn_fingerprint(element='tavg', dataset_type='raw', data_dir=MONTHLY_DATA_DIR):
+    return file_fingerprint(partition_path(element, dataset_type, data_dir))
+
+# Function to build the dense [station, year, month] value matrix (NaN = no value).
+# Data for stations that are not in the station table are ignored.
+def station_matrix(stations, data, first_year, last_year):
+    with ushcn_metrics.stage('station_matrix') as record:
+        ids = stations['station_id'].to_numpy()
+        order = np.argsort(ids, kind='stable')
+        data = data.filter(
+            pl.col('station_id').is_in(stations['station_id'].implode()),
+            pl.col('year').is_between(first_year, last_year),
+        )
+        s = order[np.searchsorted(ids, data['station_id'].to_numpy(), sorter=order)]
+        y = data['year'].to_numpy() - first_year
+        m = data['month'].to_numpy().astype(np.intp) - 1
+
+        values = np.full((len(ids), last_year - first_year + 1, 12), np.nan)
+        values[s, y, m] = data['value'].to_numpy()
+        record['rows_in'] = data.height
+        record['bytes_out'] = values.nbytes
+    return values
+
+# Function to compute the per-station monthly baselines: the mean over the baseline
+# years, where a station/month has at least min_samples values (NaN otherwise)
+def compute_baselines(values, first_year, baseline_years=BASELINE_YEARS, min_samples=MIN_SAMPLES):
+    window = values[:, baseline_years[0] - first_year:baseline_years[1] - first_year + 1]
+    counts = np.sum(~np.isnan(window), axis=1)
+    sums = np.nansum(window, axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        baselines = np.where(counts >= min_samples, sums / counts, np.nan)
+    return baselines, counts
+
+# Function to get the baselines and sample counts from the on-disk cache, computing and
+# caching them on a miss. fingerprint identifies the source data (ushcn_fingerprint or
+# file_fingerprint of the GHCN files); without one the cache is not used. A hit only
+# saves the averaging over the baseline years: values is still needed for the anomalies.
+def cached_baselines(values, first_year, station_ids, fingerprint=None, element=None, dataset_type=None,
+                     baseline_years=BASELINE_YEARS, min_samples=MIN_SAMPLES):
+    with ushcn_metrics.stage('baselines', baseline_start=baseline_years[0], baseline_end=baseline_years[1]) as record:
+        record['rows_in'] = len(values)
+        if fingerprint is None:
+            record['cache'] = 'off'
+            return compute_baselines(values, first_year, baseline_years, min_samples)
+        key = baseline_cache.cache_key(fingerprint, dataset_type, element, baseline_years, min_samples)
+        cached = baseline_cache.load(key, station_ids)
+        record['cache'] = 'miss' if cached is None else 'hit'
+        if cached is None:
+            cached = compute_baselines(values, first_year, baseline_years, min_samples)
+            baseline_cache.store(key, station_ids, *cached)
+        return cached
+
+# Function to get the grid cell of each station, and the number of cells
+def grid_cells(latitude, longitude, grid=GRID):
+    n_lat, n_lon = 180 // grid, 360 // grid
+    # int() truncation as in anomalies.py; stations on the +90/+180 edge go in the last cell
+    lati = np.minimum(((np.asarray(latitude) + 90.0) / grid).astype(np.intp), n_lat - 1)
+    lngi = np.minimum(((np.asarray(longitude) + 180.0) / grid).astype(np.intp), n_lon - 1)
+    return lati * n_lon + lngi, n_lat * n_lon
+
+# Function to get the area weight of every grid cell (anomalies.py's 3.1416 included)
+def cell_weights(grid=GRID):
+    n_lat, n_lon = 180 // grid, 360 // grid
+    w = np.array([math.cos(((lati + 0.5) * grid - 90.0) * 3.1416 / 180.0) for lati in range(n_lat)])
+    return np.repeat(w, n_lon)
+
+# Function to sum and count the non-NaN values of flat ([station, n]) per group key,
+# in one pass over the stations. Returns (keys, sums, counts) for the keys present.
+def group_sums(flat, keys):
+    order = np.argsort(keys, kind='stable')
+    present, starts = np.unique(keys[order], return_index=True)
+    if not len(order):
+        empty = np.zeros((0, flat.shape[1]))
+        return present, empty, empty
+    valid = ~np.isnan(flat[order])
+    sums = np.add.reduceat(np.where(valid, flat[order], 0.0), starts, axis=0)
+    counts = np.add.reduceat(valid, starts, axis=0)
+    return present, sums, counts
+
+# Function to take the area-weighted mean over grid cells of the cell means
+def weighted_cell_mean(cells, sums, counts, grid=GRID):
+    w = cell_weights(grid)[cells][:, None] * (counts > 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cell_means = np.where(counts > 0, sums / counts, 0.0)
+    return (w * cell_means).sum(axis=0) / np.maximum(w.sum(axis=0), 1.0e-20)
+
+# Function to average the anomalies ([station, ...]) within grid cells, then over the
+# cells weighted by area. Returns the global average for each [...] entry.
+def grid_average(anomalies, latitude, longitude, grid=GRID):
+    with ushcn_metrics.stage('gridding', grid=grid) as record:
+        cells, _ = grid_cells(latitude, longitude, grid)
+        flat = anomalies.reshape(len(anomalies), -1)
+        occupied, sums, counts = group_sums(flat, cells)
+        record['rows_in'] = len(anomalies)
+        record['cells'] = len(occupied)
+        return weighted_cell_mean(occupied, sums, counts, grid).reshape(anomalies.shape[1:])
+
+# Function to build the [station, year, month] anomaly matrix for years (NaN = no value
+# or no baseline). With a fingerprint, the baselines come from the baseline cache.
+def anomaly_matrix(stations, data, years=YEARS, baseline_years=BASELINE_YEARS, min_samples=MIN_SAMPLES,
+                   fingerprint=None, element=None, dataset_type=None):
+    first_year = min(years[0], baseline_years[0])
+    last_year = max(years[-1], baseline_years[1])
+    values = station_matrix(stations, data, first_year, last_year)
+    baselines, _ = cached_baselines(values, first_year, stations['station_id'].to_numpy(), fingerprint,
+                                    element, dataset_type, baseline_years, min_samples)
+    return values[:, years[0] - first_year:years[-1] - first_year + 1] - baselines[:, None, :]
+
+# Function to compute the gridded global-average anomaly for each year.
+# Returns a frame of year, temp (the annual mean of the 12 monthly averages).
+# With a fingerprint, the baselines come from the baseline cache.
+def compute_anomalies(stations, data, years=YEARS, grid=GRID, baseline_years=BASELINE_YEARS, min_samples=MIN_SAMPLES,
+                      fingerprint=None, element=None, dataset_type=None):
+    anomalies = anomaly_matrix(stations, data, years, baseline_years, min_samples, fingerprint, element, dataset_type)
+    monthly = grid_average(anomalies, stations['latitude'].to_numpy(), stations['longitude'].to_numpy(), grid)
+    return pl.DataFrame({'year': list(years), 'temp': monthly.sum(axis=1) / 12})
+
+# Function to compute the gridded global-average anomaly for each year out of core.
+# blocks yields (stations, data) pairs as for compute_anomalies, each station in one block
+# only. Only the per-cell sums and counts ([cell, year/month]) are kept from block to
+# block, so memory depends on the block size and the grid, not on the number of stations.
+# Returns the same frame as compute_anomalies (equal up to float summation order).
+def compute_anomalies_blocked(blocks, years=YEARS, grid=GRID, baseline_years=BASELINE_YEARS, min_samples=MIN_SAMPLES):
+    first_year = min(years[0], baseline_years[0])
+    last_year = max(years[-1], baseline_years[1])
+    n_cells = (180 // grid) * (360 // grid)
+    sums = np.zeros((n_cells, len(years) * 12))
+    counts = np.zeros((n_cells, len(years) * 12), dtype=np.int64)
+
+    for stations, data in blocks:
+        values = station_matrix(stations, data, first_year, last_year)
+        baselines, _ = cached_baselines(values, first_year, stations['station_id'].to_numpy(),
+                                        baseline_years=baseline_years, min_samples=min_samples)
+        anomalies = values[:, years[0] - first_year:years[-1] - first_year + 1] - baselines[:, None, :]
+        with ushcn_metrics.stage('gridding', grid=grid) as record:
+            cells, _ = grid_cells(stations['latitude'].to_numpy(), stations['longitude'].to_numpy(), grid)
+            occupied, block_sums, block_counts = group_sums(anomalies.reshape(len(anomalies), -1), cells)
+            sums[occupied] += block_sums
+            counts[occupied] += block_counts
+            record['rows_in'] = len(anomalies)
+
+    monthly = weighted_cell_mean(np.arange(n_cells), sums, counts, grid).reshape(len(years), 12)
+    return pl.DataFrame({'year': list(years), 'temp': monthly.sum(axis=1) / 12})
+
+# Function to compute the annual series for every combination of grid size, baseline
+# period and population class set, from one parse of the data. The anomaly matrix is
+# built once per baseline period, and the per-cell sums once per grid size, split by
+# population class, so that any set of classes is just a sum of those per-class sums.
+# popcls_sets needs a 'popcls' column in stations (GHCN v3 inventories have one);
+# None uses every station. With a fingerprint, the baselines come from the baseline cache.
+# Returns a tidy frame of grid, baseline_start, baseline_end, popcls, year, temp.
+def sweep(stations, data, grids=(5, 10, 15, 20, 30), baseline_periods=(BASELINE_YEARS,), popcls_sets=None,
+          years=YEARS, min_samples=MIN_SAMPLES, fingerprint=None, element=None, dataset_type=None):
+    first_year = min([years[0]] + [start for start, _ in baseline_periods])
+    last_year = max([years[-1]] + [end for _, end in baseline_periods])
+    values = station_matrix(stations, data, first_year, last_year)
+    latitude = stations['latitude'].to_numpy()
+    longitude = stations['longitude'].to_numpy()
+
+    if popcls_sets is None:
+        n_classes = 1
+        station_class = np.zeros(stations.height, dtype=np.intp)
+        set_classes = {None: [0]}
+    else:
+        classes = sorted(set(''.join(popcls_sets)))
+        n_classes = len(classes)
+        station_class = np.array([classes.index(c) if c in classes else -1 for c in stations['popcls']], dtype=np.intp)
+        set_classes = {popcls: [classes.index(c) for c in set(popcls)] for popcls in popcls_sets}
+    # Stations in no requested class are left out
+    included = station_class >= 0
+
+    results = []
+    for baseline_years in baseline_periods:
+        baselines, _ = cached_baselines(values, first_year, stations['station_id'].to_numpy(), fingerprint,
+                                        element, dataset_type, baseline_years, min_samples)
+        anomalies = values[included, years[0] - first_year:years[-1] - first_year + 1] - baselines[included, None, :]
+        flat = anomalies.reshape(-1, len(years) * 12)
+
+        for grid in grids:
+            with ushcn_metrics.stage('gridding', grid=grid) as record:
+                cells, n_cells = grid_cells(latitude[included], longitude[included], grid)
+                keys, sums, counts = group_sums(flat, station_class[included] * n_cells + cells)
+
+                # Lay the per-class cell sums out as [class, occupied cell, year/month]
+                occupied, cell_index = np.unique(keys % n_cells, return_inverse=True)
+                class_sums = np.zeros((n_classes, len(occupied), flat.shape[1]))
+                class_counts = np.zeros((n_classes, len(occupied), flat.shape[1]))
+                class_sums[keys // n_cells, cell_index] = sums
+                class_counts[keys // n_cells, cell_index] = counts
+                record['rows_in'] = len(flat)
+                record['cells'] = len(occupied)
+
+            for popcls, class_indexes in set_classes.items():
+                # Add up the per-class cell sums of the classes in this set
+                set_sums = class_sums[class_indexes].sum(axis=0)
+                set_counts = class_counts[class_indexes].sum(axis=0)
+                monthly = weighted_cell_mean(occupied, set_sums, set_counts, grid).reshape(len(years), 12)
+                results.append(pl.DataFrame({
+                    'grid': grid,
+                    'baseline_start': baseline_years[0],
+                    'baseline_end': baseline_years[1],
+                    'popcls': popcls,
+                    'year': list(years),
+                    'temp': monthly.sum(axis=1) / 12,
+                }, schema_overrides={'popcls': pl.Utf8}))
+
+    return pl.concat(results)
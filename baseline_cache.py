@@ -0,0 +1,60 @@
+import hashlib
+import json
+import os
+import numpy as np
+
+# Configuration
+# One .npz per (fingerprint, dataset type, element, baseline years, min samples), next to
+# this module whatever the working directory
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'baselines')
+MAX_BYTES = 512 * 1024 * 1024  # Least recently used entries are evicted beyond this
+
+# Function to get the cache key for a set of baselines. fingerprint identifies the source
+# data (see anomaly_engine.file_fingerprint); element/dataset_type are None for GHCN files.
+def cache_key(fingerprint, dataset_type, element, baseline_years, min_samples):
+    key = json.dumps([fingerprint, dataset_type, element, list(baseline_years), min_samples])
+    return hashlib.sha256(key.encode()).hexdigest()
+
+# Function to look up baselines and sample counts for the given station ids (in that order).
+# Returns None when there is no entry, or the entry does not cover every station.
+def load(key, station_ids, cache_dir=CACHE_DIR):
+    path = os.path.join(cache_dir, f'{key}.npz')
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as entry:
+        cached_ids, baselines, counts = entry['station_ids'], entry['baselines'], entry['counts']
+    # Entries are stored sorted by station id
+    where = np.searchsorted(cached_ids, station_ids).clip(0, max(len(cached_ids) - 1, 0))
+    if not len(cached_ids) or not np.array_equal(cached_ids[where], station_ids):
+        return None
+    os.utime(path)  # mark as recently used
+    return baselines[where], counts[where]
+
+# Function to store baselines and sample counts (one row per station id), then evict the
+# least recently used entries until the cache fits in max_bytes
+def store(key, station_ids, baselines, counts, cache_dir=CACHE_DIR, max_bytes=MAX_BYTES):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, f'{key}.npz')
+    tmp_path = f'{path}.tmp'
+    station_ids = np.asarray(station_ids, dtype=str)
+    order = np.argsort(station_ids)
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, station_ids=station_ids[order], baselines=baselines[order], counts=counts[order])
+    os.replace(tmp_path, path)
+    evict(max_bytes, cache_dir, keep=path)
+
+# Function to delete the least recently used entries until the cache fits in max_bytes
+def evict(max_bytes=MAX_BYTES, cache_dir=CACHE_DIR, keep=None):
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith('.npz'):
+            path = os.path.join(cache_dir, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path != keep:
+            os.remove(path)
+            total -= size
@@ -0,0 +1,242 @@
+import argparse
+import datetime
+import glob
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import time
+import numpy as np
+import polars as pl
+import anomaly_bootstrap
+import anomaly_engine
+import ghcn_v4
+import synthetic_data
+import ushcn_metrics
+import ushcn_to_polars
+
+# Configuration
+WORK_DIR = '.cache/bench'  # Generated inputs, reused across runs
+RESULTS_DIR = 'benchmark_results'
+STAGES = ['parse_stations', 'parse_element_data', 'process_elements', 'anomalies']
+EXTRA_STAGES = ['ghcn_v4', 'bootstrap']  # Only run when asked for (--stages)
+BOOTSTRAP_REPLICATES = 200
+SCALES = [1]
+
+# Benchmarks of the ingest and anomaly stages on synthetic inputs (see synthetic_data.py),
+# so they run offline and at any network size. Every stage runs in a fresh process, so
+# its peak RSS is its own, with the instrumented sub-stages (ushcn_metrics) as a breakdown;
+# results are written as JSON and can be compared across commits:
+#
+#   python benchmarks.py --scales 1 10 --compare benchmark_results/<earlier run>.json
+
+# Function to get the generated inputs for a scale, writing them the first time
+def bench_inputs(scale, years=synthetic_data.YEARS, seed=synthetic_data.SEED, work_dir=WORK_DIR):
+    inputs_dir = os.path.join(work_dir, f'inputs-x{scale:g}-{years[0]}-{years[1]}-seed{seed}')
+    raw_data_dir = os.path.join(inputs_dir, 'raw')
+    ghcn_dir = os.path.join(inputs_dir, 'ghcn')
+    done = os.path.join(inputs_dir, 'done')
+    if not os.path.exists(done):
+        print(f'Generating inputs for scale {scale:g} in {inputs_dir}/...')
+        synthetic_data.write_ushcn_snapshot(raw_data_dir, synthetic_data.scaled_stations(scale), years, seed)
+        synthetic_data.write_ghcn_v3(ghcn_dir, synthetic_data.scaled_stations(scale, synthetic_data.GHCN_V3_STATIONS), seed=seed)
+        # The per-file parser reads extracted files
+        ushcn_to_polars.extract_tar_gz(ushcn_to_polars.archive_path(raw_data_dir, 'tmax', 'raw'), inputs_dir)
+        open(done, 'w').close()
+    return inputs_dir
+
+# Function to get the generated GHCN v4 inputs for a scale (1 = ~27,000 stations), writing them the first time
+def bench_v4_inputs(scale, seed=synthetic_data.SEED, work_dir=WORK_DIR):
+    v4_dir = os.path.join(work_dir, f'ghcn-v4-x{scale:g}-seed{seed}')
+    done = os.path.join(v4_dir, 'done')
+    if not os.path.exists(done):
+        print(f'Generating GHCN v4 inputs for scale {scale:g} in {v4_dir}/...')
+        synthetic_data.write_ghcn_v4(v4_dir, synthetic_data.scaled_stations(scale, synthetic_data.GHCN_V4_STATIONS), seed=seed)
+        open(done, 'w').close()
+    return v4_dir
+
+# Function to get the total size of some files
+def _size(file_paths):
+    return sum(os.path.getsize(file_path) for file_path in file_paths)
+
+# Stage: parse the station list
+def bench_parse_stations(inputs_dir, workers):
+    file_path = os.path.join(inputs_dir, 'raw', 'ushcn-v2.5-stations.txt')
+    return {'rows': ushcn_to_polars.parse_stations(file_path).height, 'bytes_in': _size([file_path])}
+
+# Stage: parse the extracted tmax/raw files one at a time, as the original script did
+def bench_parse_element_data(inputs_dir, workers):
+    file_paths = sorted(glob.glob(os.path.join(inputs_dir, synthetic_data.SNAPSHOT, '*.raw.tmax')))
+    df = pl.concat([ushcn_to_polars.parse_element_data(file_path, 'tmax', 'raw') for file_path in file_paths])
+    return {'rows': df.height, 'bytes_in': _size(file_paths), 'files': len(file_paths)}
+
+# Stage: full ingest of every archive into a scratch directory (partitions, adjustments, rollups)
+def bench_process_elements(inputs_dir, workers):
+    raw_data_dir = os.path.abspath(os.path.join(inputs_dir, 'raw'))
+    run_dir = os.path.join(inputs_dir, 'run')
+    os.makedirs(run_dir, exist_ok=True)
+    os.chdir(run_dir)
+    ushcn_to_polars.process_elements(raw_data_dir, workers=workers, full=True)
+    partitions = glob.glob(os.path.join(ushcn_to_polars.MONTHLY_DATA_DIR, '**', '*.parquet'), recursive=True)
+    rows = ushcn_to_polars.scan_monthly().select(pl.len()).collect().item()
+    return {'rows': rows, 'bytes_in': _size(glob.glob(os.path.join(raw_data_dir, '*.tar.gz'))), 'bytes_out': _size(partitions)}
+
+# Stage: read the GHCN v3 files and compute the gridded anomaly series (no baseline cache)
+def bench_anomalies(inputs_dir, workers):
+    inventory = os.path.join(inputs_dir, 'ghcn', 'v3.inv')
+    data_file = os.path.join(inputs_dir, 'ghcn', 'v3.mean')
+    stations = anomaly_engine.read_ghcn_v3_inventory(inventory)
+    data = anomaly_engine.read_ghcn_v3_data(data_file)
+    series = anomaly_engine.compute_anomalies(stations, data)
+    return {'rows': data.height, 'bytes_in': _size([inventory, data_file]), 'stations': stations.height,
+            'checksum': float(np.nansum(series['temp'].to_numpy()))}
+
+# Stage: bootstrap replicates of the GHCN v3 series, always through the process pool when
+# workers > 1 (compare --workers 1 with more to see what the pool costs and saves)
+def bench_bootstrap(inputs_dir, workers):
+    inventory = os.path.join(inputs_dir, 'ghcn', 'v3.inv')
+    data_file = os.path.join(inputs_dir, 'ghcn', 'v3.mean')
+    stations = anomaly_engine.read_ghcn_v3_inventory(inventory)
+    anomalies = anomaly_engine.anomaly_matrix(stations, anomaly_engine.read_ghcn_v3_data(data_file))
+    start = time.perf_counter()
+    replicates = anomaly_bootstrap.bootstrap_replicates(anomalies, stations['latitude'].to_numpy(),
+                                                        stations['longitude'].to_numpy(), replicates=BOOTSTRAP_REPLICATES,
+                                                        workers=workers, min_parallel_work=0)
+    wall = time.perf_counter() - start
+    work = BOOTSTRAP_REPLICATES * anomalies.shape[0] * anomalies.shape[1] * anomalies.shape[2]
+    return {'rows': BOOTSTRAP_REPLICATES, 'bytes_in': _size([inventory, data_file]), 'stations': stations.height,
+            'replicates_s': wall, 'work_per_s': work / wall, 'checksum': float(replicates.sum())}
+
+# Stage: build the GHCN v4 store and compute the 5x5 degree series out of core
+def bench_ghcn_v4(inputs_dir, workers):
+    inventory = os.path.join(inputs_dir, 'v4.inv')
+    data_file = os.path.join(inputs_dir, 'v4.dat')
+    store_dir = os.path.join(inputs_dir, 'store')
+    shutil.rmtree(store_dir, ignore_errors=True)
+    series = ghcn_v4.ghcn_v4_anomalies(inventory, data_file, store_dir, grid=5)
+    with open(os.path.join(store_dir, 'index.json')) as f:
+        index = json.load(f)
+    return {'rows': index['rows'], 'bytes_in': _size([inventory, data_file]), 'stations': index['stations'],
+            'checksum': float(np.nansum(series['temp'].to_numpy()))}
+
+# Function to get the peak RSS (MB) of this process and of its finished child processes
+def _peak_rss_mb():
+    kb = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return kb / 1024
+
+# Function to run one stage in this (fresh) process and send back its measurements
+def _run_stage(stage, inputs_dir, workers, queue):
+    function = globals()[f'bench_{stage}']
+    rss_before = _peak_rss_mb()
+    times_before = os.times()
+    metrics = ushcn_metrics.start()
+    start = time.perf_counter()
+    counts = function(inputs_dir, workers)
+    wall = time.perf_counter() - start
+    ushcn_metrics.stop()
+    times_after = os.times()
+    cpu = sum(after - before for after, before in zip(times_after[:4], times_before[:4]))
+    queue.put(dict(counts, wall_s=wall, cpu_s=cpu, peak_rss_mb=_peak_rss_mb(), start_rss_mb=rss_before,
+                   breakdown=metrics.totals()))
+
+# Function to run one stage in a new process ('spawn', so nothing is inherited from earlier stages)
+def run_stage(stage, inputs_dir, workers=1):
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=_run_stage, args=(stage, inputs_dir, workers, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+# Function to run the stages at one scale, keeping the fastest of `repeat` runs of each
+def run_scale(scale, stages=STAGES, years=synthetic_data.YEARS, seed=synthetic_data.SEED, workers=1, repeat=1,
+              work_dir=WORK_DIR):
+    inputs_dir = bench_inputs(scale, years, seed, work_dir)
+    results = {}
+    for stage in stages:
+        stage_dir = bench_v4_inputs(scale, seed, work_dir) if stage == 'ghcn_v4' else inputs_dir
+        runs = [run_stage(stage, stage_dir, workers) for _ in range(repeat)]
+        best = min(runs, key=lambda run: run['wall_s'])
+        best['wall_s_all'] = [run['wall_s'] for run in runs]
+        best['rows_per_s'] = best['rows'] / best['wall_s'] if best['wall_s'] > 0 else None
+        results[stage] = best
+        print(f'  x{scale:g} {stage}: {best["wall_s"]:.3f}s wall, {best["cpu_s"]:.3f}s cpu, '
+              f'{best["peak_rss_mb"]:.0f} MB peak, {best["rows"]} rows')
+    return {
+        'scale': scale,
+        'ushcn_stations': synthetic_data.scaled_stations(scale),
+        'ghcn_stations': synthetic_data.scaled_stations(scale, synthetic_data.GHCN_V3_STATIONS),
+        'years': list(years),
+        'seed': seed,
+        'stages': results,
+    }
+
+# Function to describe the code and machine a run was made on
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'polars': pl.__version__,
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+# Function to print the wall time and peak RSS ratios of a run against an earlier one
+def compare(results, baseline):
+    previous = {run['scale']: run for run in baseline['runs']}
+    print(f'Compared with {baseline["environment"]["commit"]} ({baseline["environment"]["timestamp"]}):')
+    for run in results['runs']:
+        if run['scale'] not in previous:
+            continue
+        for stage, result in run['stages'].items():
+            before = previous[run['scale']]['stages'].get(stage)
+            if before is None:
+                continue
+            print(f'  x{run["scale"]:g} {stage}: wall {result["wall_s"] / before["wall_s"]:.2f}x, '
+                  f'peak RSS {result["peak_rss_mb"] / before["peak_rss_mb"]:.2f}x')
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the ingest and anomaly stages on synthetic data.')
+    parser.add_argument('--scales', type=float, nargs='+', default=SCALES, help='network sizes relative to the real one (1 to 100)')
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES + EXTRA_STAGES)
+    parser.add_argument('--years', type=int, nargs=2, default=synthetic_data.YEARS, metavar=('FIRST', 'LAST'), help='USHCN years, inclusive')
+    parser.add_argument('--seed', type=int, default=synthetic_data.SEED)
+    parser.add_argument('--workers', type=int, default=1, help='parser processes for process_elements')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per stage (the fastest is kept)')
+    parser.add_argument('--work-dir', default=WORK_DIR, help='where the generated inputs are kept')
+    parser.add_argument('--output', help=f'results file (default: {RESULTS_DIR}/<commit>-<time>.json)')
+    parser.add_argument('--compare', help='earlier results file to compare with')
+    args = parser.parse_args()
+
+    results = {'environment': environment(), 'workers': args.workers, 'runs': []}
+    for scale in args.scales:
+        print(f'Scale x{scale:g}:')
+        results['runs'].append(run_scale(scale, args.stages, tuple(args.years), args.seed, args.workers, args.repeat,
+                                         os.path.abspath(args.work_dir)))
+
+    output = args.output
+    if output is None:
+        stamp = results['environment']['timestamp'].replace(':', '').replace('-', '')
+        output = os.path.join(RESULTS_DIR, f'{results["environment"]["commit"] or "nocommit"}-{stamp}.json')
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Saved results to {output}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+import hashlib
+import json
+from collections import OrderedDict
+import polars as pl
+from session_cache import SessionCache, source_fingerprint
+from ushcn_dataset import UshcnDataset
+
+# Configuration
+MAX_ENTRIES = 64  # Results kept in memory; the least recently used go first
+CACHE_DIR = '.cache/charts'  # Disk tier: <sources>-<fingerprint>/<name>-<arguments hash>.arrow
+FINAL = 'FLs.52j'
+JULY = 7
+
+# The series behind the notebooks' charts (replicate-ushcn-vid.ipynb and
+# adjustment_analysis.ipynb), built from lazy queries on the monthly dataset and cached by
+# name, arguments and the fingerprint of the source files. Results are kept in an
+# in-memory LRU and, with disk=True, as session cache entries (session_cache.py) that
+# later kernels memory-map. Series are built on top of each other through the cache, so
+# overlapping requests share their aggregates: the raw and final July series, the 5- and
+# 9-year rolling means and the raw vs final comparison all start from one cached
+# monthly_means per dataset type.
+#
+#   charts = ChartData(disk=True)
+#   july = charts.july_temps('raw')
+#   comparison = charts.july_comparison()
+
+# Function to convert a column of °C values to °F
+def _fahrenheit(column):
+    return pl.col(column) * 9 / 5 + 32
+
+class ChartData:
+    def __init__(self, ds=None, max_entries=MAX_ENTRIES, disk=False, cache_dir=CACHE_DIR):
+        self.ds = UshcnDataset() if ds is None else ds
+        self.sources = [self.ds.data_dir, self.ds.stations_file]
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir if disk else None
+        self.memory = OrderedDict()
+        self.stats = {'memory': 0, 'disk': 0, 'built': 0}
+
+    # Function to get a result from memory, then from disk, building (and storing) it on a
+    # miss. The key is the name, the arguments and the fingerprint of the sources, so a
+    # rewrite of the monthly data gives new entries rather than stale ones.
+    def _cached(self, name, args, build):
+        fingerprint = source_fingerprint(*self.sources)
+        arguments = json.dumps(args, default=str)
+        key = (fingerprint, name, arguments)
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.stats['memory'] += 1
+            return self.memory[key]
+
+        df = None
+        if self.cache_dir is not None:
+            cache = SessionCache(self.sources, self.cache_dir)
+            entry = f'{name}-{hashlib.sha256(arguments.encode()).hexdigest()[:16]}'
+            df = cache.load(entry)
+            if df is not None:
+                self.stats['disk'] += 1
+        if df is None:
+            df = build()
+            self.stats['built'] += 1
+            if self.cache_dir is not None:
+                df = cache.store(entry, df)
+
+        self.memory[key] = df
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+        return df
+
+    # Function to drop the in-memory results (the disk tier is kept)
+    def clear(self):
+        self.memory.clear()
+
+    # Function to get one element/dataset type with the value as temp_c and temp_f (the
+    # notebooks' clean_source), from first_year on, optionally without the missing values
+    def clean_source(self, element='tmax', dataset_type='raw', first_year=None, has_value=False):
+        def build():
+            lf = self.ds.query(element=element, dataset_type=dataset_type, years=(first_year, None), has_value=has_value)
+            return self.ds.collect(
+                lf
+                .with_columns(
+                    pl.col('value').alias('temp_c'),
+                    _fahrenheit('value').alias('temp_f'),
+                )
+                .drop(['element', 'dataset_type', 'value'])
+            )
+        return self._cached('clean_source', [element, dataset_type, first_year, has_value], build)
+
+    # Function to get the yearly mean (°C) of one calendar month over every station
+    def monthly_means(self, element='tmax', dataset_type='raw', month=JULY, first_year=1895):
+        def build():
+            lf = self.ds.query(element=element, dataset_type=dataset_type, years=(first_year, None), months=month,
+                               has_value=True)
+            return self.ds.collect(lf.group_by('year').agg(pl.col('value').mean().alias('mean')).sort('year'))
+        return self._cached('monthly_means', [element, dataset_type, month, first_year], build)
+
+    # Function to get the yearly July mean in °F, with centered rolling means over each
+    # window (july_mean_<window>yr columns), as make_july_temps_df did
+    def july_temps(self, dataset_type='raw', element='tmax', first_year=1895, windows=(5, 9)):
+        def build():
+            return self.monthly_means(element, dataset_type, JULY, first_year).select(
+                'year',
+                _fahrenheit('mean').alias('july_mean'),
+                *[_fahrenheit('mean').rolling_mean(window_size=window, center=True).alias(f'july_mean_{window}yr')
+                  for window in windows],
+            )
+        return self._cached('july_temps', [dataset_type, element, first_year, list(windows)], build)
+
+    # Function to set the raw and final July series side by side (final columns suffixed
+    # _altered), with their difference and its centered rolling mean over diff_window years
+    def july_comparison(self, element='tmax', first_year=1895, windows=(5, 9), diff_window=5, base='raw', other=FINAL):
+        def build():
+            return (
+                self.july_temps(base, element, first_year, windows)
+                .join(self.july_temps(other, element, first_year, windows), on='year', how='inner', suffix='_altered')
+                .with_columns(
+                    (pl.col('july_mean_altered') - pl.col('july_mean')).alias('diff'),
+                    (pl.col('july_mean_altered') - pl.col('july_mean')).rolling_mean(diff_window, center=True)
+                    .alias(f'diff_{diff_window}yr'),
+                )
+            )
+        return self._cached('july_comparison', [element, first_year, list(windows), diff_window, base, other], build)
+
+    # Function to get the yearly number of reported values, the number estimated ('E'
+    # dmflag) and their percentage, as make_percent_fab_chart did
+    def percent_estimated(self, element='tmax', dataset_type=FINAL, first_year=1920):
+        def build():
+            return (
+                self.clean_source(element, dataset_type, first_year, has_value=True)
+                .group_by('year')
+                .agg(
+                    pl.col('temp_c').is_not_null().sum().alias('n_reports'),
+                    (pl.col('dmflag') == 'E').sum().alias('n_estimated'),
+                )
+                .with_columns((100 * pl.col('n_estimated') / pl.col('n_reports')).alias('percent_estimated'))
+                .sort('year')
+            )
+        return self._cached('percent_estimated', [element, dataset_type, first_year], build)
+
+    # Function to get the yearly number of reporting stations and their mean value (°C)
+    def station_counts(self, element='tmax', dataset_type='raw', years=(1920, 2024)):
+        def build():
+            lf = self.ds.query(element=element, dataset_type=dataset_type, years=tuple(years), has_value=True)
+            return self.ds.collect(
+                lf
+                .group_by('year')
+                .agg(
+                    pl.col('coop_id').n_unique().alias('n_stations'),
+                    pl.col('value').mean().alias(f'{element}_mean'),
+                )
+                .sort('year')
+            )
+        return self._cached('station_counts', [element, dataset_type, list(years)], build)
+
+    # Function to pair every final value with its raw value (left join, so values that only
+    # exist in the final data keep a null raw value), with the adjustment in °F
+    def adjusted_vs_raw(self, element='tmax', first_year=None, base='raw', other=FINAL):
+        def build():
+            return (
+                self.clean_source(element, other, first_year)
+                .join(self.clean_source(element, base, first_year), on=['coop_id', 'year', 'month'], how='left',
+                      suffix='_raw')
+                .sort(['year', 'month', 'coop_id'])
+                .select(['year', 'month', 'coop_id', 'temp_f', 'dmflag', 'temp_f_raw', 'dmflag_raw'])
+                .with_columns((pl.col('temp_f') - pl.col('temp_f_raw')).alias('adjustment'))
+            )
+        return self._cached('adjusted_vs_raw', [element, first_year, base, other], build)
+
+    # Function to get the yearly adjustment statistics of adjustment_analysis.ipynb: how many
+    # values were adjusted and by how much on average, and how many were estimated and how
+    # far the estimates are from the mean of the values that were not
+    def adjustment_stats(self, element='tmax', first_year=None):
+        def build():
+            estimated = (pl.col('dmflag') == 'E') & pl.col('temp_f').is_not_null()
+            return (
+                self.adjusted_vs_raw(element, first_year)
+                .group_by('year')
+                .agg(
+                    pl.col('temp_f').is_not_null().sum().alias('n_obs_altered'),
+                    pl.col('adjustment').count().alias('n_obs_both'),
+                    pl.col('adjustment').filter(pl.col('adjustment') != 0).count().alias('n_adjs'),
+                    pl.col('temp_f').filter(estimated).count().alias('n_ests'),
+                    pl.col('adjustment').filter(pl.col('adjustment') != 0).mean().alias('avg_adj'),
+                    pl.col('temp_f').filter(estimated).mean().alias('avg_est'),
+                    pl.col('temp_f_raw').filter((pl.col('dmflag') != 'E') | pl.col('dmflag').is_null())
+                    .mean().alias('avg_not_est_raw'),
+                )
+                .with_columns(
+                    (100 * pl.col('n_adjs') / pl.col('n_obs_both')).alias('percent_adjusted'),
+                    (pl.col('avg_est') - pl.col('avg_not_est_raw')).alias('avg_est_delta'),
+                )
+                .sort('year')
+            )
+        return self._cached('adjustment_stats', [element, first_year], build)
+
+    # Function to get every final value that has a raw value, with the adjustment in °F
+    # and °C, from first_year on
+    def adjustment_deltas(self, element='tmax', first_year=1920, base='raw', other=FINAL):
+        def build():
+            return (
+                self.clean_source(element, other, first_year, has_value=True)
+                .join(self.clean_source(element, base, first_year, has_value=True), on=['coop_id', 'year', 'month'],
+                      how='left', suffix='_raw')
+                .filter(pl.col('temp_f_raw').is_not_null())
+                .with_columns(
+                    (pl.col('temp_f') - pl.col('temp_f_raw')).alias('adjustment_f'),
+                    (pl.col('temp_c') - pl.col('temp_c_raw')).alias('adjustment_c'),
+                )
+            )
+        return self._cached('adjustment_deltas', [element, first_year, base, other], build)
+
+    # Function to get the yearly mean adjustment (°F) of one calendar month
+    def monthly_adjustments(self, element='tmax', month=JULY, first_year=1920):
+        def build():
+            return (
+                self.adjustment_deltas(element, first_year)
+                .filter(pl.col('month') == month)
+                .group_by('year')
+                .agg(pl.col('adjustment_f').mean().alias('mean_adjustment_f'))
+                .sort('year')
+            )
+        return self._cached('monthly_adjustments', [element, month, first_year], build)
@@ -0,0 +1,202 @@
+import argparse
+import glob
+import json
+import os
+import sys
+import numpy as np
+import polars as pl
+import anomaly_engine
+import ushcn_manifest
+import ushcn_metrics
+from ushcn_to_polars import byte_matrix, parse_ints
+
+# Configuration
+STORE_DIR = 'ghcn_v4_store'  # stations.parquet, data/part-*.parquet, lines/part-*.parquet, index.json
+CHUNK_BYTES = 16 << 20  # Data file bytes parsed at a time (~145,000 lines)
+BLOCK_STATIONS = 2000  # Stations per out-of-core block
+ROW_GROUP_SIZE = 100_000
+
+# GHCN-M v4 support for the anomaly engine. v4 has ~27,000 stations (about 4x v3), so the
+# data file is parsed a chunk at a time into a columnar store on disk, and the anomalies
+# are computed one block of stations at a time (anomaly_engine.compute_anomalies_blocked).
+# Neither step holds more than a chunk or a block in memory.
+#
+#   python ghcn_v4.py ghcnm.tavg.v4.0.1.<date>.qcu.inv ghcnm.tavg.v4.0.1.<date>.qcu.dat --grid 5
+
+# Function to read a GHCN v4 inventory (.inv) file; v4 has no population class
+def read_ghcn_v4_inventory(file_path):
+    with open(file_path, 'rb') as f:
+        matrix = byte_matrix(f.read(), 68)
+
+    def field(start, end):
+        return pl.Series(np.ascontiguousarray(matrix[:, start:end]).view(f'S{end - start}').ravel()).cast(pl.Utf8)
+
+    return pl.DataFrame({
+        'station_id': field(0, 11),
+        'latitude': field(12, 20).str.strip_chars().cast(pl.Float64),
+        'longitude': field(21, 30).str.strip_chars().cast(pl.Float64),
+        'elevation': field(31, 37).str.strip_chars().cast(pl.Float64),
+        'name': field(38, 68).str.strip_chars(),
+    })
+
+# Function to read a file in chunks of whole lines
+def iter_line_chunks(file_path, chunk_bytes=CHUNK_BYTES):
+    rest = b''
+    with open(file_path, 'rb') as f:
+        while True:
+            data = f.read(chunk_bytes)
+            if not data:
+                break
+            data = rest + data
+            cut = data.rfind(b'\n') + 1
+            rest = data[cut:]
+            if cut:
+                yield data[:cut]
+    if rest.strip():
+        yield rest
+
+# Function to parse one chunk of a GHCN v3/v4 data file (lines x 115 byte matrix) into
+# (rows, lines): rows are the values without a measurement or quality flag, lines is
+# every station/year line. line numbers count from first_line, so duplicates of a
+# station/year can be resolved across chunks (the last line wins, as in anomalies.py).
+def _chunk_tables(matrix, first_line):
+    n_lines = len(matrix)
+    months = matrix[:, 19:115].reshape(n_lines, 12, 8)
+    temps = parse_ints(months[:, :, 0:5])
+    unflagged = (months[:, :, 5] == ord(' ')) & (months[:, :, 6] == ord(' '))
+    valid = (temps != -9999) & unflagged
+
+    lines = pl.DataFrame({
+        'station_id': pl.Series(np.ascontiguousarray(matrix[:, 0:11]).view('S11').ravel()).cast(pl.Utf8),
+        'year': parse_ints(matrix[:, 11:15]).astype(np.int16),
+        'line': np.arange(first_line, first_line + n_lines, dtype=np.int64),
+    })
+    line, month = np.nonzero(valid)
+    rows = pl.DataFrame({
+        'station_id': lines['station_id'].gather(line),
+        'year': lines['year'].gather(line),
+        'month': (month + 1).astype(np.int8),
+        'temp': temps[line, month].astype(np.int16),  # hundredths of °C
+        'line': lines['line'].gather(line),
+    })
+    return rows, lines
+
+# Function to build the columnar store from an inventory and a data file, one chunk at a
+# time. Stations are numbered in station_id order, and every part is sorted by station,
+# so a block of stations only reads the row groups that hold it. Skipped when the store
+# was already built from the same files.
+def build_store(inventory, data_file, store_dir=STORE_DIR, chunk_bytes=CHUNK_BYTES):
+    source = ushcn_manifest.fingerprint(inventory, data_file)
+    index_file = os.path.join(store_dir, 'index.json')
+    if os.path.exists(index_file):
+        with open(index_file) as f:
+            if json.load(f).get('source') == source:
+                return store_dir
+
+    for sub_dir in ['data', 'lines']:
+        os.makedirs(os.path.join(store_dir, sub_dir), exist_ok=True)
+        for old in glob.glob(os.path.join(store_dir, sub_dir, '*.parquet')):
+            os.remove(old)
+    if os.path.exists(index_file):
+        os.remove(index_file)
+
+    stations = (
+        read_ghcn_v4_inventory(inventory)
+        .unique('station_id', keep='last')
+        .sort('station_id')
+        .with_row_index('station')
+    )
+    stations.write_parquet(os.path.join(store_dir, 'stations.parquet'))
+    station_index = stations.select('station_id', 'station')
+
+    n_lines = n_rows = 0
+    for part, chunk in enumerate(iter_line_chunks(data_file, chunk_bytes)):
+        with ushcn_metrics.stage('ghcn_v4_chunk', part=part) as record:
+            rows, lines = _chunk_tables(byte_matrix(chunk, 115), n_lines)
+            # Data for stations missing from the inventory is dropped here
+            for name, table in [('data', rows), ('lines', lines)]:
+                (
+                    table
+                    .join(station_index, on='station_id', how='inner')
+                    .drop('station_id')
+                    .sort(['station', 'year'])
+                    .write_parquet(os.path.join(store_dir, name, f'part-{part:05d}.parquet'),
+                                   row_group_size=ROW_GROUP_SIZE, statistics=True)
+                )
+            n_lines += lines.height
+            n_rows += rows.height
+            record['bytes_in'] = len(chunk)
+            record['rows_out'] = rows.height
+
+    with open(index_file, 'w') as f:
+        json.dump({'source': source, 'stations': stations.height, 'lines': n_lines, 'rows': n_rows}, f)
+    print(f'Saved GHCN v4 store to {store_dir}/ ({stations.height} stations, {n_rows} values)')
+    return store_dir
+
+# Function to read the (stations, data) of stations [first, last) from the store, in the
+# shape the anomaly engine takes (station_id is the store's station number)
+def load_station_block(store_dir, first, last):
+    in_block = pl.col('station').is_between(first, last, closed='left')
+    stations = (
+        pl.scan_parquet(os.path.join(store_dir, 'stations.parquet'))
+        .filter(in_block)
+        .select(pl.col('station').alias('station_id'), 'latitude', 'longitude')
+        .collect()
+    )
+    # Only the last line of a station/year counts
+    last_lines = (
+        pl.scan_parquet(os.path.join(store_dir, 'lines', '*.parquet'))
+        .filter(in_block)
+        .group_by('station', 'year')
+        .agg(pl.col('line').max())
+    )
+    data = (
+        pl.scan_parquet(os.path.join(store_dir, 'data', '*.parquet'))
+        .filter(in_block)
+        .join(last_lines, on=['station', 'year', 'line'], how='semi')
+        .select(
+            pl.col('station').alias('station_id'),
+            pl.col('year').cast(pl.Int32),
+            'month',
+            (pl.col('temp').cast(pl.Float64) * 0.01).alias('value'),
+        )
+        .collect()
+    )
+    return stations, data
+
+# Function to yield the store's stations block by block
+def iter_station_blocks(store_dir=STORE_DIR, block_stations=BLOCK_STATIONS):
+    with open(os.path.join(store_dir, 'index.json')) as f:
+        n_stations = json.load(f)['stations']
+    for first in range(0, n_stations, block_stations):
+        yield load_station_block(store_dir, first, first + block_stations)
+
+# Function to compute the gridded annual anomaly series of a GHCN v4 inventory/data file
+# pair out of core (building or reusing the store). Returns a frame of year, temp.
+def ghcn_v4_anomalies(inventory, data_file, store_dir=STORE_DIR, years=anomaly_engine.YEARS, grid=anomaly_engine.GRID,
+                      baseline_years=anomaly_engine.BASELINE_YEARS, min_samples=anomaly_engine.MIN_SAMPLES,
+                      block_stations=BLOCK_STATIONS, chunk_bytes=CHUNK_BYTES):
+    build_store(inventory, data_file, store_dir, chunk_bytes)
+    blocks = iter_station_blocks(store_dir, block_stations)
+    return anomaly_engine.compute_anomalies_blocked(blocks, years, grid, baseline_years, min_samples)
+
+def main():
+    parser = argparse.ArgumentParser(description='Gridded annual anomalies from GHCN-M v4 files, computed out of core.')
+    parser.add_argument('inventory', help='v4 inventory (.inv) file')
+    parser.add_argument('data_file', help='v4 data (.dat) file')
+    parser.add_argument('--grid', type=int, default=anomaly_engine.GRID, help='grid cell size in degrees')
+    parser.add_argument('--years', type=int, nargs=2, default=(anomaly_engine.YEARS[0], anomaly_engine.YEARS[-1]), metavar=('FIRST', 'LAST'))
+    parser.add_argument('--baseline', type=int, nargs=2, default=anomaly_engine.BASELINE_YEARS, metavar=('FIRST', 'LAST'))
+    parser.add_argument('--store-dir', default=STORE_DIR)
+    parser.add_argument('--block-stations', type=int, default=BLOCK_STATIONS, help='stations per block')
+    args = parser.parse_args()
+
+    series = ghcn_v4_anomalies(args.inventory, args.data_file, args.store_dir, range(args.years[0], args.years[1] + 1),
+                               args.grid, tuple(args.baseline), block_stations=args.block_stations)
+    print('year', ',', 'temp')
+    for year, temp in series.iter_rows():
+        print(year, ',', temp)
+    print('All finished!!', file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+import glob
+import hashlib
+import os
+import shutil
+import polars as pl
+import pyarrow as pa
+from ushcn_to_polars import MONTHLY_DATA_DIR
+
+# Configuration
+CACHE_DIR = '.cache/session'  # <sources>-<fingerprint>/<name>.arrow, one directory per version of the sources
+
+# Session cache for notebooks: frames are written once as uncompressed Arrow IPC files and
+# memory-mapped on every later load, so a kernel restart (or a second kernel, or a worker
+# process) gets the base table and its derived frames back without reading, decompressing,
+# filtering or joining anything again; the pages are shared through the OS page cache.
+# Entries belong to one version of the source parquet files: when the sources change, the
+# fingerprint changes and the old entries are dropped on the next store. Caches of other
+# sources in the same cache_dir (another dataset or station file) are left alone.
+#
+#   cache = SessionCache()
+#   raw = cache.frame('tmax_raw', lambda: build_raw(df))
+#
+# An entry is keyed by its name only, so give a frame a new name when its build changes.
+
+# Function to fingerprint the source parquet files (every .parquet under a directory, or a
+# file) by path, size and modification time: cheap enough for every kernel start, and any
+# rewrite of a partition changes it
+def source_fingerprint(*sources):
+    file_paths = []
+    for source in sources:
+        if os.path.isdir(source):
+            file_paths += glob.glob(os.path.join(source, '**', '*.parquet'), recursive=True)
+        elif os.path.exists(source):
+            file_paths.append(source)
+    digest = hashlib.sha256()
+    for file_path in sorted(file_paths):
+        stat = os.stat(file_path)
+        digest.update(f'{file_path}\0{stat.st_size}\0{stat.st_mtime_ns}\n'.encode())
+    return digest.hexdigest()
+
+# Function to identify a set of sources by their paths, whatever their contents
+def source_key(*sources):
+    paths = sorted(os.path.abspath(source) for source in sources)
+    return hashlib.sha256('\0'.join(paths).encode()).hexdigest()[:16]
+
+class SessionCache:
+    def __init__(self, sources=(MONTHLY_DATA_DIR,), cache_dir=CACHE_DIR):
+        self.cache_dir = cache_dir
+        self.fingerprint = source_fingerprint(*sources)
+        self.source_key = source_key(*sources)
+        self.entry_dir = os.path.join(cache_dir, f'{self.source_key}-{self.fingerprint[:16]}')
+
+    # Function to get the file of an entry
+    def path(self, name):
+        return os.path.join(self.entry_dir, f'{name}.arrow')
+
+    # Function to load an entry, memory-mapped (zero-copy), or None if there is none
+    def load(self, name):
+        path = self.path(name)
+        if not os.path.exists(path):
+            return None
+        table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+        return pl.from_arrow(table, rechunk=False)
+
+    # Function to store a frame (written to a temp file first, so other kernels never map
+    # half an entry), drop the entries of other source versions, and return the stored
+    # frame memory-mapped
+    def store(self, name, df):
+        os.makedirs(self.entry_dir, exist_ok=True)
+        path = self.path(name)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        df.write_ipc(tmp_path, compression='uncompressed')
+        os.replace(tmp_path, path)
+        self.evict_stale()
+        return self.load(name)
+
+    # Function to get an entry, building and storing it the first time
+    def frame(self, name, build):
+        df = self.load(name)
+        if df is None:
+            df = self.store(name, build())
+        return df
+
+    # Function to delete the entries of every other version of the same sources (files that
+    # are still mapped somewhere stay readable until they are unmapped)
+    def evict_stale(self):
+        for entry_dir in glob.glob(os.path.join(self.cache_dir, f'{self.source_key}-*')):
+            if os.path.isdir(entry_dir) and os.path.abspath(entry_dir) != os.path.abspath(self.entry_dir):
+                shutil.rmtree(entry_dir, ignore_errors=True)
+
+    # Function to delete this version's entries
+    def clear(self):
+        shutil.rmtree(self.entry_dir, ignore_errors=True)
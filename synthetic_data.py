@@ -0,0 +1,264 @@
+import argparse
+import gzip
+import io
+import os
+import tarfile
+import numpy as np
+from ushcn_to_polars import DATASET_TYPES, ELEMENTS
+
+# Configuration
+SEED = 2025
+REAL_STATIONS = 1218  # USHCN v2.5
+GHCN_V3_STATIONS = 7280  # GHCN-M v3
+GHCN_V4_STATIONS = 27000  # GHCN-M v4 (about)
+YEARS = (1895, 2024)  # Inclusive
+SNAPSHOT = 'ushcn.v2.5.5.20250419'  # Directory name inside the archives
+BLOCK = 1000  # Stations generated at a time (part of the seed, so keep it fixed)
+MISSING = -9999
+STATES = ['AL', 'AZ', 'AR', 'CA', 'CO', 'CT', 'DE', 'FL', 'GA', 'ID', 'IL', 'IN', 'IA', 'KS', 'KY', 'LA',
+          'ME', 'MD', 'MA', 'MI', 'MN', 'MS', 'MO', 'MT', 'NE', 'NV', 'NH', 'NJ', 'NM', 'NY', 'NC', 'ND',
+          'OH', 'OK', 'OR', 'PA', 'RI', 'SC', 'SD', 'TN', 'TX', 'UT', 'VT', 'VA', 'WA', 'WV', 'WI', 'WY']
+
+# Everything here is generated from a fixed seed, so the same arguments always give the
+# same bytes (archives included: the tar and gzip timestamps are pinned to 0). The values
+# are plausible rather than realistic: a seasonal cycle, a station offset, a small trend,
+# noise, ~3% missing values and the usual flags.
+
+# Function to get the number of stations for a scale factor (1 = the real network)
+def scaled_stations(scale, real_stations=REAL_STATIONS):
+    return max(1, round(real_stations * scale))
+
+# Function to format integers right-aligned into a (n, width) byte matrix, blank- or zero-padded
+def format_ints(values, width, zero_pad=False):
+    values = np.asarray(values, dtype=np.int64)
+    out = np.full((len(values), width), ord('0' if zero_pad else ' '), dtype=np.uint8)
+    rest = np.abs(values)
+    n_digits = np.ones(len(values), dtype=np.intp)
+    for position in range(width):
+        column = width - 1 - position
+        show = (rest > 0) | (position == 0)
+        out[show, column] = ord('0') + rest[show] % 10
+        n_digits[show] = position + 1
+        rest //= 10
+    negative = np.flatnonzero(values < 0)
+    out[negative, width - 1 - n_digits[negative]] = ord('-')
+    return out
+
+# Function to draw flag bytes: probabilities maps each flag character to its share (the rest is blank)
+def _flags(rng, shape, probabilities):
+    out = np.full(shape, ord(' '), dtype=np.uint8)
+    draw = rng.random(shape)
+    start = 0.0
+    for flag, probability in probabilities.items():
+        out[(draw >= start) & (draw < start + probability)] = ord(flag)
+        start += probability
+    return out
+
+# Function to get n distinct, sorted 6-digit coop ids
+def station_coop_ids(n_stations, seed=SEED):
+    rng = np.random.default_rng([seed, 0])
+    return np.sort(rng.choice(np.arange(10000, 1000000), n_stations, replace=False))
+
+# Function to write a USHCN v2.5 station list (ushcn-v2.5-stations.txt layout)
+def write_stations(file_path, n_stations=REAL_STATIONS, seed=SEED):
+    coop_ids = station_coop_ids(n_stations, seed)
+    rng = np.random.default_rng([seed, 1])
+    latitude = rng.uniform(25.0, 49.0, n_stations)
+    longitude = rng.uniform(-124.5, -67.0, n_stations)
+    elevation = rng.uniform(-50.0, 3500.0, n_stations)
+    states = rng.choice(STATES, n_stations)
+    components = rng.integers(10000, 1000000, (n_stations, 3))
+    has_component = rng.random((n_stations, 3)) < 0.05
+    utc_offset = np.clip(np.round(-longitude / 15.0).astype(int), 5, 8)
+
+    with open(file_path, 'w') as f:
+        for i in range(n_stations):
+            parts = [f'{components[i, c]:06d}' if has_component[i, c] else '------' for c in range(3)]
+            name = f'STATION {coop_ids[i]:06d}'
+            f.write(
+                f'USH00{coop_ids[i]:06d} {latitude[i]:8.4f} {longitude[i]:9.4f} {elevation[i]:6.1f} '
+                f'{states[i]} {name:30s} {parts[0]} {parts[1]} {parts[2]} {utc_offset[i]:+d}\n'
+            )
+    return coop_ids
+
+# Function to generate the values (native units: hundredths of °C, tenths of mm) and
+# flags of one element/dataset type for a block of stations, as arrays [station, year, month]
+def _ushcn_values(block, n_stations, element, dataset_type, n_years, seed):
+    e, d = ELEMENTS.index(element), DATASET_TYPES.index(dataset_type)
+    shape = (n_stations, n_years, 12)
+
+    # The raw series is shared by every dataset type of an element; tob and FLs.52j adjust it
+    rng = np.random.default_rng([seed, 2, e, block])
+    if element == 'prcp':
+        scale = rng.uniform(200.0, 1500.0, (n_stations, 1, 1))
+        raw = rng.gamma(2.0, scale / 2.0, shape)
+    else:
+        base = {'tmax': 1800.0, 'tmin': 500.0, 'tavg': 1150.0}[element]
+        season = -np.cos(2 * np.pi * np.arange(12) / 12) * 1200.0
+        offset = rng.normal(0.0, 500.0, (n_stations, 1, 1))
+        trend = np.linspace(0.0, 80.0, n_years)[None, :, None]
+        raw = base + season + offset + trend + rng.normal(0.0, 150.0, shape)
+    raw_missing = rng.random(shape) < 0.03
+
+    # Stations start reporting in different years
+    first_year = rng.integers(0, max(1, n_years // 3), n_stations)
+    reporting = np.arange(n_years)[None, :] >= first_year[:, None]
+
+    rng = np.random.default_rng([seed, 3, e, d, block])
+    values = raw
+    missing = raw_missing
+    dmflag = np.full(shape, ord(' '), dtype=np.uint8)
+    if dataset_type == 'tob':
+        values = raw + rng.normal(0.0, 20.0, (n_stations, 1, 12))
+    elif dataset_type == 'FLs.52j':
+        values = raw + rng.normal(0.0, 40.0, (n_stations, 1, 12)) - np.linspace(40.0, 0.0, n_years)[None, :, None]
+        # Most missing raw values are infilled (dmflag 'E'); a few good ones are removed
+        infilled = raw_missing & (rng.random(shape) < 0.8)
+        removed = ~raw_missing & (rng.random(shape) < 0.01)
+        missing = (raw_missing & ~infilled) | removed
+        dmflag[infilled] = ord('E')
+    if element == 'prcp':
+        values = np.maximum(values, 0.0)
+
+    values = np.where(missing, MISSING, np.round(values)).astype(np.int64)
+    qcflag = _flags(rng, shape, {'I': 0.002, 'Q': 0.002, 'X': 0.001})
+    dsflag = _flags(rng, shape, {'0': 0.3, '1': 0.05, '2': 0.05, '3': 0.05})
+    if dataset_type == 'raw':
+        dmflag = _flags(rng, shape, {'a': 0.005, 'b': 0.005})
+    dmflag[missing] = ord(' ')
+    return values, dmflag, qcflag, dsflag, reporting
+
+# Function to generate the USHCN v2.5 data files of one element/dataset type, yielding
+# (file name, bytes) per station, in coop id order
+def ushcn_element_files(coop_ids, element, dataset_type, years=YEARS, seed=SEED):
+    n_years = years[1] - years[0] + 1
+    for block, start in enumerate(range(0, len(coop_ids), BLOCK)):
+        block_ids = coop_ids[start:start + BLOCK]
+        n_stations = len(block_ids)
+        values, dmflag, qcflag, dsflag, reporting = _ushcn_values(block, n_stations, element, dataset_type, n_years, seed)
+
+        # One 124 character line per station/year: ID, year, then 12 x (value, 3 flags)
+        n_lines = n_stations * n_years
+        lines = np.full((n_lines, 125), ord(' '), dtype=np.uint8)
+        lines[:, 0:5] = np.frombuffer(b'USH00', dtype=np.uint8)
+        lines[:, 5:11] = format_ints(np.repeat(block_ids, n_years), 6, zero_pad=True)
+        lines[:, 12:16] = format_ints(np.tile(np.arange(years[0], years[1] + 1), n_stations), 4)
+        months = lines[:, 16:124].reshape(n_lines, 12, 9)
+        months[:, :, 0:6] = format_ints(values.ravel(), 6).reshape(n_lines, 12, 6)
+        months[:, :, 6] = dmflag.reshape(n_lines, 12)
+        months[:, :, 7] = qcflag.reshape(n_lines, 12)
+        months[:, :, 8] = dsflag.reshape(n_lines, 12)
+        lines[:, 124] = ord('\n')
+
+        lines = lines.reshape(n_stations, n_years, 125)
+        for i, coop_id in enumerate(block_ids):
+            yield f'USH00{coop_id:06d}.{dataset_type}.{element}', lines[i, reporting[i]].tobytes()
+
+# Function to write one tar.gz archive from (name, bytes) pairs, byte-for-byte reproducibly
+# (fast compression: reading the archives back costs the same either way)
+def _write_archive(file_path, members):
+    with open(file_path, 'wb') as f, gzip.GzipFile(fileobj=f, mode='wb', compresslevel=1, mtime=0) as gz:
+        with tarfile.open(fileobj=gz, mode='w', format=tarfile.USTAR_FORMAT) as tar:
+            for name, data in members:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                info.mode = 0o644
+                tar.addfile(info, io.BytesIO(data))
+
+# Function to write a USHCN snapshot directory like source-data/raw/<YYYYMMDD>: the station
+# list and one ushcn.<element>.latest.<dataset_type>.tar.gz per element/dataset type
+# (there is no tob precipitation, as in the real data). Returns the coop ids.
+def write_ushcn_snapshot(raw_data_dir, n_stations=REAL_STATIONS, years=YEARS, seed=SEED):
+    os.makedirs(raw_data_dir, exist_ok=True)
+    coop_ids = write_stations(os.path.join(raw_data_dir, 'ushcn-v2.5-stations.txt'), n_stations, seed)
+    for element in ELEMENTS:
+        for dataset_type in DATASET_TYPES:
+            if element == 'prcp' and dataset_type == 'tob':
+                continue
+            files = ushcn_element_files(coop_ids, element, dataset_type, years, seed)
+            archive = os.path.join(raw_data_dir, f'ushcn.{element}.latest.{dataset_type}.tar.gz')
+            _write_archive(archive, ((f'{SNAPSHOT}/{name}', data) for name, data in files))
+    return coop_ids
+
+# Function to write GHCN-M v3 inventory (v3.inv) and data (v3.mean) files for anomalies.py
+def write_ghcn_v3(out_dir, n_stations=GHCN_V3_STATIONS, years=(1880, 2019), seed=SEED):
+    return _write_ghcn(out_dir, 'v3.inv', 'v3.mean', n_stations, years, [seed, 4], popcls=True)
+
+# Function to write GHCN-M v4 inventory (v4.inv) and data (v4.dat) files. v4 has the same
+# data layout as v3; its inventory stops after the station name (no population class).
+# The data is generated and written BLOCK stations at a time, so any size fits in memory.
+def write_ghcn_v4(out_dir, n_stations=GHCN_V4_STATIONS, years=(1880, 2024), seed=SEED):
+    return _write_ghcn(out_dir, 'v4.inv', 'v4.dat', n_stations, years, [seed, 5], popcls=False, block=BLOCK)
+
+# Function to write a GHCN-M inventory and data file (block=None: all stations at once)
+def _write_ghcn(out_dir, inv_name, dat_name, n_stations, years, seed, popcls, block=None):
+    os.makedirs(out_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    # Stations cluster in the northern mid-latitudes, like the real network
+    latitude = np.clip(rng.normal(35.0, 25.0, n_stations), -89.9, 89.9)
+    longitude = rng.uniform(-179.9, 179.9, n_stations)
+    elevation = rng.uniform(-50.0, 4000.0, n_stations)
+    classes = rng.choice(['R', 'S', 'U'], n_stations, p=[0.6, 0.2, 0.2]) if popcls else None
+    station_ids = 10000000000 + np.arange(n_stations) * 1000
+
+    with open(os.path.join(out_dir, inv_name), 'w') as f:
+        for i in range(n_stations):
+            name = f'STATION {i}'
+            line = f'{station_ids[i]:011d} {latitude[i]:8.4f} {longitude[i]:9.4f} {elevation[i]:6.1f} {name:30s}'
+            if popcls:
+                line = f'{line} {int(elevation[i]):4d}{classes[i]}'.ljust(106)
+            f.write(line + '\n')
+
+    with open(os.path.join(out_dir, dat_name), 'wb') as f:
+        for start in range(0, n_stations, block or max(n_stations, 1)):
+            stations = np.arange(start, min(n_stations, start + (block or n_stations)))
+            f.write(_ghcn_lines(rng, stations, station_ids, latitude, years).tobytes())
+    return n_stations
+
+# Function to generate the data lines of some stations: each station reports for its own
+# span of years, one line per station/year
+def _ghcn_lines(rng, stations, station_ids, latitude, years):
+    n_stations = len(stations)
+    n_years = years[1] - years[0] + 1
+    first = rng.integers(0, n_years * 2 // 3, n_stations)
+    last = np.minimum(n_years, first + rng.integers(n_years // 4, n_years + 1, n_stations))
+    station_of_line = np.repeat(stations, last - first)
+    year_of_line = years[0] + np.concatenate([np.arange(a, b) for a, b in zip(first, last)])
+    n_lines = len(station_of_line)
+
+    season = -np.cos(2 * np.pi * np.arange(12) / 12) * np.sign(latitude)[station_of_line, None] * 1000.0
+    offset = (2500.0 - np.abs(latitude) * 50.0)[station_of_line, None]
+    trend = ((year_of_line - years[0]) / n_years * 100.0)[:, None]
+    values = np.round(offset + season + trend + rng.normal(0.0, 150.0, (n_lines, 12))).astype(np.int64)
+    values[rng.random((n_lines, 12)) < 0.05] = MISSING
+
+    lines = np.full((n_lines, 116), ord(' '), dtype=np.uint8)
+    lines[:, 0:11] = format_ints(station_ids[station_of_line], 11, zero_pad=True)
+    lines[:, 11:15] = format_ints(year_of_line, 4)
+    lines[:, 15:19] = np.frombuffer(b'TAVG', dtype=np.uint8)
+    months = lines[:, 19:115].reshape(n_lines, 12, 8)
+    months[:, :, 0:5] = format_ints(values.ravel(), 5).reshape(n_lines, 12, 5)
+    months[:, :, 5] = _flags(rng, (n_lines, 12), {'E': 0.01})
+    months[:, :, 6] = _flags(rng, (n_lines, 12), {'Q': 0.005, 'O': 0.002})
+    months[:, :, 7] = _flags(rng, (n_lines, 12), {'G': 0.05})
+    lines[:, 115] = ord('\n')
+    return lines
+
+def main():
+    parser = argparse.ArgumentParser(description='Write synthetic USHCN v2.5 and GHCN-M v3 inputs.')
+    parser.add_argument('out_dir', help='directory to write to')
+    parser.add_argument('--scale', type=float, default=1.0, help='network size relative to the real one (1 = 1,218 USHCN / 7,280 GHCN stations)')
+    parser.add_argument('--years', type=int, nargs=2, default=YEARS, metavar=('FIRST', 'LAST'), help='USHCN years, inclusive')
+    parser.add_argument('--seed', type=int, default=SEED)
+    args = parser.parse_args()
+
+    raw_data_dir = os.path.join(args.out_dir, 'raw')
+    n_stations = scaled_stations(args.scale)
+    write_ushcn_snapshot(raw_data_dir, n_stations, tuple(args.years), args.seed)
+    print(f'Wrote {n_stations} USHCN stations to {raw_data_dir}/')
+    ghcn_dir = os.path.join(args.out_dir, 'ghcn')
+    n_stations = write_ghcn_v3(ghcn_dir, scaled_stations(args.scale, GHCN_V3_STATIONS), seed=args.seed)
+    print(f'Wrote {n_stations} GHCN v3 stations to {ghcn_dir}/')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+import os
+import polars as pl
+import pytest
+import synthetic_data
+import ushcn_adjustments
+import ushcn_rollups
+import ushcn_row_hashes
+from ushcn_dataset import UshcnDataset
+from ushcn_to_polars import MONTHLY_DATA_DIR, archive_path, partition_path, process_elements, scan_monthly
+
+# Configuration
+N_STATIONS = 8
+YEARS = (2000, 2003)
+
+# The ingest end to end on a small synthetic snapshot: process_elements builds the monthly
+# partitions and everything kept in step with them (adjustments, rollups, row hashes).
+# Every test runs in its own working directory, as the manifest and the data directories
+# are relative to it.
+
+# Fixture: a synthetic snapshot directory (the working directory is the test's tmp_path)
+@pytest.fixture
+def raw_data_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    raw_data_dir = os.path.join('source-data', 'raw', '20250301')
+    synthetic_data.write_ushcn_snapshot(raw_data_dir, N_STATIONS, YEARS)
+    return raw_data_dir
+
+# Function to count the rows of each element/dataset type, from the rollups (through
+# UshcnDataset.aggregate) and from the monthly data itself
+def row_counts(ds):
+    rollups = ds.aggregate(['element', 'dataset_type'], 'count')
+    monthly = (
+        scan_monthly()
+        .group_by('element', 'dataset_type')
+        .agg(pl.col('value').count().alias('count'))
+        .sort('element', 'dataset_type')
+        .collect()
+    )
+    return rollups, monthly
+
+def test_removed_archive_drops_its_rollups(raw_data_dir):
+    process_elements(raw_data_dir)
+    os.remove(archive_path(raw_data_dir, 'tavg', 'tob'))
+    process_elements(raw_data_dir)
+
+    assert not os.path.exists(partition_path('tavg', 'tob'))
+    for kind in ushcn_rollups.ROLLUP_KEYS:
+        assert not os.path.exists(ushcn_rollups.rollup_path(kind, 'tavg', 'tob'))
+    rollups, monthly = row_counts(UshcnDataset(MONTHLY_DATA_DIR))
+    assert ('tavg', 'tob') not in set(rollups.select('element', 'dataset_type').iter_rows())
+    assert rollups.equals(monthly, null_equal=True)
+
+def test_removed_archive_is_reported(raw_data_dir, capsys):
+    process_elements(raw_data_dir)
+    os.remove(archive_path(raw_data_dir, 'tavg', 'tob'))
+    capsys.readouterr()
+    process_elements(raw_data_dir)
+
+    out = capsys.readouterr().out
+    assert f'Removed 1 partitions from {MONTHLY_DATA_DIR}/' in out
+    assert 'is up to date' not in out
+
+    process_elements(raw_data_dir)
+    assert f'No archives changed; {MONTHLY_DATA_DIR}/ is up to date' in capsys.readouterr().out
+
+# An --extract run after an archive-based one, with the tavg/tob archive gone in between:
+# the partition the earlier run wrote for it must not be mixed in with the extracted data
+@pytest.mark.parametrize('batch_rows', [None, 100])
+def test_extract_drops_partitions_it_did_not_write(raw_data_dir, batch_rows):
+    process_elements(raw_data_dir)
+    os.remove(archive_path(raw_data_dir, 'tavg', 'tob'))
+    process_elements(raw_data_dir, extract=True, batch_rows=batch_rows)
+
+    assert not os.path.exists(partition_path('tavg', 'tob'))
+    assert os.path.exists(partition_path('tmax', 'tob'))
+    rollups, monthly = row_counts(UshcnDataset(MONTHLY_DATA_DIR))
+    assert ('tavg', 'tob') not in set(monthly.select('element', 'dataset_type').iter_rows())
+    assert rollups.equals(monthly, null_equal=True)
+
+# With batch_rows, the adjustments, rollups and row hashes are built a few stations at a
+# time; they should hold the same rows, in the same order, as when built whole
+def test_batched_stages_match_whole(raw_data_dir):
+    outputs = []
+    for batch_rows in [None, 100]:
+        process_elements(raw_data_dir, full=True, batch_rows=batch_rows)
+        outputs.append({
+            'adjustments': pl.read_parquet(ushcn_adjustments.adjustments_path('tmax')),
+            'station_annual': pl.read_parquet(ushcn_rollups.rollup_path('station_annual', 'tmax', 'raw')),
+            'monthly': pl.read_parquet(ushcn_rollups.rollup_path('monthly', 'tmax', 'raw')),
+            'hashes': pl.read_parquet(ushcn_row_hashes.hashes_path(ushcn_row_hashes.snapshot_name(raw_data_dir),
+                                                                   'tmax', 'raw')),
+        })
+    whole, batched = outputs
+
+    assert whole['adjustments'].equals(batched['adjustments'], null_equal=True)
+    assert whole['hashes'].equals(batched['hashes'])
+    # Rollup sums are added up in another order (streamed partitions keep the file's row
+    # order, and the monthly rollup is merged from the batches')
+    for kind in ushcn_rollups.ROLLUP_KEYS:
+        assert whole[kind].drop('sum').equals(batched[kind].drop('sum'), null_equal=True)
+        assert whole[kind]['sum'].to_numpy() == pytest.approx(batched[kind]['sum'].to_numpy(), abs=1e-9)
@@ -0,0 +1,101 @@
+import io
+import os
+import polars as pl
+import pytest
+import synthetic_data
+from ushcn_to_polars import MONTHLY_SCHEMA, parse_element_archive, parse_element_data, scan_monthly, write_partition
+
+# Configuration
+N_STATIONS = 6
+YEARS = (2000, 2004)
+KEYS = ['element', 'dataset_type', 'coop_id', 'year', 'month']
+
+# The byte-matrix parser (parse_element_bytes) against the row-by-row parser it replaced,
+# on small synthetic data files, and the compact schema round-tripping through
+# scan_monthly. Every test runs in its own working directory.
+
+# The original parser, line by line and month by month (kept here as the reference)
+def row_parse_element_data(file_path, element, dataset_type):
+    data = []
+    with open(file_path, 'r') as f:
+        for line in f:
+            coop_id = line[5:11].strip()
+            year = int(line[12:16].strip())
+            for month in range(1, 13):
+                start = 16 + (month - 1) * 9
+                value = int(line[start:start+6].strip())
+                data.append({
+                    'coop_id': coop_id,
+                    'year': year,
+                    'month': month,
+                    'element': element,
+                    'dataset_type': dataset_type,
+                    'value': value if value != -9999 else None,
+                    'dmflag': line[start+6:start+7].strip() or None,
+                    'qcflag': line[start+7:start+8].strip() or None,
+                    'dsflag': line[start+8:start+9].strip() or None
+                })
+
+    df = pl.DataFrame(data, schema=MONTHLY_SCHEMA)
+
+    # Convert values: temperature (hundredths of °C to °C), precipitation (tenths of mm to mm)
+    if element in ['tmax', 'tmin', 'tavg']:
+        df = df.with_columns(pl.col('value') / 100.0)
+    else:  # prcp
+        df = df.with_columns(pl.col('value') / 10.0)
+
+    return df
+
+# Function to write the data files of one element/dataset type into one file, with the
+# line endings given, and without the final newline if asked
+def write_data_file(file_path, element, dataset_type, line_end=b'\n', final_newline=True):
+    coop_ids = synthetic_data.station_coop_ids(N_STATIONS)
+    data = b''.join(block for _, block in synthetic_data.ushcn_element_files(coop_ids, element, dataset_type, YEARS))
+    data = data.replace(b'\n', line_end)
+    if not final_newline:
+        data = data[:-len(line_end)]
+    with open(file_path, 'wb') as f:
+        f.write(data)
+    return file_path
+
+# Function to get the parquet bytes of a frame
+def parquet_bytes(df):
+    buffer = io.BytesIO()
+    df.write_parquet(buffer)
+    return buffer.getvalue()
+
+@pytest.mark.parametrize('element, dataset_type', [('tmax', 'raw'), ('tavg', 'FLs.52j'), ('prcp', 'raw')])
+def test_matches_row_parser(tmp_path, element, dataset_type):
+    file_path = write_data_file(tmp_path / 'data', element, dataset_type)
+    expected = row_parse_element_data(file_path, element, dataset_type)
+    df = parse_element_data(file_path, element, dataset_type)
+
+    assert expected.height == N_STATIONS * (YEARS[1] - YEARS[0] + 1) * 12
+    assert df.schema == expected.schema
+    assert df.equals(expected, null_equal=True)
+    assert parquet_bytes(df) == parquet_bytes(expected)
+
+@pytest.mark.parametrize('line_end, final_newline', [(b'\r\n', True), (b'\n', False)], ids=['crlf', 'no-final-newline'])
+def test_line_endings_match_row_parser(tmp_path, line_end, final_newline):
+    file_path = write_data_file(tmp_path / 'data', 'tmin', 'tob', line_end, final_newline)
+    expected = row_parse_element_data(file_path, 'tmin', 'tob')
+    assert parse_element_data(file_path, 'tmin', 'tob').equals(expected, null_equal=True)
+
+# Both ways round: a compact partition scanned in the full schema, and a full partition
+# scanned in the compact schema, give what the other one stores
+def test_compact_round_trip(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    raw_data_dir = os.path.join('source-data', 'raw', '20250301')
+    synthetic_data.write_ushcn_snapshot(raw_data_dir, N_STATIONS, YEARS)
+    for compact, data_dir in [(False, 'monthly-full'), (True, 'monthly-compact')]:
+        for element, dataset_type in [('tmax', 'raw'), ('prcp', 'FLs.52j')]:
+            archive = os.path.join(raw_data_dir, f'ushcn.{element}.latest.{dataset_type}.tar.gz')
+            df, _ = parse_element_archive(archive, element, dataset_type, compact)
+            write_partition(df, element, dataset_type, data_dir)
+
+    for compact in [False, True]:
+        full = scan_monthly('monthly-full', compact).sort(KEYS).collect()
+        stored_compact = scan_monthly('monthly-compact', compact).sort(KEYS).collect()
+        assert full.height == 2 * N_STATIONS * (YEARS[1] - YEARS[0] + 1) * 12
+        assert full.schema == stored_compact.schema
+        assert full.equals(stored_compact, null_equal=True)
@@ -0,0 +1,171 @@
+import os
+import polars as pl
+import pytest
+import synthetic_data
+import ushcn_revisions
+import ushcn_row_hashes
+from ushcn_to_polars import archive_path, iter_tar_members, parse_element_archive, partition_path, scan_monthly, write_partition
+
+# Configuration
+ELEMENT = 'tmax'
+DATASET_TYPE = 'raw'
+N_STATIONS = 12
+YEARS = (2000, 2004)
+
+# Revision tracking end to end on small synthetic snapshots: archives are edited byte by
+# byte, ingested as the monthly partition would be, hashed, and compared with
+# ushcn_revisions. Every test runs in its own working directory, as the manifest and the
+# data directories are relative to it.
+
+# Fixture: a synthetic snapshot directory (the working directory is the test's tmp_path)
+@pytest.fixture
+def old_raw(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    raw_data_dir = os.path.join('source-data', 'raw', '20250301')
+    synthetic_data.write_ushcn_snapshot(raw_data_dir, N_STATIONS, YEARS)
+    return raw_data_dir
+
+# Function to read the station files of the test element/dataset type out of a snapshot
+def read_members(raw_data_dir):
+    return list(iter_tar_members(archive_path(raw_data_dir, ELEMENT, DATASET_TYPE)))
+
+# Function to write station files as a new snapshot's archive
+def write_snapshot(raw_data_dir, members):
+    os.makedirs(raw_data_dir, exist_ok=True)
+    synthetic_data._write_archive(archive_path(raw_data_dir, ELEMENT, DATASET_TYPE), members)
+    return raw_data_dir
+
+# Function to get the coop id of a station file
+def member_coop_id(name):
+    return os.path.basename(name)[5:11]
+
+# Function to apply edit(line) to the line of one station-year (edit returns the new line,
+# or None to drop it)
+def edit_line(members, coop_id, year, edit):
+    edited = []
+    for name, data in members:
+        if member_coop_id(name) == coop_id:
+            lines = []
+            for line in data.splitlines(keepends=True):
+                if int(line[12:16]) == year:
+                    line = edit(line)
+                if line is not None:
+                    lines.append(line)
+            data = b''.join(lines)
+        edited.append((name, data))
+    return edited
+
+# Function to get the start of one month's 9 byte field (6 value, then dm, qc and ds flags)
+def field_start(month):
+    return 16 + 9 * (month - 1)
+
+# Function to find a station-year and month that has a value
+def first_reported(members):
+    name, data = members[0]
+    line = data.splitlines()[0]
+    for month in range(1, 13):
+        if int(line[field_start(month):field_start(month) + 6]) != -9999:
+            return member_coop_id(name), int(line[12:16]), month
+    raise AssertionError('no reported month in the first line')
+
+# Function to parse a snapshot's archive into a monthly partition (stored compact or not)
+# and write its row hashes
+def ingest(raw_data_dir, compact=False):
+    snapshot = ushcn_row_hashes.snapshot_name(raw_data_dir)
+    data_dir = f'monthly-{snapshot}-{"compact" if compact else "full"}'
+    df, _ = parse_element_archive(archive_path(raw_data_dir, ELEMENT, DATASET_TYPE), ELEMENT, DATASET_TYPE, compact)
+    write_partition(df, ELEMENT, DATASET_TYPE, data_dir)
+    paths = {(ELEMENT, DATASET_TYPE): partition_path(ELEMENT, DATASET_TYPE, data_dir)}
+    ushcn_row_hashes.update_hashes(scan_monthly(data_dir, compact=True), paths, snapshot)
+    return snapshot, data_dir
+
+# Function to get the diff between two ingested snapshots as (coop_id, year, change) rows
+def changes(old, new):
+    diff = ushcn_revisions.diff_snapshots(old, new)
+    return diff, sorted(diff.select('coop_id', 'year', 'change').iter_rows())
+
+def test_compact_and_full_partitions_hash_the_same(old_raw):
+    hashes = []
+    for compact in [False, True]:
+        _, data_dir = ingest(old_raw, compact)
+        # Scanned as stored and converted to the other schema
+        for scan_compact in [False, True]:
+            hashes.append(
+                ushcn_row_hashes.station_year_hashes(scan_monthly(data_dir, compact=scan_compact), ELEMENT, DATASET_TYPE)
+                .sort(['coop_id', 'year'])
+            )
+    assert hashes[0].height == N_STATIONS * (YEARS[1] - YEARS[0] + 1)
+    for other in hashes[1:]:
+        assert hashes[0].equals(other)
+    assert hashes[0]['row_hash'].n_unique() == hashes[0].height
+
+def test_same_contents_give_no_changes(old_raw):
+    old, _ = ingest(old_raw)
+    new, _ = ingest(write_snapshot(os.path.join('source-data', 'raw', '20250419'), read_members(old_raw)), compact=True)
+    diff, _ = changes(old, new)
+    assert diff.is_empty()
+
+# Edits of one month's field: the value by one hundredth of a degree, the value to
+# missing, and each flag
+def _bump_value(field):
+    return b'%6d' % (int(field[:6]) + 1) + field[6:]
+
+def _drop_value(field):
+    return b'%6d' % -9999 + field[6:]
+
+def _flip_flag(position):
+    def edit(field):
+        flag = b'Z' if field[position:position + 1] == b' ' else b' '
+        return field[:position] + flag + field[position + 1:]
+    return edit
+
+@pytest.mark.parametrize('edit', [_bump_value, _drop_value, _flip_flag(6), _flip_flag(7), _flip_flag(8)],
+                         ids=['value', 'missing', 'dmflag', 'qcflag', 'dsflag'])
+def test_single_value_or_flag_change_is_changed(old_raw, edit):
+    members = read_members(old_raw)
+    coop_id, year, month = first_reported(members)
+    start = field_start(month)
+    new_raw = write_snapshot(
+        os.path.join('source-data', 'raw', '20250419'),
+        edit_line(members, coop_id, year, lambda line: line[:start] + edit(line[start:start + 9]) + line[start + 9:]),
+    )
+    old, _ = ingest(old_raw)
+    new, _ = ingest(new_raw)
+
+    diff, rows = changes(old, new)
+    assert rows == [(coop_id, year, 'changed')]
+    changed = ushcn_revisions.changed_rows(diff, old_raw, new_raw)
+    assert changed.select('coop_id', 'year', 'month').rows() == [(coop_id, year, month)]
+
+def test_added_and_removed_station_years(old_raw):
+    members = read_members(old_raw)
+    first_id, second_id = member_coop_id(members[0][0]), member_coop_id(members[1][0])
+    gone_id = member_coop_id(members[2][0])
+    # The old snapshot lacks one station-year, the new one another and a whole station
+    old_raw = write_snapshot(os.path.join('source-data', 'raw', '20250302'),
+                             edit_line(members, first_id, YEARS[0], lambda line: None))
+    new_members = [(name, data) for name, data in members if member_coop_id(name) != gone_id]
+    new_raw = write_snapshot(os.path.join('source-data', 'raw', '20250419'),
+                             edit_line(new_members, second_id, YEARS[1], lambda line: None))
+    old, _ = ingest(old_raw)
+    new, _ = ingest(new_raw)
+
+    diff, rows = changes(old, new)
+    expected = [(first_id, YEARS[0], 'added'), (second_id, YEARS[1], 'removed')]
+    expected += [(gone_id, year, 'removed') for year in range(YEARS[0], YEARS[1] + 1)]
+    assert rows == sorted(expected)
+    added = diff.filter(pl.col('change') == 'added')
+    assert added['n_values_old'].is_null().all() and (added['n_values_new'] > 0).all()
+    removed = diff.filter(pl.col('change') == 'removed')
+    assert removed['n_values_new'].is_null().all() and (removed['n_values_old'] > 0).all()
+
+def test_removed_partition_drops_only_this_snapshots_hashes(old_raw):
+    old, _ = ingest(old_raw)
+    new, data_dir = ingest(write_snapshot(os.path.join('source-data', 'raw', '20250419'), read_members(old_raw)))
+    # Re-hash the new snapshot after its partition is gone (nothing is left to scan)
+    paths = {(ELEMENT, DATASET_TYPE): partition_path(ELEMENT, DATASET_TYPE, data_dir)}
+    os.remove(paths[ELEMENT, DATASET_TYPE])
+    ushcn_row_hashes.update_hashes(None, paths, new)
+
+    assert not os.path.exists(ushcn_row_hashes.hashes_path(new, ELEMENT, DATASET_TYPE))
+    assert os.path.exists(ushcn_row_hashes.hashes_path(old, ELEMENT, DATASET_TYPE))
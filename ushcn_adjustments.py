@@ -0,0 +1,130 @@
+import os
+import polars as pl
+import pyarrow.parquet as pq
+import ushcn_batches
+import ushcn_manifest
+
+# Configuration
+ADJUSTMENTS_DIR = 'ushcn_adjustments'  # element=<element>/part-0.parquet
+ROW_GROUP_SIZE = 50_000
+KEYS = ['coop_id', 'year', 'month']
+SOURCES = {'final': 'FLs.52j', 'raw': 'raw', 'tob': 'tob'}  # column suffix: dataset type
+
+# Function to get the adjustments file for an element
+def adjustments_path(element, data_dir=ADJUSTMENTS_DIR):
+    return os.path.join(data_dir, f'element={element}', 'part-0.parquet')
+
+# Function to build the adjustments table for one element from the monthly data (a
+# LazyFrame in the full schema): final, raw and tob values and flags side by side for
+# every station/year/month, the deltas between them, and the flag transitions
+def build_adjustments(monthly, element):
+    sides = [
+        monthly
+        .filter(pl.col('element') == element, pl.col('dataset_type') == dataset_type)
+        .select(
+            KEYS
+            + [pl.col(column).alias(f'{column}_{suffix}') for column in ['value', 'dmflag', 'qcflag']]
+        )
+        for suffix, dataset_type in SOURCES.items()
+    ]
+    joined = sides[0]
+    for side in sides[1:]:
+        joined = joined.join(side, on=KEYS, how='full', coalesce=True)
+
+    return (
+        joined
+        .with_columns(
+            (pl.col('value_final') - pl.col('value_raw')).alias('adjustment'),
+            (pl.col('value_tob') - pl.col('value_raw')).alias('tob_adjustment'),
+            (pl.col('value_final') - pl.col('value_tob')).alias('pha_adjustment'),
+            (pl.col('dmflag_final') == 'E').fill_null(False).alias('estimated'),
+            (pl.col('value_final').is_not_null() & pl.col('value_raw').is_null()).alias('infilled'),
+            (pl.col('value_final').is_null() & pl.col('value_raw').is_not_null()).alias('removed'),
+            pl.col('dmflag_final').ne_missing(pl.col('dmflag_raw')).alias('dmflag_changed'),
+            pl.col('qcflag_final').ne_missing(pl.col('qcflag_raw')).alias('qcflag_changed'),
+        )
+        .sort(KEYS)
+        .collect()
+    )
+
+# Function to write the adjustments for one element, sorted by station/year/month so the
+# row group statistics act as an index on those columns
+def write_adjustments(adjustments_df, element, data_dir=ADJUSTMENTS_DIR):
+    path = adjustments_path(element, data_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    adjustments_df.write_parquet(path, row_group_size=ROW_GROUP_SIZE, statistics=True)
+    return path
+
+# Function to build and write the adjustments for one element a range of stations at a
+# time (about batch_rows monthly rows per dataset type, see ushcn_batches), so memory
+# depends on batch_rows rather than on the size of the element. Same rows and order as
+# write_adjustments. Returns (path, rows).
+def stream_adjustments(monthly, element, batch_rows, data_dir=ADJUSTMENTS_DIR):
+    path = adjustments_path(element, data_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    element_monthly = monthly.filter(pl.col('element') == element, pl.col('dataset_type').is_in(list(SOURCES.values())))
+    schema = build_adjustments(monthly.clear(), element).to_arrow().schema
+    n_rows = 0
+    tmp_path = path + '.tmp'
+    with pq.ParquetWriter(tmp_path, schema) as writer:
+        for station_range in ushcn_batches.station_ranges(element_monthly, batch_rows):
+            batch_df = build_adjustments(ushcn_batches.read_range(element_monthly, station_range), element)
+            writer.write_table(batch_df.to_arrow(), row_group_size=ROW_GROUP_SIZE)
+            n_rows += batch_df.height
+    os.replace(tmp_path, path)
+    return path, n_rows
+
+# Function to lazily scan the adjustments dataset
+def scan_adjustments(data_dir=ADJUSTMENTS_DIR):
+    return pl.scan_parquet(
+        os.path.join(data_dir, '**', '*.parquet'),
+        hive_partitioning=True,
+        hive_schema={'element': pl.Utf8},
+    )
+
+# Function to rebuild the adjustments of the elements whose source partitions changed
+# since the last build (by content hash, recorded in the manifest). partition_paths maps
+# (element, dataset_type) to the partition file. With batch_rows, each element is built
+# in station batches (see stream_adjustments). Returns the number of elements rebuilt.
+def update_adjustments(monthly, partition_paths, elements, full=False, data_dir=ADJUSTMENTS_DIR, batch_rows=None):
+    manifest = ushcn_manifest.load_manifest()
+    previous = {} if full else manifest.get('adjustments', {})
+    entries = {}
+    n_built = 0
+    for element in elements:
+        sources = {
+            dataset_type: ushcn_manifest.file_sha256(partition_paths[element, dataset_type])
+            for dataset_type in SOURCES.values()
+            if os.path.exists(partition_paths[element, dataset_type])
+        }
+        if not sources:
+            # No source partitions left: drop the element's old adjustments along with its
+            # manifest entry, so scan_adjustments does not keep returning them
+            stale = manifest.get('adjustments', {}).get(element, {}).get('path')
+            for path in {stale, adjustments_path(element, data_dir)} - {None}:
+                if os.path.exists(path):
+                    os.remove(path)
+                    print(f'Removed {element} adjustments {path} (no source partitions)')
+            continue
+        entry = previous.get(element)
+        if (
+            entry is not None
+            and entry['sources'] == sources
+            and os.path.exists(entry['path'])
+            and ushcn_manifest.file_sha256(entry['path']) == entry['sha256']
+        ):
+            entries[element] = entry
+            continue
+
+        if batch_rows:
+            path, n_rows = stream_adjustments(monthly, element, batch_rows, data_dir)
+        else:
+            adjustments_df = build_adjustments(monthly, element)
+            path, n_rows = write_adjustments(adjustments_df, element, data_dir), adjustments_df.height
+        print(f'Saved {element} adjustments to {path} ({n_rows} rows)')
+        entries[element] = {'path': path, 'sha256': ushcn_manifest.file_sha256(path), 'sources': sources}
+        n_built += 1
+
+    manifest['adjustments'] = entries
+    ushcn_manifest.save_manifest(manifest)
+    return n_built
@@ -0,0 +1,39 @@
+import polars as pl
+
+# Station batches for the stages built from whole partitions (the adjustments, rollups
+# and row hashes), so that with --batch-rows they run in bounded memory too: the stations
+# are cut, in coop_id order, into ranges of about batch_rows monthly rows, and each range
+# is read, built and written on its own. Outputs sorted by station stay sorted, as the
+# ranges come in order.
+
+# Function to split the stations of monthly (a LazyFrame, already filtered to what is
+# being built) into ranges of about batch_rows rows, in coop_id order. Returns a list of
+# inclusive (first, last) coop_ids; a station with more than batch_rows rows is a range
+# of its own.
+def station_ranges(monthly, batch_rows):
+    counts = (
+        monthly
+        .group_by('coop_id')
+        .agg(pl.len().alias('rows'))
+        .sort('coop_id')
+        .collect(engine='streaming')
+    )
+    ranges = []
+    first, n_rows = None, 0
+    for coop_id, rows in counts.iter_rows():
+        if first is None:
+            first = coop_id
+        n_rows += rows
+        if n_rows >= batch_rows:
+            ranges.append((first, coop_id))
+            first, n_rows = None, 0
+    if first is not None:
+        ranges.append((first, coop_id))
+    return ranges
+
+# Function to read one range of stations out of monthly, on the streaming engine (the scan
+# is filtered as it is read, so only the range is held in memory). Returns a LazyFrame
+# over the rows read, for the builders.
+def read_range(monthly, station_range):
+    first, last = station_range
+    return monthly.filter(pl.col('coop_id').is_between(pl.lit(first), pl.lit(last))).collect(engine='streaming').lazy()
@@ -0,0 +1,103 @@
+import json
+import os
+import numpy as np
+import polars as pl
+from ushcn_to_polars import DATASET_TYPES, ELEMENTS, MONTHLY_DATA_DIR, scan_monthly, value_scale
+
+# Configuration
+CUBE_DIR = 'ushcn_cube'  # values.npy, flags.npy and index.json
+MISSING = -9999  # Same missing value as the source files
+FLAGS = ['dmflag', 'qcflag', 'dsflag']  # Order of the last axis of the flag plane
+
+# Dense cube of the monthly data, indexed [dataset_type, element, station, year, month].
+# values holds native integer units (MISSING where there is no value); flags holds the
+# ASCII code of each flag in FLAGS order (0 = blank). Both are memory-mapped, so any
+# slice is a zero-copy view and opening the cube costs nothing but the index.
+class UshcnCube:
+    def __init__(self, cube_dir=CUBE_DIR):
+        with open(os.path.join(cube_dir, 'index.json')) as f:
+            index = json.load(f)
+        self.dataset_types = index['dataset_types']
+        self.elements = index['elements']
+        self.coop_ids = index['coop_ids']
+        self.years = list(range(index['first_year'], index['first_year'] + index['n_years']))
+        self.values = np.load(os.path.join(cube_dir, 'values.npy'), mmap_mode='r')
+        self.flags = np.load(os.path.join(cube_dir, 'flags.npy'), mmap_mode='r')
+        self._station_index = {coop_id: i for i, coop_id in enumerate(self.coop_ids)}
+
+    # Array positions for each axis
+    def dataset_type_index(self, dataset_type):
+        return self.dataset_types.index(dataset_type)
+
+    def element_index(self, element):
+        return self.elements.index(element)
+
+    def station_index(self, coop_id):
+        return self._station_index[coop_id]
+
+    def year_index(self, year):
+        return year - self.years[0]
+
+    # Function to get a [station, year, month] view for one dataset type and element
+    # (or [station, year] when a month is given)
+    def select(self, dataset_type, element, month=None):
+        view = self.values[self.dataset_type_index(dataset_type), self.element_index(element)]
+        return view if month is None else view[:, :, month - 1]
+
+    # Function to get the matching flag view ([..., 3], FLAGS order)
+    def select_flags(self, dataset_type, element, month=None):
+        view = self.flags[self.dataset_type_index(dataset_type), self.element_index(element)]
+        return view if month is None else view[:, :, month - 1]
+
+    # Function to convert a slice of native values to °C/mm, with NaN for missing values
+    def to_float(self, values, element):
+        return np.where(values == MISSING, np.nan, values / value_scale(element))
+
+# Function to write the cube from the monthly dataset, one partition at a time
+# (so peak memory is one partition plus whatever the OS keeps of the memory maps)
+def export_cube(data_dir=MONTHLY_DATA_DIR, cube_dir=CUBE_DIR):
+    lf = scan_monthly(data_dir, compact=True)
+    coop_ids = lf.select(pl.col('coop_id').unique().sort()).collect()['coop_id'].to_numpy()
+    years = lf.select(pl.col('year').min().alias('first'), pl.col('year').max().alias('last')).collect()
+    first_year, last_year = int(years['first'][0]), int(years['last'][0])
+    shape = (len(DATASET_TYPES), len(ELEMENTS), len(coop_ids), last_year - first_year + 1, 12)
+
+    os.makedirs(cube_dir, exist_ok=True)
+    values = np.lib.format.open_memmap(os.path.join(cube_dir, 'values.npy'), mode='w+', dtype=np.int32, shape=shape)
+    flags = np.lib.format.open_memmap(os.path.join(cube_dir, 'flags.npy'), mode='w+', dtype=np.uint8, shape=shape + (3,))
+    values[:] = MISSING
+    flags[:] = 0
+
+    for d, dataset_type in enumerate(DATASET_TYPES):
+        for e, element in enumerate(ELEMENTS):
+            df = lf.filter(pl.col('element') == element, pl.col('dataset_type') == dataset_type).collect()
+            if df.is_empty():
+                continue
+            print(f'Adding {element}:{dataset_type} to the cube ({df.height} rows)...')
+            s = np.searchsorted(coop_ids, df['coop_id'].to_numpy())
+            y = df['year'].to_numpy().astype(np.intp) - first_year
+            m = df['month'].to_numpy().astype(np.intp) - 1
+            values[d, e, s, y, m] = df['value'].fill_null(MISSING).to_numpy()
+            for i, flag in enumerate(FLAGS):
+                # FLAG_ENUM categories are the printable characters from '!' (33) upwards
+                codes = df[flag].to_physical().cast(pl.Int32) + 33
+                flags[d, e, s, y, m, i] = codes.fill_null(0).cast(pl.UInt8).to_numpy()
+
+    values.flush()
+    flags.flush()
+    with open(os.path.join(cube_dir, 'index.json'), 'w') as f:
+        json.dump({
+            'dataset_types': DATASET_TYPES,
+            'elements': ELEMENTS,
+            'coop_ids': [f'{coop_id:06d}' for coop_id in coop_ids],
+            'first_year': first_year,
+            'n_years': shape[3],
+        }, f)
+    print(f'Saved cube {shape} to {cube_dir}/')
+
+# Function to open the cube
+def load_cube(cube_dir=CUBE_DIR):
+    return UshcnCube(cube_dir)
+
+if __name__ == '__main__':
+    export_cube()
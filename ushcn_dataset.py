@@ -0,0 +1,127 @@
+import polars as pl
+from ushcn_adjustments import ADJUSTMENTS_DIR, scan_adjustments
+from ushcn_rollups import ROLLUPS_DIR, rollup_aggregate
+from ushcn_to_polars import MONTHLY_DATA_DIR, scan_monthly
+from session_cache import CACHE_DIR, SessionCache
+
+# Configuration
+STATIONS_FILE = 'ushcn_stations.parquet'
+BLANK = ''  # Stands for "no flag" in the flag filters
+
+# Function to turn a single value or a list of values into a list
+def _as_list(values):
+    return [values] if isinstance(values, (str, int)) else list(values)
+
+# Function to build the filter for a flag column: values is a flag or list of flags to keep,
+# where BLANK keeps the rows without a flag
+def _flag_filter(column, values):
+    values = _as_list(values)
+    present = [value for value in values if value != BLANK]
+    keep = pl.col(column).is_in(present)
+    if BLANK in values:
+        keep = keep | pl.col(column).is_null()
+    return keep
+
+# Lazy query API over the monthly dataset. Every helper returns a LazyFrame; the filters
+# are pushed into the parquet scan, so only the matching partitions, row groups and
+# columns are read. collect() runs a query on the streaming engine.
+#
+#   ds = UshcnDataset()
+#   july = ds.query(element='tmax', dataset_type='FLs.52j', years=(1895, None), months=7)
+#   ds.collect(july.group_by('year').agg(pl.col('value').mean()))
+class UshcnDataset:
+    def __init__(self, data_dir=MONTHLY_DATA_DIR, stations_file=STATIONS_FILE,
+                 adjustments_dir=ADJUSTMENTS_DIR, rollups_dir=ROLLUPS_DIR, compact=False, cache_dir=CACHE_DIR):
+        self.data_dir = data_dir
+        self.stations_file = stations_file
+        self.adjustments_dir = adjustments_dir
+        self.rollups_dir = rollups_dir
+        self.cache_dir = cache_dir
+        self.compact = compact
+
+    # Function to scan the whole monthly table
+    def scan(self):
+        return scan_monthly(self.data_dir, self.compact)
+
+    # Function to scan the station metadata (coop_id matches the monthly table's type)
+    def stations(self):
+        stations = pl.scan_parquet(self.stations_file)
+        if self.compact:
+            stations = stations.with_columns(pl.col('coop_id').cast(pl.UInt32))
+        return stations
+
+    # Function to filter the monthly table. Every argument is optional:
+    #   element, dataset_type, months, stations: a value or a list of values
+    #   years: (first, last), inclusive; either end may be None
+    #   dmflag, qcflag, dsflag: a flag or list of flags to keep (BLANK = no flag)
+    #   has_value: drop the missing values
+    #   columns: the columns to keep
+    #   with_stations: join the station metadata (latitude, longitude, state, ...)
+    def query(self, element=None, dataset_type=None, years=None, months=None, stations=None,
+              dmflag=None, qcflag=None, dsflag=None, has_value=False, columns=None, with_stations=False):
+        filters = []
+        if element is not None:
+            filters.append(pl.col('element').is_in(_as_list(element)))
+        if dataset_type is not None:
+            filters.append(pl.col('dataset_type').is_in(_as_list(dataset_type)))
+        if years is not None:
+            first, last = years
+            if first is not None:
+                filters.append(pl.col('year') >= first)
+            if last is not None:
+                filters.append(pl.col('year') <= last)
+        if months is not None:
+            filters.append(pl.col('month').is_in(_as_list(months)))
+        if stations is not None:
+            coop_ids = _as_list(stations)
+            if self.compact:
+                coop_ids = [int(coop_id) for coop_id in coop_ids]
+            filters.append(pl.col('coop_id').is_in(coop_ids))
+        for column, values in [('dmflag', dmflag), ('qcflag', qcflag), ('dsflag', dsflag)]:
+            if values is not None:
+                filters.append(_flag_filter(column, values))
+        if has_value:
+            filters.append(pl.col('value').is_not_null())
+
+        lf = self.scan()
+        if filters:
+            lf = lf.filter(*filters)
+        if with_stations:
+            lf = self.with_stations(lf)
+        if columns is not None:
+            lf = lf.select(columns)
+        return lf
+
+    # Function to join the station metadata onto a query (lazily)
+    def with_stations(self, lf):
+        return lf.join(self.stations().drop(['country_code', 'network_code']), on='coop_id', how='left')
+
+    # Function to scan the raw-vs-adjusted table, optionally for some elements only
+    def adjustments(self, element=None):
+        lf = scan_adjustments(self.adjustments_dir)
+        if element is not None:
+            lf = lf.filter(pl.col('element').is_in(_as_list(element)))
+        return lf
+
+    # Function to get grouped summary statistics (mean, sum, count, min, max, n_estimated,
+    # n_flagged, n_stations) by any of year, month, element and dataset_type, answered from
+    # the pre-aggregated rollups where possible. Returns a DataFrame; values are in °C/mm
+    # even for a compact dataset, as the rollups are, so the fallback to the monthly data
+    # reads the full schema.
+    #
+    #   ds.aggregate('year', 'mean', element='tmax', dataset_type='raw', months=7)
+    def aggregate(self, by, aggregates=('mean', 'count'), element=None, dataset_type=None, years=None, months=None):
+        return rollup_aggregate(by, aggregates, element, dataset_type, years, months,
+                                monthly=scan_monthly(self.data_dir, compact=False), data_dir=self.rollups_dir)
+
+    # Function to run a query on the streaming engine
+    def collect(self, lf):
+        return lf.collect(engine='streaming')
+
+    # Function to get a frame from the session cache (see session_cache.py), building it
+    # with build() the first time for this version of the monthly data and station files.
+    # Later calls, in any kernel, memory-map the stored frame.
+    #
+    #   df = ds.cached('tmax', lambda: ds.collect(ds.query(element='tmax')))
+    def cached(self, name, build):
+        return SessionCache([self.data_dir, self.stations_file], self.cache_dir).frame(name, build)
@@ -0,0 +1,56 @@
+import hashlib
+import json
+import os
+
+# Configuration
+MANIFEST_FILE = 'ushcn_manifest.json'  # Content hashes of the source archives and output partitions
+MANIFEST_VERSION = 2
+
+# Function to hash a file's contents without reading it into memory all at once
+def file_sha256(file_path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Function to make a manifest that knows about nothing (forces a full rebuild)
+def empty_manifest():
+    return {'version': MANIFEST_VERSION, 'snapshot': None, 'partitions': {}, 'adjustments': {}, 'rollups': {}, 'hashes': {}}
+
+# Function to fingerprint a set of source files by their contents (order does not matter)
+def fingerprint(*file_paths):
+    digest = hashlib.sha256()
+    for file_hash in sorted(file_sha256(file_path) for file_path in file_paths):
+        digest.update(file_hash.encode())
+    return digest.hexdigest()
+
+# Function to load the manifest (an empty one if there is none yet, or it is from another version)
+def load_manifest(manifest_file=MANIFEST_FILE):
+    if not os.path.exists(manifest_file):
+        return empty_manifest()
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+    if manifest.get('version') != MANIFEST_VERSION:
+        return empty_manifest()
+    return manifest
+
+# Function to save the manifest (written to a temp file first, so a crash never leaves half a manifest)
+def save_manifest(manifest, manifest_file=MANIFEST_FILE):
+    tmp_file = f'{manifest_file}.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_file, manifest_file)
+
+# Function to get the key used for an element/dataset type in the manifest
+def partition_key(element, dataset_type):
+    return f'{element}.{dataset_type}'
+
+# Function to check whether a manifest entry can be reused for an archive with the given hash
+def is_current(entry, archive_sha256):
+    return (
+        entry is not None
+        and entry['archive_sha256'] == archive_sha256
+        and os.path.exists(entry['path'])
+        and file_sha256(entry['path']) == entry['sha256']
+    )
@@ -0,0 +1,156 @@
+import contextlib
+import datetime
+import json
+import os
+import resource
+import sys
+import time
+
+# Per-stage instrumentation. Library code marks its stages with
+#
+#   with ushcn_metrics.stage('parse', element=element) as record:
+#       ...
+#       record['rows_out'] = df.height
+#
+# which costs nothing unless a Metrics recorder has been started (start()). Each finished
+# stage becomes one record: its name and labels, wall and CPU seconds, the process's peak
+# RSS so far (a high-water mark: it only tells a stage's own peak when it is the highest
+# yet), any rows_in/rows_out/bytes_in/bytes_out the stage filled in, and rows per second.
+
+# Configuration
+COUNTERS = ['rows_in', 'rows_out', 'bytes_in', 'bytes_out']
+
+# Function to get the peak RSS (MB) of this process and its finished child processes
+def peak_rss_mb():
+    self_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_kb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # ru_maxrss is in bytes on macOS, kilobytes elsewhere
+    scale = 1 / (1024 * 1024) if sys.platform == 'darwin' else 1 / 1024
+    return max(self_kb, children_kb) * scale
+
+# Function to get the CPU seconds (user + system) used so far, children included
+def cpu_seconds():
+    return sum(os.times()[:4])
+
+# Recorder for the stage records of one run
+class Metrics:
+    def __init__(self, progress=False):
+        self.progress = progress
+        self.records = []
+        self.started = datetime.datetime.now(datetime.timezone.utc)
+        self._start = time.perf_counter()
+        self._cpu_start = cpu_seconds()
+
+    # Function to time one stage (a context manager yielding the record to fill in)
+    @contextlib.contextmanager
+    def stage(self, name, **labels):
+        record = dict(stage=name, **labels)
+        cpu_start = cpu_seconds()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['wall_s'] = time.perf_counter() - start
+            record['cpu_s'] = cpu_seconds() - cpu_start
+            record['peak_rss_mb'] = peak_rss_mb()
+            rows = record.get('rows_out', record.get('rows_in'))
+            if rows is not None and record['wall_s'] > 0:
+                record['rows_per_s'] = rows / record['wall_s']
+            record['pid'] = os.getpid()
+            self.records.append(record)
+            if self.progress:
+                self._print_progress(record)
+
+    # Function to add records made elsewhere (e.g. in a worker process)
+    def extend(self, records):
+        self.records.extend(records)
+        if self.progress:
+            for record in records:
+                self._print_progress(record)
+
+    # Function to show a finished stage on one, constantly rewritten, stderr line
+    def _print_progress(self, record):
+        labels = ' '.join(str(value) for key, value in record.items() if key not in _FIELDS)
+        line = f'[{time.perf_counter() - self._start:7.1f}s] {record["stage"]} {labels} {record["wall_s"]:.2f}s'
+        if 'rows_per_s' in record:
+            line += f' ({record["rows_per_s"]:,.0f} rows/s)'
+        line += f' peak {record["peak_rss_mb"]:.0f} MB'
+        sys.stderr.write('\r\033[K' + line)
+        sys.stderr.flush()
+
+    # Function to add up the records of each stage name
+    def totals(self):
+        totals = {}
+        for record in self.records:
+            total = totals.setdefault(record['stage'], {'count': 0, 'wall_s': 0.0, 'cpu_s': 0.0, 'peak_rss_mb': 0.0})
+            total['count'] += 1
+            total['wall_s'] += record['wall_s']
+            total['cpu_s'] += record['cpu_s']
+            total['peak_rss_mb'] = max(total['peak_rss_mb'], record['peak_rss_mb'])
+            for counter in COUNTERS:
+                if counter in record:
+                    total[counter] = total.get(counter, 0) + record[counter]
+        for total in totals.values():
+            rows = total.get('rows_out', total.get('rows_in'))
+            if rows is not None and total['wall_s'] > 0:
+                total['rows_per_s'] = rows / total['wall_s']
+        return totals
+
+    # Function to get the whole report as a JSON-ready dict
+    def report(self):
+        return {
+            'started': self.started.isoformat(timespec='seconds'),
+            'wall_s': time.perf_counter() - self._start,
+            'cpu_s': cpu_seconds() - self._cpu_start,
+            'peak_rss_mb': peak_rss_mb(),
+            'totals': self.totals(),
+            'stages': self.records,
+        }
+
+    # Function to write the report as JSON
+    def write(self, file_path):
+        if self.progress:
+            sys.stderr.write('\n')
+        with open(file_path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+# Record fields that are not labels
+_FIELDS = {'stage', 'wall_s', 'cpu_s', 'peak_rss_mb', 'rows_per_s', 'pid'} | set(COUNTERS)
+
+# The recorder stages are reported to (None = instrumentation off)
+_active = None
+
+# Function to start recording stages; returns the recorder
+def start(progress=False):
+    global _active
+    _active = Metrics(progress)
+    return _active
+
+# Function to stop recording; returns the recorder (or None if none was started)
+def stop():
+    global _active
+    metrics, _active = _active, None
+    return metrics
+
+# Function to get the active recorder, if any
+def active():
+    return _active
+
+# Function to time a stage on the active recorder; without one, the record is just thrown away
+def stage(name, **labels):
+    if _active is None:
+        return contextlib.nullcontext({})
+    return _active.stage(name, **labels)
+
+# Function to run function(task) in a worker process with its own recorder, returning
+# (result, records) so the parent can merge them (see instrumented_task)
+def _run_instrumented(function, task):
+    metrics = start()
+    try:
+        return function(task), metrics.records
+    finally:
+        stop()
+
+# Process pool task: (function, task) -> (result, records)
+def instrumented_task(function_and_task):
+    return _run_instrumented(*function_and_task)
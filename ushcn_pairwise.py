@@ -0,0 +1,243 @@
+import argparse
+import os
+import tempfile
+import numpy as np
+import polars as pl
+import ushcn_metrics
+from ushcn_dataset import STATIONS_FILE
+from ushcn_spatial import SpatialIndex, load_spatial_index
+from ushcn_to_polars import MONTHLY_DATA_DIR, run_tasks
+from ushcn_trends import series_matrix
+
+# Configuration
+NEIGHBORS = 10  # Neighbors compared with each station
+WINDOW = 60  # Months in each rolling window
+MIN_MONTHS = 24  # Fewest months with a difference for a window (or a segment) to count
+CHUNK_PAIRS = 2000  # Station/neighbor pairs per task
+
+# Difference series between every station and its nearest neighbors, the comparison the
+# pairwise homogenization behind FLs.52j is built on. Each station's monthly anomalies
+# (its own mean for each calendar month removed) are laid out as a dense [station, month]
+# matrix; every pair's difference series is one row of a [pair, month] block, so the rolling
+# statistics and changepoint scores are cumulative sums over whole blocks of pairs.
+# Blocks run in parallel (workers), sharing the matrix through a memory-mapped file.
+#
+#   summary, series = pairwise_differences('tavg', 'raw', k=10, series=True, workers=4)
+#
+# summary has one row per pair: overlap, correlation, mean and spread of the differences,
+# the SNHT break (the single most likely step change) and the largest step score between
+# two adjacent windows. series has one row per pair and month with a difference.
+
+# Function to read one element/dataset type as a [station, month] matrix of monthly
+# anomalies (NaN where missing). Returns (coop_ids, years, anomalies); month t of the
+# matrix is years[t // 12], calendar month t % 12 + 1.
+def station_anomaly_matrix(element, dataset_type, years=None, data_dir=MONTHLY_DATA_DIR):
+    coop_ids, year_values, values = series_matrix(element, dataset_type, years, data_dir=data_dir)
+    valid = ~np.isnan(values)
+    counts = valid.sum(axis=2, keepdims=True)
+    means = np.where(valid, values, 0.0).sum(axis=2, keepdims=True) / np.maximum(counts, 1)
+    anomalies = (values - means).transpose(0, 2, 1).reshape(len(coop_ids), -1)
+    return np.array([f'{coop_id:06d}' for coop_id in coop_ids]), year_values, np.ascontiguousarray(anomalies)
+
+# Function to pair every station in coop_ids with its k nearest neighbors among coop_ids.
+# Returns (targets, neighbors, ranks, distances_km); targets and neighbors are positions in coop_ids.
+def neighbor_pairs(coop_ids, k=NEIGHBORS, stations_file=STATIONS_FILE):
+    index = load_spatial_index(stations_file)
+    located = np.isin(index.coop_ids, coop_ids)
+    if not located.all():
+        # Neighbors must have data too: index just the stations that do
+        index = SpatialIndex(index.coop_ids[located], index.latitude[located], index.longitude[located])
+    indices, distances = index.knn(k)
+    found = indices >= 0
+    rows, ranks = np.nonzero(found)
+    positions = np.searchsorted(coop_ids, index.coop_ids)
+    return positions[rows], positions[indices[found]], ranks + 1, distances[found]
+
+# Function to get running sums along the month axis, with a leading zero column, of the
+# count, sum and sum of squares of the non-NaN values
+def _cumulative(values):
+    valid = ~np.isnan(values)
+    filled = np.where(valid, values, 0.0)
+    zeros = np.zeros((len(values), 1))
+    return (np.concatenate([zeros, np.cumsum(valid, axis=1)], axis=1),
+            np.concatenate([zeros, np.cumsum(filled, axis=1)], axis=1),
+            np.concatenate([zeros, np.cumsum(filled * filled, axis=1)], axis=1))
+
+# Function to get the count, mean and variance of the values in [start, end) of every row
+# from running sums (columns are positions along the month axis; NaN below min_count)
+def _window_stats(sums, start, end, min_count):
+    count_sums, value_sums, square_sums = sums
+    n = count_sums[:, end] - count_sums[:, start]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = (value_sums[:, end] - value_sums[:, start]) / n
+        variance = ((square_sums[:, end] - square_sums[:, start]) - n * mean * mean) / (n - 1)
+    enough = n >= max(min_count, 2)
+    return n, np.where(enough, mean, np.nan), np.where(enough, np.maximum(variance, 0.0), np.nan)
+
+# Function to get the trailing rolling mean and standard deviation of every row of a
+# [pair, month] block over `window` months
+def rolling_stats(differences, window=WINDOW, min_count=MIN_MONTHS):
+    sums = _cumulative(differences)
+    end = np.arange(1, differences.shape[1] + 1)
+    _, mean, variance = _window_stats(sums, np.maximum(end - window, 0), end, min_count)
+    return mean, np.sqrt(variance)
+
+# Function to score a step change at every month of every row: Welch's t statistic of the
+# `window` months from there on against the `window` months before
+def step_scores(differences, window=WINDOW, min_count=MIN_MONTHS):
+    sums = _cumulative(differences)
+    n_months = differences.shape[1]
+    split = np.arange(n_months)
+    n_before, mean_before, var_before = _window_stats(sums, np.maximum(split - window, 0), split, min_count)
+    n_after, mean_after, var_after = _window_stats(sums, split, np.minimum(split + window, n_months), min_count)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (mean_after - mean_before) / np.sqrt(var_before / n_before + var_after / n_after)
+
+# Function to find the single most likely step change of every row with the standard
+# normal homogeneity test: T(k) = n1 * z1^2 + n2 * z2^2 over the standardized values
+# before and after each split, both sides at least min_count values long. Returns (score,
+# position of the first month after the break, shift in the rows' units); score is NaN
+# when a row is too short.
+def snht(differences, min_count=MIN_MONTHS):
+    valid = ~np.isnan(differences)
+    n = valid.sum(axis=1)
+    filled = np.where(valid, differences, 0.0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = filled.sum(axis=1) / n
+        std = np.sqrt((np.where(valid, differences - mean[:, None], 0.0) ** 2).sum(axis=1) / (n - 1))
+        z = np.where(valid, (differences - mean[:, None]) / std[:, None], 0.0)
+        n1 = np.cumsum(valid, axis=1)
+        s1 = np.cumsum(z, axis=1)
+        n2 = n[:, None] - n1
+        scores = s1 * s1 / n1 + (s1[:, -1:] - s1) ** 2 / n2
+    scores = np.where(valid & (n1 >= min_count) & (n2 >= min_count) & np.isfinite(scores), scores, -np.inf)
+    position = np.argmax(scores, axis=1)
+    rows = np.arange(len(differences))
+    score = scores[rows, position]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        before = s1[rows, position] / n1[rows, position]
+        after = (s1[rows, -1] - s1[rows, position]) / n2[rows, position]
+    found = np.isfinite(score)
+    return np.where(found, score, np.nan), position + 1, np.where(found, (after - before) * std, np.nan)
+
+# Function to get the Pearson correlation of every pair of rows, over the months both have
+def _correlations(a, b):
+    both = ~(np.isnan(a) | np.isnan(b))
+    n = both.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        a = np.where(both, a - np.where(both, a, 0.0).sum(axis=1, keepdims=True) / n[:, None], 0.0)
+        b = np.where(both, b - np.where(both, b, 0.0).sum(axis=1, keepdims=True) / n[:, None], 0.0)
+        return (a * b).sum(axis=1) / np.sqrt((a * a).sum(axis=1) * (b * b).sum(axis=1))
+
+# Process pool task: the statistics of one block of pairs. The matrix is an array, or the
+# path of a .npy file that is memory-mapped (so workers share it rather than copy it).
+def _pairs_task(task):
+    matrix, coop_ids, first_year, targets, neighbors, ranks, distances, window, min_count, series = task
+    if isinstance(matrix, str):
+        matrix = np.load(matrix, mmap_mode='r')
+    with ushcn_metrics.stage('pairwise', pairs=len(targets)) as record:
+        target_values = matrix[targets]
+        neighbor_values = matrix[neighbors]
+        differences = target_values - neighbor_values
+        valid = ~np.isnan(differences)
+        _, mean, variance = _window_stats(_cumulative(differences), 0, differences.shape[1], 2)
+        score, position, shift = snht(differences, min_count)
+        steps = step_scores(differences, window, min_count)
+        finite = np.where(np.isfinite(steps), np.abs(steps), -1.0)
+        step_position = np.argmax(finite, axis=1)
+        max_step = steps[np.arange(len(steps)), step_position]
+
+        summary = pl.DataFrame({
+            'coop_id': coop_ids[targets],
+            'neighbor': coop_ids[neighbors],
+            'rank': ranks.astype(np.uint16),
+            'distance_km': distances,
+            'n_months': valid.sum(axis=1).astype(np.uint32),
+            'correlation': _correlations(target_values, neighbor_values),
+            'mean': mean,
+            'std': np.sqrt(variance),
+            'snht': score,
+            'break_year': (first_year + position // 12).astype(np.uint16),
+            'break_month': (position % 12 + 1).astype(np.uint8),
+            'shift': shift,
+            'max_step': max_step,
+            'step_year': (first_year + step_position // 12).astype(np.uint16),
+            'step_month': (step_position % 12 + 1).astype(np.uint8),
+        }).with_columns(
+            pl.col(['correlation', 'mean', 'std', 'snht', 'shift', 'max_step']).fill_nan(None),
+        ).with_columns(
+            # No break or step where there is no score
+            pl.when(pl.col('snht').is_not_null()).then(pl.col(['break_year', 'break_month'])),
+            pl.when(pl.col('max_step').is_not_null()).then(pl.col(['step_year', 'step_month'])),
+        )
+
+        frame = None
+        if series:
+            rolling_mean, rolling_std = rolling_stats(differences, window, min_count)
+            pair, month = np.nonzero(valid)
+            frame = pl.DataFrame({
+                'coop_id': coop_ids[targets[pair]],
+                'neighbor': coop_ids[neighbors[pair]],
+                'year': (first_year + month // 12).astype(np.uint16),
+                'month': (month % 12 + 1).astype(np.uint8),
+                'difference': differences[pair, month],
+                'rolling_mean': rolling_mean[pair, month],
+                'rolling_std': rolling_std[pair, month],
+                'step_score': steps[pair, month],
+            }).with_columns(pl.col(['rolling_mean', 'rolling_std', 'step_score']).fill_nan(None))
+        record['rows_in'] = int(valid.sum())
+        record['rows_out'] = summary.height
+        return summary, frame
+
+# Function to compare every station of one element/dataset type with its k nearest
+# neighbors. Returns (summary, series): series is None unless asked for, as it has a row
+# for every pair and month.
+def pairwise_differences(element='tavg', dataset_type='raw', k=NEIGHBORS, years=None, window=WINDOW,
+                         min_count=MIN_MONTHS, series=False, data_dir=MONTHLY_DATA_DIR, stations_file=STATIONS_FILE,
+                         workers=1, chunk_pairs=CHUNK_PAIRS):
+    coop_ids, year_values, matrix = station_anomaly_matrix(element, dataset_type, years, data_dir)
+    targets, neighbors, ranks, distances = neighbor_pairs(coop_ids, k, stations_file)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        source = matrix
+        if workers > 1:
+            source = os.path.join(tmp_dir, 'anomalies.npy')
+            np.save(source, matrix)
+            del matrix
+        tasks = [
+            (source, coop_ids, int(year_values[0]) if len(year_values) else 0,
+             targets[start:start + chunk_pairs], neighbors[start:start + chunk_pairs],
+             ranks[start:start + chunk_pairs], distances[start:start + chunk_pairs], window, min_count, series)
+            for start in range(0, len(targets), chunk_pairs)
+        ]
+        results = run_tasks(_pairs_task, tasks, workers)
+    if not results:
+        return None, None
+    summary = pl.concat([summary for summary, _ in results])
+    return summary, pl.concat([frame for _, frame in results]) if series else None
+
+def main():
+    parser = argparse.ArgumentParser(description='Difference series between every station and its nearest neighbors.')
+    parser.add_argument('--element', default='tavg')
+    parser.add_argument('--dataset-type', default='raw')
+    parser.add_argument('--neighbors', type=int, default=NEIGHBORS, help='neighbors per station')
+    parser.add_argument('--years', type=int, nargs=2, metavar=('FIRST', 'LAST'))
+    parser.add_argument('--window', type=int, default=WINDOW, help='months per rolling window')
+    parser.add_argument('--min-months', type=int, default=MIN_MONTHS)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--output', default='ushcn_pairwise.parquet', help='one row per station/neighbor pair')
+    parser.add_argument('--series', help='also write the monthly difference series to this file')
+    args = parser.parse_args()
+
+    summary, series = pairwise_differences(args.element, args.dataset_type, args.neighbors, args.years, args.window,
+                                           args.min_months, args.series is not None, workers=args.workers)
+    if summary is None:
+        print(f'No {args.element}:{args.dataset_type} data.')
+        return
+    summary.write_parquet(args.output)
+    print(f'Saved {summary.height} pairs to {args.output}')
+    if series is not None:
+        series.write_parquet(args.series)
+        print(f'Saved {series.height} monthly differences to {args.series}')
+
+if __name__ == '__main__':
+    main()
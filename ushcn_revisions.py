@@ -0,0 +1,153 @@
+import argparse
+import os
+import polars as pl
+from ushcn_row_hashes import FLAGS, HASHES_DIR, list_snapshots, scan_hashes, update_hashes
+from ushcn_to_polars import (DATASET_TYPES, ELEMENTS, MONTHLY_SCHEMA, archive_path, iter_tar_members,
+                             parse_element_bytes, partition_path, scan_monthly)
+
+# Configuration
+SOURCE_DIR = 'source-data/raw'  # Dated snapshots: <YYYYMMDD>/ushcn.<element>.latest.<dataset_type>.tar.gz
+KEYS = ['element', 'dataset_type', 'coop_id', 'year']
+
+# Revision tracking between snapshots. At ingest, every station-year row is hashed into a
+# small table per snapshot (ushcn_row_hashes.py). Two snapshots are compared by joining
+# those tables, and only the station-years whose hashes differ are re-read from the two
+# snapshots' archives to show what changed:
+#
+#   python ushcn_revisions.py 20250301 20250419 --changes changes.parquet
+
+# Function to compare two snapshots by their row hashes. Returns one row per station-year
+# that was added, removed or changed: element, dataset_type, coop_id, year, change,
+# n_values_old, n_values_new. element/dataset_type optionally restrict the comparison.
+def diff_snapshots(old, new, element=None, dataset_type=None, data_dir=HASHES_DIR):
+    def side(snapshot):
+        lf = scan_hashes(data_dir).filter(pl.col('snapshot') == snapshot)
+        if element is not None:
+            lf = lf.filter(pl.col('element').is_in([element] if isinstance(element, str) else element))
+        if dataset_type is not None:
+            lf = lf.filter(pl.col('dataset_type').is_in([dataset_type] if isinstance(dataset_type, str) else dataset_type))
+        return lf.select(KEYS + ['row_hash', 'n_values'])
+
+    for snapshot in [old, new]:
+        if snapshot not in list_snapshots(data_dir):
+            raise ValueError(f'No row hashes for snapshot {snapshot!r} in {data_dir}/ (have: {list_snapshots(data_dir)})')
+
+    return (
+        side(old)
+        .join(side(new), on=KEYS, how='full', coalesce=True, suffix='_new')
+        .with_columns(
+            pl.when(pl.col('row_hash').is_null()).then(pl.lit('added'))
+            .when(pl.col('row_hash_new').is_null()).then(pl.lit('removed'))
+            .when(pl.col('row_hash') != pl.col('row_hash_new')).then(pl.lit('changed'))
+            .alias('change')
+        )
+        .filter(pl.col('change').is_not_null())
+        .select(
+            'element', 'dataset_type',
+            pl.col('coop_id').cast(pl.Utf8).str.zfill(6),
+            'year', 'change',
+            pl.col('n_values').alias('n_values_old'),
+            'n_values_new',
+        )
+        .sort(KEYS)
+        .collect()
+    )
+
+# Function to count a diff's added, removed and changed station-years by any of element,
+# dataset_type, coop_id and year
+def summarize_diff(diff, by=('element', 'dataset_type')):
+    by = [by] if isinstance(by, str) else list(by)
+    return (
+        diff
+        .group_by(by)
+        .agg(
+            (pl.col('change') == 'added').sum().alias('added'),
+            (pl.col('change') == 'removed').sum().alias('removed'),
+            (pl.col('change') == 'changed').sum().alias('changed'),
+            pl.col('coop_id').n_unique().alias('n_stations'),
+        )
+        .sort(by)
+    )
+
+# Function to parse just some stations' files out of one archive of a snapshot (an empty
+# frame when the snapshot has no such archive)
+def _parse_stations(raw_data_dir, element, dataset_type, coop_ids):
+    archive = archive_path(raw_data_dir, element, dataset_type)
+    blocks = []
+    if os.path.exists(archive):
+        for name, block in iter_tar_members(archive):
+            # Files are named <country><network>00<coop_id>.<dataset_type>.<element>
+            if name.endswith(f'.{dataset_type}.{element}') and os.path.basename(name)[5:11] in coop_ids:
+                blocks.append(block if block.endswith(b'\n') else block + b'\n')
+    if not blocks:
+        return pl.DataFrame(schema=MONTHLY_SCHEMA)
+    return parse_element_bytes(b''.join(blocks), element, dataset_type)
+
+# Function to materialize the monthly values behind a diff: only the stations in it are
+# parsed out of the two snapshots' archives. Returns one row per month whose value or
+# flags differ: element, dataset_type, coop_id, year, month, then value, dmflag, qcflag
+# and dsflag of the old (_old) and new (_new) snapshot.
+def changed_rows(diff, old_raw_dir, new_raw_dir):
+    columns = ['value'] + FLAGS
+    frames = []
+    for (element, dataset_type), group in diff.group_by(['element', 'dataset_type'], maintain_order=True):
+        coop_ids = set(group['coop_id'])
+        keys = group.select('coop_id', 'year')
+        sides = [
+            _parse_stations(raw_dir, element, dataset_type, coop_ids)
+            .join(keys, on=['coop_id', 'year'], how='semi')
+            .select(['coop_id', 'year', 'month'] + [pl.col(column).alias(f'{column}_{suffix}') for column in columns])
+            for raw_dir, suffix in [(old_raw_dir, 'old'), (new_raw_dir, 'new')]
+        ]
+        differs = pl.any_horizontal(pl.col(f'{column}_old').ne_missing(pl.col(f'{column}_new')) for column in columns)
+        frames.append(
+            sides[0]
+            .join(sides[1], on=['coop_id', 'year', 'month'], how='full', coalesce=True)
+            .filter(differs)
+            .select(pl.lit(element).alias('element'), pl.lit(dataset_type).alias('dataset_type'), pl.all())
+        )
+    if not frames:
+        return None
+    return pl.concat(frames).sort(KEYS + ['month'])
+
+# Function to hash the partitions currently in the monthly dataset as a snapshot, for data
+# ingested before row hashes were written at ingest
+def hash_snapshot(snapshot, data_dir=HASHES_DIR):
+    partition_paths = {
+        (element, dataset_type): partition_path(element, dataset_type)
+        for element in ELEMENTS
+        for dataset_type in DATASET_TYPES
+    }
+    return update_hashes(scan_monthly(compact=True), partition_paths, snapshot, data_dir=data_dir)
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare two ingested USHCN snapshots by their row hashes.')
+    parser.add_argument('old', nargs='?', help='earlier snapshot (YYYYMMDD)')
+    parser.add_argument('new', nargs='?', help='later snapshot (YYYYMMDD)')
+    parser.add_argument('--element', choices=ELEMENTS)
+    parser.add_argument('--dataset-type', choices=DATASET_TYPES)
+    parser.add_argument('--by', nargs='+', default=['element', 'dataset_type'], choices=KEYS, help='summary grouping')
+    parser.add_argument('--output', help='write the changed station-years to this parquet file')
+    parser.add_argument('--changes', help='write the changed monthly values (read from the archives) to this parquet file')
+    parser.add_argument('--source-dir', default=SOURCE_DIR, help='where the dated snapshot directories are')
+    args = parser.parse_args()
+
+    if args.old is None or args.new is None:
+        print('Snapshots with row hashes:', ', '.join(list_snapshots()) or 'none')
+        return
+    diff = diff_snapshots(args.old, args.new, args.element, args.dataset_type)
+    print(f'{diff.height} station-years differ between {args.old} and {args.new}')
+    print(summarize_diff(diff, args.by))
+    if args.output:
+        diff.write_parquet(args.output)
+        print(f'Saved the changed station-years to {args.output}')
+    if args.changes:
+        changes = changed_rows(diff, os.path.join(args.source_dir, args.old), os.path.join(args.source_dir, args.new))
+        if changes is None:
+            print('No changed values.')
+        else:
+            changes.write_parquet(args.changes)
+            print(f'Saved {changes.height} changed monthly values to {args.changes}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+import os
+import polars as pl
+import pyarrow.parquet as pq
+import ushcn_batches
+import ushcn_manifest
+
+# Configuration
+ROLLUPS_DIR = 'ushcn_rollups'  # <kind>/element=<element>/dataset_type=<dataset_type>/part-0.parquet
+ROLLUP_KEYS = {
+    'monthly': ['year', 'month'],  # network-wide, per year x month
+    'station_annual': ['coop_id', 'year'],  # per station, per year
+}
+AGGREGATES = ['mean', 'sum', 'count', 'min', 'max', 'n_estimated', 'n_flagged', 'n_stations']
+
+# Function to get the rollup file of one kind for an element/dataset type
+def rollup_path(kind, element, dataset_type, data_dir=ROLLUPS_DIR):
+    return os.path.join(data_dir, kind, f'element={element}', f'dataset_type={dataset_type}', 'part-0.parquet')
+
+# Function to get the rollup statistics of the monthly rows in a group:
+#   sum, count, min, max: of the non-missing values
+#   n_estimated: non-missing values with dmflag 'E'
+#   n_flagged: rows with a qcflag
+#   n_stations: stations with at least one non-missing value
+def _rollup_exprs():
+    has_value = pl.col('value').is_not_null()
+    return [
+        pl.col('value').sum().alias('sum'),
+        pl.col('value').count().alias('count'),
+        pl.col('value').min().alias('min'),
+        pl.col('value').max().alias('max'),
+        ((pl.col('dmflag') == 'E') & has_value).sum().alias('n_estimated'),
+        pl.col('qcflag').is_not_null().sum().alias('n_flagged'),
+        pl.col('coop_id').filter(has_value).n_unique().alias('n_stations'),
+    ]
+
+# Function to build one kind of rollup for one element/dataset type from the monthly data
+# (a LazyFrame in the full schema)
+def build_rollup(monthly, kind, element, dataset_type):
+    keys = ROLLUP_KEYS[kind]
+    return (
+        monthly
+        .filter(pl.col('element') == element, pl.col('dataset_type') == dataset_type)
+        .group_by(keys)
+        .agg(_rollup_exprs())
+        .sort(keys)
+        .collect()
+    )
+
+# Function to build and write both rollups of one element/dataset type a range of stations
+# at a time (about batch_rows monthly rows, see ushcn_batches), so memory depends on
+# batch_rows rather than on the size of the partition. The station_annual rows of each
+# range are written as they come; the monthly rollup is merged from the ranges' own
+# monthly rollups, which add up as the ranges share no station (sums may differ from
+# build_rollup's in the last bits, from the summation order).
+def stream_rollups(monthly, element, dataset_type, paths, batch_rows):
+    partition = monthly.filter(pl.col('element') == element, pl.col('dataset_type') == dataset_type)
+    monthly_path, annual_path = paths
+    partials = [build_rollup(partition.clear(), 'monthly', element, dataset_type)]
+    schema = build_rollup(partition.clear(), 'station_annual', element, dataset_type).to_arrow().schema
+    tmp_path = annual_path + '.tmp'
+    with pq.ParquetWriter(tmp_path, schema) as writer:
+        for station_range in ushcn_batches.station_ranges(partition, batch_rows):
+            batch = ushcn_batches.read_range(partition, station_range)
+            writer.write_table(build_rollup(batch, 'station_annual', element, dataset_type).to_arrow())
+            partials.append(build_rollup(batch, 'monthly', element, dataset_type))
+    os.replace(tmp_path, annual_path)
+
+    keys = ROLLUP_KEYS['monthly']
+    (
+        pl.concat(partials)
+        .group_by(keys)
+        .agg(
+            pl.col('sum').sum(),
+            pl.col('count').sum(),
+            pl.col('min').min(),
+            pl.col('max').max(),
+            pl.col('n_estimated').sum(),
+            pl.col('n_flagged').sum(),
+            pl.col('n_stations').sum(),
+        )
+        .sort(keys)
+        .write_parquet(monthly_path, statistics=True)
+    )
+
+# Function to rebuild the rollups of the partitions whose contents changed since the last
+# build (by content hash, recorded in the manifest). partition_paths maps
+# (element, dataset_type) to the partition file. With batch_rows, each partition is
+# rolled up in station batches (see stream_rollups). Returns the number of partitions rebuilt.
+def update_rollups(monthly, partition_paths, full=False, data_dir=ROLLUPS_DIR, batch_rows=None):
+    manifest = ushcn_manifest.load_manifest()
+    previous = {} if full else manifest.get('rollups', {})
+    entries = {}
+    n_built = 0
+    for (element, dataset_type), source in partition_paths.items():
+        paths = [rollup_path(kind, element, dataset_type, data_dir) for kind in ROLLUP_KEYS]
+        if not os.path.exists(source):
+            # The partition is gone: drop its rollups too, so rollup_aggregate does not keep
+            # counting rows the monthly data no longer has
+            for path in paths:
+                if os.path.exists(path):
+                    os.remove(path)
+                    print(f'Removed {element}:{dataset_type} rollup {path} (no source partition)')
+            continue
+        key = ushcn_manifest.partition_key(element, dataset_type)
+        source_sha256 = ushcn_manifest.file_sha256(source)
+        entry = previous.get(key)
+        if entry is not None and entry['source_sha256'] == source_sha256 and all(map(os.path.exists, paths)):
+            entries[key] = entry
+            continue
+
+        for path in paths:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        if batch_rows:
+            stream_rollups(monthly, element, dataset_type, paths, batch_rows)
+        else:
+            for kind, path in zip(ROLLUP_KEYS, paths):
+                build_rollup(monthly, kind, element, dataset_type).write_parquet(path, statistics=True)
+        entries[key] = {'source_sha256': source_sha256}
+        n_built += 1
+
+    if n_built:
+        print(f'Saved rollups for {n_built} partitions to {data_dir}/')
+    manifest['rollups'] = entries
+    ushcn_manifest.save_manifest(manifest)
+    return n_built
+
+# Function to lazily scan one kind of rollup
+def scan_rollup(kind, data_dir=ROLLUPS_DIR):
+    return pl.scan_parquet(
+        os.path.join(data_dir, kind, '**', '*.parquet'),
+        hive_partitioning=True,
+        hive_schema={'element': pl.Utf8, 'dataset_type': pl.Utf8},
+    )
+
+# Function to turn a single value or a list of values into a list
+def _as_list(values):
+    return [values] if isinstance(values, (str, int)) else list(values)
+
+# Function to get the filters shared by the rollups and the monthly data
+def _filters(element, dataset_type, years, months):
+    filters = []
+    if element is not None:
+        filters.append(pl.col('element').is_in(_as_list(element)))
+    if dataset_type is not None:
+        filters.append(pl.col('dataset_type').is_in(_as_list(dataset_type)))
+    if years is not None:
+        first, last = years
+        if first is not None:
+            filters.append(pl.col('year') >= first)
+        if last is not None:
+            filters.append(pl.col('year') <= last)
+    if months is not None:
+        filters.append(pl.col('month').is_in(_as_list(months)))
+    return filters
+
+# Function to check whether every group of a query is exactly one cell of the monthly rollup
+# (then n_stations can be read off it; otherwise station counts do not add up)
+def _single_cells(by, element, dataset_type, months):
+    def pinned(column, values):
+        return column in by or (values is not None and len(_as_list(values)) == 1)
+    return 'year' in by and pinned('month', months) and pinned('element', element) and pinned('dataset_type', dataset_type)
+
+# Function to answer an aggregate query, grouped by any of year, month, element and
+# dataset_type, from the rollups when the grouping allows, otherwise from the monthly data:
+#   - mean, sum, count, min, max, n_estimated and n_flagged add up across rollup cells
+#   - n_stations comes from the monthly rollup when every group is a single cell, or from
+#     the per-station annual rollup when there is no month in the grouping or filters
+# monthly is the fallback LazyFrame (e.g. UshcnDataset().scan()); aggregates is a subset
+# of AGGREGATES. Returns the grouped frame, sorted by the group columns.
+def rollup_aggregate(by, aggregates=('mean', 'count'), element=None, dataset_type=None, years=None, months=None,
+                     monthly=None, data_dir=ROLLUPS_DIR):
+    by = _as_list(by)
+    aggregates = _as_list(aggregates)
+    filters = _filters(element, dataset_type, years, months)
+    additive = [aggregate for aggregate in aggregates if aggregate != 'n_stations']
+
+    exprs = {
+        'sum': pl.col('sum').sum(),
+        'count': pl.col('count').sum(),
+        'mean': pl.col('sum').sum() / pl.col('count').sum(),
+        'min': pl.col('min').min(),
+        'max': pl.col('max').max(),
+        'n_estimated': pl.col('n_estimated').sum(),
+        'n_flagged': pl.col('n_flagged').sum(),
+    }
+    station_counts = None
+    if 'n_stations' in aggregates:
+        if _single_cells(by, element, dataset_type, months):
+            exprs['n_stations'] = pl.col('n_stations').sum()
+            additive = aggregates
+        elif 'month' not in by and months is None:
+            station_counts = (
+                scan_rollup('station_annual', data_dir)
+                .filter(*filters, pl.col('count') > 0)
+                .group_by(by)
+                .agg(pl.col('coop_id').n_unique().alias('n_stations'))
+            )
+        elif monthly is not None:
+            return _aggregate_monthly(monthly, by, aggregates, filters)
+        else:
+            raise ValueError('n_stations for this grouping needs the monthly data (pass monthly=...)')
+
+    result = (
+        scan_rollup('monthly', data_dir)
+        .filter(*filters)
+        .group_by(by)
+        .agg([exprs[aggregate].alias(aggregate) for aggregate in additive])
+    )
+    if station_counts is not None:
+        result = result.join(station_counts, on=by, how='left')
+    return result.select(by + aggregates).sort(by).collect()
+
+# Function to answer the same query from the monthly data itself
+def _aggregate_monthly(monthly, by, aggregates, filters):
+    exprs = {expr.meta.output_name(): expr for expr in _rollup_exprs()}
+    exprs['mean'] = pl.col('value').mean()
+    return (
+        monthly
+        .filter(*filters)
+        .group_by(by)
+        .agg([exprs[aggregate].alias(aggregate) for aggregate in aggregates])
+        .sort(by)
+        .collect()
+    )
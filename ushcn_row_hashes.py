@@ -0,0 +1,153 @@
+import os
+import shutil
+import numpy as np
+import polars as pl
+import pyarrow.parquet as pq
+import ushcn_batches
+import ushcn_manifest
+
+# Configuration
+HASHES_DIR = 'ushcn_row_hashes'  # snapshot=<YYYYMMDD>/element=<element>/dataset_type=<dataset_type>/part-0.parquet
+MISSING = -9999
+FLAGS = ['dmflag', 'qcflag', 'dsflag']
+
+# Row hashes written at ingest, for revision tracking between snapshots (see
+# ushcn_revisions.py): every station-year row of a partition (its 12 values and 36 flags)
+# is hashed to 64 bits and kept per snapshot, so two snapshots can be compared without
+# joining their monthly data.
+
+# Function to get the name of a snapshot directory (source-data/raw/20250419 -> 20250419)
+def snapshot_name(raw_data_dir):
+    return os.path.basename(os.path.normpath(raw_data_dir))
+
+# Function to get the row hash file of a snapshot's element/dataset type
+def hashes_path(snapshot, element, dataset_type, data_dir=HASHES_DIR):
+    return os.path.join(data_dir, f'snapshot={snapshot}', f'element={element}', f'dataset_type={dataset_type}',
+                        'part-0.parquet')
+
+# Function to hash every row of a (rows x bytes) uint8 matrix to 64 bits: FNV-1a over
+# 8-byte words, with a shift after every multiply and a final avalanche, so any change
+# anywhere in a row moves the whole hash
+def hash_rows(rows):
+    n_rows, width = rows.shape
+    padded = np.zeros((n_rows, -(-width // 8) * 8), dtype=np.uint8)
+    padded[:, :width] = rows
+    words = padded.view('<u8')
+    h = np.full(n_rows, 0xcbf29ce484222325, dtype=np.uint64)
+    for i in range(words.shape[1]):
+        h ^= words[:, i]
+        h *= np.uint64(0x100000001b3)
+        h ^= h >> np.uint64(29)
+    h ^= h >> np.uint64(33)
+    h *= np.uint64(0xff51afd7ed558ccd)
+    h ^= h >> np.uint64(33)
+    h *= np.uint64(0xc4ceb9fe1a85ec53)
+    h ^= h >> np.uint64(33)
+    return h
+
+# Function to hash the station-year rows of one element/dataset type. monthly is the
+# monthly data in either schema, as stored (scanning it in the other one would cast
+# coop_id, and a filter on a cast column is no longer pushed down to the files); values
+# are hashed in native integer units and flags as character codes, so a partition stored
+# either way hashes the same. Returns coop_id, year, row_hash and n_values per station-year.
+def station_year_hashes(monthly, element, dataset_type):
+    partition = monthly.filter(pl.col('element') == element, pl.col('dataset_type') == dataset_type)
+    if partition.collect_schema()['value'].is_integer():
+        value = pl.col('value')
+        # FLAG_ENUM categories are the printable characters from '!' (33) upwards
+        flags = [(pl.col(flag).to_physical().cast(pl.Int32) + 33).alias(flag) for flag in FLAGS]
+    else:
+        value = (pl.col('value') * (10 if element == 'prcp' else 100)).round().cast(pl.Int32)
+        flags = [pl.col(flag).str.encode('hex').str.to_integer(base=16).alias(flag) for flag in FLAGS]
+    df = (
+        partition
+        .select(pl.col('coop_id').cast(pl.UInt32), 'year', 'month', value, *flags)
+        .collect()
+    )
+    key = (df['coop_id'].to_numpy().astype(np.uint64) << np.uint64(16)) | df['year'].to_numpy().astype(np.uint64)
+    keys, row = np.unique(key, return_inverse=True)
+    month = df['month'].to_numpy().astype(np.intp) - 1
+
+    values = np.full((len(keys), 12), MISSING, dtype='<i4')
+    values[row, month] = df['value'].fill_null(MISSING).to_numpy()
+    flags = np.zeros((len(keys), 12, len(FLAGS)), dtype=np.uint8)
+    for i, flag in enumerate(FLAGS):
+        flags[row, month, i] = df[flag].fill_null(0).cast(pl.UInt8).to_numpy()
+    record = np.concatenate([values.view(np.uint8).reshape(len(keys), 12 * values.itemsize),
+                             flags.reshape(len(keys), 12 * len(FLAGS))], axis=1)
+
+    return pl.DataFrame({
+        'coop_id': (keys >> np.uint64(16)).astype(np.uint32),
+        'year': (keys & np.uint64(0xffff)).astype(np.uint16),
+        'row_hash': hash_rows(record),
+        'n_values': np.bincount(row, weights=df['value'].is_not_null().to_numpy(), minlength=len(keys)).astype(np.uint8),
+    })
+
+# Function to write the row hashes of one element/dataset type a range of stations at a
+# time (about batch_rows monthly rows, see ushcn_batches), so memory depends on
+# batch_rows rather than on the size of the partition. Same rows and order as
+# station_year_hashes.
+def stream_hashes(monthly, element, dataset_type, path, batch_rows):
+    partition = monthly.filter(pl.col('element') == element, pl.col('dataset_type') == dataset_type)
+    schema = station_year_hashes(partition.clear(), element, dataset_type).to_arrow().schema
+    tmp_path = path + '.tmp'
+    with pq.ParquetWriter(tmp_path, schema) as writer:
+        for station_range in ushcn_batches.station_ranges(partition, batch_rows):
+            writer.write_table(
+                station_year_hashes(ushcn_batches.read_range(partition, station_range), element, dataset_type).to_arrow()
+            )
+    os.replace(tmp_path, path)
+
+# Function to write the row hashes of a snapshot for the partitions in partition_paths
+# ((element, dataset_type) -> partition file). A partition whose contents are unchanged
+# since its hashes were last written (by content hash, recorded in the manifest) has its
+# hash file copied rather than rebuilt. With batch_rows, partitions are hashed in station
+# batches (see stream_hashes). Returns the number of partitions hashed.
+def update_hashes(monthly, partition_paths, snapshot, full=False, data_dir=HASHES_DIR, batch_rows=None):
+    manifest = ushcn_manifest.load_manifest()
+    previous = {} if full else manifest.get('hashes', {})
+    entries = {}
+    n_built = 0
+    for (element, dataset_type), source in partition_paths.items():
+        if not os.path.exists(source):
+            # The partition is gone: drop this snapshot's hashes of it (those of earlier
+            # snapshots stay, they record what those snapshots held)
+            stale = hashes_path(snapshot, element, dataset_type, data_dir)
+            if os.path.exists(stale):
+                os.remove(stale)
+            continue
+        key = ushcn_manifest.partition_key(element, dataset_type)
+        source_sha256 = ushcn_manifest.file_sha256(source)
+        path = hashes_path(snapshot, element, dataset_type, data_dir)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        entry = previous.get(key)
+        if entry is not None and entry['source_sha256'] == source_sha256 and os.path.exists(entry['path']):
+            if entry['path'] != path:
+                shutil.copyfile(entry['path'], path)
+        elif batch_rows:
+            stream_hashes(monthly, element, dataset_type, path, batch_rows)
+            n_built += 1
+        else:
+            station_year_hashes(monthly, element, dataset_type).write_parquet(path, statistics=True)
+            n_built += 1
+        entries[key] = {'source_sha256': source_sha256, 'path': path}
+
+    if n_built:
+        print(f'Saved row hashes for {n_built} partitions to {data_dir}/snapshot={snapshot}/')
+    manifest['hashes'] = entries
+    ushcn_manifest.save_manifest(manifest)
+    return n_built
+
+# Function to lazily scan the row hashes of every snapshot
+def scan_hashes(data_dir=HASHES_DIR):
+    return pl.scan_parquet(
+        os.path.join(data_dir, '**', '*.parquet'),
+        hive_partitioning=True,
+        hive_schema={'snapshot': pl.Utf8, 'element': pl.Utf8, 'dataset_type': pl.Utf8},
+    )
+
+# Function to list the snapshots that have row hashes, oldest first
+def list_snapshots(data_dir=HASHES_DIR):
+    if not os.path.isdir(data_dir):
+        return []
+    return sorted(name.split('=', 1)[1] for name in os.listdir(data_dir) if name.startswith('snapshot='))
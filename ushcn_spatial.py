@@ -0,0 +1,293 @@
+import argparse
+import hashlib
+import os
+import numpy as np
+import polars as pl
+import anomaly_engine
+import ushcn_manifest
+from ushcn_dataset import STATIONS_FILE
+
+# Configuration
+LEAF_SIZE = 32  # Stations per leaf of the tree
+EARTH_RADIUS_KM = 6371.0
+CACHE_DIR = '.cache/spatial'  # One <station file path hash>.npz per station file
+
+# Spatial index over the station table: a KD-tree on unit-sphere (x, y, z) coordinates,
+# flattened into leaves of at most LEAF_SIZE stations with their bounding boxes. Queries
+# are answered in bulk, a leaf of query points at a time: only the leaves whose boxes can
+# hold an answer are compared, so neighbors of every station cost about N log N instead of
+# N^2 haversines. Straight-line (chord) distances rank the same as great-circle ones;
+# results are given in great-circle km.
+#
+#   index = load_spatial_index()
+#   index.neighbors(10)            # coop_id, neighbor, rank, distance_km for every station
+#   index.within_radius(100)       # every station pair within 100 km
+#   index.in_bbox(35, 40, -110, -100)
+
+# Function to get unit-sphere (x, y, z) coordinates from latitudes and longitudes in degrees
+def unit_xyz(latitude, longitude):
+    lat = np.radians(np.asarray(latitude, dtype=np.float64))
+    lon = np.radians(np.asarray(longitude, dtype=np.float64))
+    return np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+# Functions to convert between chord lengths on the unit sphere and great-circle km
+def chord_to_km(chord):
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.minimum(np.asarray(chord) / 2, 1.0))
+
+def km_to_chord(km):
+    return 2 * np.sin(np.minimum(np.asarray(km, dtype=np.float64) / (2 * EARTH_RADIUS_KM), np.pi / 2))
+
+# Function to build the leaves of a KD-tree over points: split on the widest coordinate at
+# the median until a node holds at most leaf_size points. Returns (order, starts, ends,
+# box_min, box_max): leaf i holds points order[starts[i]:ends[i]] inside that box.
+def build_leaves(xyz, leaf_size=LEAF_SIZE):
+    order = np.arange(len(xyz))
+    starts, ends = [], []
+    stack = [(0, len(xyz))] if len(xyz) else []
+    while stack:
+        lo, hi = stack.pop()
+        if hi - lo <= leaf_size:
+            starts.append(lo)
+            ends.append(hi)
+            continue
+        points = xyz[order[lo:hi]]
+        axis = np.argmax(points.max(axis=0) - points.min(axis=0))
+        mid = (hi - lo) // 2
+        order[lo:hi] = order[lo:hi][np.argpartition(points[:, axis], mid)]
+        stack.append((lo + mid, hi))
+        stack.append((lo, lo + mid))
+    starts, ends = np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64)
+    box_min = np.array([xyz[order[s:e]].min(axis=0) for s, e in zip(starts, ends)]).reshape(-1, 3)
+    box_max = np.array([xyz[order[s:e]].max(axis=0) for s, e in zip(starts, ends)]).reshape(-1, 3)
+    return order, starts, ends, box_min, box_max
+
+# Function to get the shortest distance between one box and each of many boxes
+def _box_distances(low, high, box_min, box_max):
+    gaps = np.maximum(0.0, np.maximum(box_min - high, low - box_max))
+    return np.sqrt((gaps * gaps).sum(axis=1))
+
+# Function to get the distances between every query point and every candidate point
+def _chords(queries, points):
+    diff = queries[:, None, :] - points[None, :, :]
+    return np.sqrt((diff * diff).sum(axis=2))
+
+# Function to turn labels into an array that can be saved without pickling (polars gives
+# strings as an object array)
+def _labels(values):
+    values = np.asarray(values)
+    return values.astype(str) if values.dtype == object else values
+
+class SpatialIndex:
+    def __init__(self, coop_ids, latitude, longitude, states=None, leaf_size=LEAF_SIZE, leaves=None):
+        self.coop_ids = _labels(coop_ids)
+        self.latitude = np.asarray(latitude, dtype=np.float64)
+        self.longitude = np.asarray(longitude, dtype=np.float64)
+        self.states = None if states is None else _labels(states)
+        self.leaf_size = leaf_size
+        self.xyz = unit_xyz(self.latitude, self.longitude)
+        self.order, self.starts, self.ends, self.box_min, self.box_max = (
+            build_leaves(self.xyz, leaf_size) if leaves is None else leaves
+        )
+        self._by_latitude = np.argsort(self.latitude, kind='stable')
+
+    # Function to write the index to an .npz file, tagged with the hash of its source
+    def save(self, file_path, source=None):
+        tmp_path = f'{file_path}.tmp'
+        arrays = dict(coop_ids=self.coop_ids, latitude=self.latitude, longitude=self.longitude,
+                      order=self.order, starts=self.starts, ends=self.ends, box_min=self.box_min, box_max=self.box_max,
+                      leaf_size=self.leaf_size, source=source or '')
+        if self.states is not None:
+            arrays['states'] = self.states
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, file_path)
+
+    # Function to get the query points' xyz and leaves (build_leaves); the query points are
+    # the stations themselves, with their own leaves, when no coordinates are given
+    def _query_leaves(self, latitude, longitude):
+        if latitude is None:
+            return self.xyz, (self.order, self.starts, self.ends, self.box_min, self.box_max)
+        xyz = unit_xyz(np.atleast_1d(latitude), np.atleast_1d(longitude))
+        return xyz, build_leaves(xyz, self.leaf_size)
+
+    # Function to get the stations of a set of leaves
+    def _leaf_stations(self, leaves):
+        return np.concatenate([self.order[self.starts[i]:self.ends[i]] for i in leaves])
+
+    # Function to find the k nearest stations of every station (latitude/longitude None;
+    # a station is not its own neighbor) or of every given point. Returns (indices,
+    # distances_km), both [query, k] and nearest first; indices are positions in coop_ids,
+    # -1 (at an infinite distance) when there are fewer than k stations to give.
+    def knn(self, k, latitude=None, longitude=None):
+        self_query = latitude is None
+        xyz, (q_order, q_starts, q_ends, q_min, q_max) = self._query_leaves(latitude, longitude)
+        indices = np.full((len(xyz), k), -1, dtype=np.int64)
+        distances = np.full((len(xyz), k), np.inf)
+        sizes = self.ends - self.starts
+        need = k + self_query
+        for start, end, low, high in zip(q_starts, q_ends, q_min, q_max):
+            queries = q_order[start:end]
+            gaps = _box_distances(low, high, self.box_min, self.box_max)
+            ranked = np.argsort(gaps, kind='stable')
+            # The closest leaves that hold enough stations bound the k-th distance...
+            enough = min(np.searchsorted(np.cumsum(sizes[ranked]), need) + 1, len(ranked))
+            chords = self._candidate_chords(xyz[queries], queries, self._leaf_stations(ranked[:enough]), self_query)
+            bound = np.inf if chords.shape[1] < need else np.partition(chords, k - 1, axis=1)[:, k - 1].max()
+            # ...so only the leaves within that bound can hold a nearer station
+            candidates = self._leaf_stations(ranked[gaps[ranked] <= bound])
+            chords = self._candidate_chords(xyz[queries], queries, candidates, self_query)
+            n = min(k, len(candidates))
+            nearest = np.argsort(chords, axis=1, kind='stable')[:, :n]
+            indices[queries, :n] = candidates[nearest]
+            distances[queries, :n] = np.take_along_axis(chords, nearest, axis=1)
+        indices[~np.isfinite(distances)] = -1
+        return indices, chord_to_km(distances)
+
+    # Function to get the chords from query points to candidate stations (a station's
+    # distance to itself is infinite in a self query)
+    def _candidate_chords(self, query_xyz, queries, candidates, self_query):
+        chords = _chords(query_xyz, self.xyz[candidates])
+        if self_query:
+            chords[queries[:, None] == candidates[None, :]] = np.inf
+        return chords
+
+    # Function to get the k nearest neighbors of every station as a table of coop_id,
+    # neighbor, rank (1 = nearest) and distance_km
+    def neighbors(self, k):
+        indices, distances = self.knn(k)
+        found = indices >= 0
+        rows, ranks = np.nonzero(found)
+        return pl.DataFrame({
+            'coop_id': self.coop_ids[rows],
+            'neighbor': self.coop_ids[indices[found]],
+            'rank': (ranks + 1).astype(np.uint16),
+            'distance_km': distances[found],
+        })
+
+    # Function to find every station within radius_km of every station (latitude/longitude
+    # None: a table of coop_id, neighbor, distance_km) or of every given point (a table of
+    # point, the point's position, and coop_id, distance_km), nearest first
+    def within_radius(self, radius_km, latitude=None, longitude=None):
+        self_query = latitude is None
+        xyz, (q_order, q_starts, q_ends, q_min, q_max) = self._query_leaves(latitude, longitude)
+        limit = km_to_chord(radius_km)
+        found_queries, found_stations, found_chords = [], [], []
+        for start, end, low, high in zip(q_starts, q_ends, q_min, q_max):
+            leaves = np.nonzero(_box_distances(low, high, self.box_min, self.box_max) <= limit)[0]
+            if not len(leaves):
+                continue
+            queries = q_order[start:end]
+            candidates = self._leaf_stations(leaves)
+            chords = self._candidate_chords(xyz[queries], queries, candidates, self_query)
+            rows, columns = np.nonzero(chords <= limit)
+            found_queries.append(queries[rows])
+            found_stations.append(candidates[columns])
+            found_chords.append(chords[rows, columns])
+        query = np.concatenate(found_queries) if found_queries else np.array([], dtype=np.int64)
+        station = np.concatenate(found_stations) if found_stations else np.array([], dtype=np.int64)
+        chord = np.concatenate(found_chords) if found_chords else np.array([])
+        order = np.lexsort((chord, query))
+        return pl.DataFrame({
+            'coop_id' if self_query else 'point': self.coop_ids[query[order]] if self_query else query[order],
+            'neighbor' if self_query else 'coop_id': self.coop_ids[station[order]],
+            'distance_km': chord_to_km(chord[order]),
+        })
+
+    # Function to get the stations inside a latitude/longitude box (inclusive; a box with
+    # lon_min > lon_max crosses the antimeridian)
+    def in_bbox(self, lat_min, lat_max, lon_min, lon_max):
+        sorted_latitude = self.latitude[self._by_latitude]
+        first = np.searchsorted(sorted_latitude, lat_min, side='left')
+        last = np.searchsorted(sorted_latitude, lat_max, side='right')
+        candidates = self._by_latitude[first:last]
+        longitude = self.longitude[candidates]
+        if lon_min <= lon_max:
+            inside = (longitude >= lon_min) & (longitude <= lon_max)
+        else:
+            inside = (longitude >= lon_min) | (longitude <= lon_max)
+        return self.coop_ids[np.sort(candidates[inside])]
+
+    # Function to put every station in a grid x grid degree cell (numbered as in the
+    # anomaly engine), with the south-west corner of its cell
+    def grid_cells(self, grid=anomaly_engine.GRID):
+        cells, _ = anomaly_engine.grid_cells(self.latitude, self.longitude, grid)
+        n_lon = 360 // grid
+        return pl.DataFrame({
+            'coop_id': self.coop_ids,
+            'cell': cells.astype(np.int64),
+            'cell_latitude': (cells // n_lon) * grid - 90.0,
+            'cell_longitude': (cells % n_lon) * grid - 180.0,
+        })
+
+    # Function to assign every station to the nearest of a set of region points, e.g.
+    # climate division centroids: a frame of region, latitude, longitude and, optionally,
+    # state, in which case a station only goes to a region of its own state. Returns
+    # coop_id, region, distance_km (region null when the station's state has no region).
+    def assign_regions(self, regions):
+        by_state = 'state' in regions.columns and self.states is not None
+        groups = regions.partition_by('state', as_dict=True) if by_state else {None: regions}
+        region = np.full(len(self.coop_ids), None, dtype=object)
+        distance = np.full(len(self.coop_ids), np.nan)
+        for key, group in groups.items():
+            stations = np.arange(len(self.coop_ids)) if key is None else np.nonzero(self.states == key[0])[0]
+            if not len(stations):
+                continue
+            index = SpatialIndex(group['region'].to_numpy(), group['latitude'].to_numpy(), group['longitude'].to_numpy())
+            nearest, km = index.knn(1, self.latitude[stations], self.longitude[stations])
+            region[stations] = index.coop_ids[nearest[:, 0]]
+            distance[stations] = km[:, 0]
+        return pl.DataFrame({'coop_id': self.coop_ids, 'region': region.tolist(), 'distance_km': distance})
+
+# Function to get the cache file of a station file's index (its contents are checked on
+# load, so the file is named after the station file's path only)
+def cache_path(stations_file=STATIONS_FILE, cache_dir=CACHE_DIR):
+    key = hashlib.sha256(os.path.abspath(stations_file).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, f'{key}.npz')
+
+# Function to load the spatial index of a station file, building (and caching) it the first
+# time, or whenever the station file's contents or the leaf size change
+def load_spatial_index(stations_file=STATIONS_FILE, cache_file=None, leaf_size=LEAF_SIZE):
+    cache_file = cache_file or cache_path(stations_file)
+    source = ushcn_manifest.file_sha256(stations_file)
+    if os.path.exists(cache_file):
+        with np.load(cache_file) as cached:
+            if str(cached['source']) == source and int(cached['leaf_size']) == leaf_size:
+                leaves = tuple(cached[name] for name in ['order', 'starts', 'ends', 'box_min', 'box_max'])
+                return SpatialIndex(cached['coop_ids'], cached['latitude'], cached['longitude'],
+                                    cached['states'] if 'states' in cached else None, leaf_size, leaves)
+
+    stations = pl.read_parquet(stations_file).drop_nulls(['latitude', 'longitude'])
+    index = SpatialIndex(stations['coop_id'].to_numpy(), stations['latitude'].to_numpy(),
+                         stations['longitude'].to_numpy(),
+                         stations['state'].to_numpy() if 'state' in stations.columns else None, leaf_size)
+    os.makedirs(os.path.dirname(cache_file) or '.', exist_ok=True)
+    index.save(cache_file, source)
+    return index
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the station spatial index and run bulk queries on it.')
+    parser.add_argument('--stations-file', default=STATIONS_FILE)
+    parser.add_argument('--neighbors', type=int, metavar='K', help='the K nearest neighbors of every station')
+    parser.add_argument('--radius', type=float, metavar='KM', help='every station pair within KM km')
+    parser.add_argument('--grid', type=int, metavar='DEG', help='the grid cell of every station')
+    parser.add_argument('--output', help='write the result to this parquet file (default: print it)')
+    args = parser.parse_args()
+
+    index = load_spatial_index(args.stations_file)
+    print(f'Spatial index of {len(index.coop_ids)} stations in {cache_path(args.stations_file)}')
+    if args.neighbors is not None:
+        result = index.neighbors(args.neighbors)
+    elif args.radius is not None:
+        result = index.within_radius(args.radius)
+    elif args.grid is not None:
+        result = index.grid_cells(args.grid)
+    else:
+        return
+    if args.output:
+        result.write_parquet(args.output)
+        print(f'Saved {result.height} rows to {args.output}')
+    else:
+        print(result)
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,46 @@
 import tarfile
 import os
+import sys
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import polars as pl
+import pyarrow as pa
+import pyarrow.parquet as pq
 import glob
+import ushcn_adjustments
+import ushcn_rollups
+import ushcn_row_hashes
+import ushcn_manifest
+import ushcn_metrics
 
 # Configuration
 RAW_DATA_DIR = 'source-data/raw/20250419'  # Directory containing .tar.gz files
+MONTHLY_DATA_DIR = 'ushcn_monthly_data'  # Hive-partitioned dataset: element=<element>/dataset_type=<dataset_type>/
+ROW_GROUP_SIZE = 50_000  # ~40 years of one month for every station, per row group
+BATCH_ROWS = 500_000  # Monthly rows parsed at a time when streaming (--batch-rows)
 DATASET_TYPES = ['raw', 'tob', 'FLs.52j']  
 ELEMENTS = ['tmax', 'tmin', 'tavg', 'prcp'] 
 
 # Function to extract tar.gz files
 def extract_tar_gz(file_path, extract_path='.'):
-    with tarfile.open(file_path, 'r:gz') as tar:
-        tar.extractall(path=extract_path, filter="data")  # Use "data" for safe extraction
+    with ushcn_metrics.stage('extract', archive=os.path.basename(file_path)) as record:
+        record['bytes_in'] = os.path.getsize(file_path)
+        with tarfile.open(file_path, 'r:gz') as tar:
+            tar.extractall(path=extract_path, filter="data")  # Use "data" for safe extraction
+
+# Function to stream the regular-file members of a tar.gz file as (name, bytes),
+# without extracting anything to disk
+def iter_tar_members(file_path):
+    with tarfile.open(file_path, 'r|gz') as tar:
+        for member in tar:
+            if member.isfile():
+                yield member.name, tar.extractfile(member).read()
+
+# Function to get the archive path for an element/dataset type
+def archive_path(raw_data_dir, element, dataset_type):
+    return os.path.join(raw_data_dir, f'ushcn.{element}.latest.{dataset_type}.tar.gz')
 
 # Function to parse the station file
 def parse_stations(file_path):
@@ -53,60 +82,177 @@ def parse_stations(file_path):
     
     return pl.DataFrame(data, schema=schema)
 
-# Function to parse data file
-def parse_element_data(file_path, element, dataset_type):
-    data = []
-    with open(file_path, 'r') as f:
-        for line in f:
-            record = {
-                'country_code': line[0:2].strip(),
-                'network_code': line[2:3].strip(),
-                'coop_id': line[5:11].strip(),
-                'year': int(line[12:16].strip())
-            }
-            for month in range(1, 13):
-                start = 16 + (month - 1) * 9
-                value = int(line[start:start+6].strip())
-                monthly_record = {
-                    'coop_id': record['coop_id'],
-                    'year': record['year'],
-                    'month': month,
-                    'element': element,
-                    'dataset_type': dataset_type,
-                    'value': value if value != -9999 else None,
-                    'dmflag': line[start+6:start+7].strip() or None,
-                    'qcflag': line[start+7:start+8].strip() or None,
-                    'dsflag': line[start+8:start+9].strip() or None
-                }
-                data.append(monthly_record)
-    
-    # Define schema for monthly data
-    schema = {
-        'coop_id': pl.Utf8,
-        'year': pl.UInt16,
-        'month': pl.UInt8,
-        'element': pl.Utf8,
-        'dataset_type': pl.Utf8,
-        'value': pl.Float64,
-        'dmflag': pl.Utf8,
-        'qcflag': pl.Utf8,
-        'dsflag': pl.Utf8
-    }
-    
-    df = pl.DataFrame(data, schema=schema)
-    
-    # Convert values: temperature (hundredths of °C to °C), precipitation (tenths of mm to mm)
-    if element in ['tmax', 'tmin', 'tavg']:
-        df = df.with_columns(pl.col('value') / 100.0)
-    else:  # prcp
-        df = df.with_columns(pl.col('value') / 10.0)
-    
+# Schema for monthly data
+MONTHLY_SCHEMA = {
+    'coop_id': pl.Utf8,
+    'year': pl.UInt16,
+    'month': pl.UInt8,
+    'element': pl.Utf8,
+    'dataset_type': pl.Utf8,
+    'value': pl.Float64,
+    'dmflag': pl.Utf8,
+    'qcflag': pl.Utf8,
+    'dsflag': pl.Utf8
+}
+
+# Compact schema for monthly data: numeric station key, values in native integer units
+# (hundredths of °C, tenths of mm; see scaled_value) and single-byte enums for the
+# element, dataset type and flags
+FLAG_ENUM = pl.Enum([chr(code) for code in range(33, 127)])  # any printable, non-blank character
+COMPACT_SCHEMA = {
+    'coop_id': pl.UInt32,
+    'year': pl.UInt16,
+    'month': pl.UInt8,
+    'element': pl.Enum(ELEMENTS),
+    'dataset_type': pl.Enum(DATASET_TYPES),
+    'value': pl.Int32,
+    'dmflag': FLAG_ENUM,
+    'qcflag': FLAG_ENUM,
+    'dsflag': FLAG_ENUM
+}
+
+# Function to get the divisor from native units: temperature (hundredths of °C to °C),
+# precipitation (tenths of mm to mm)
+def value_scale(element):
+    return 100.0 if element in ['tmax', 'tmin', 'tavg'] else 10.0
+
+# Function to convert a compact, native-unit value column to °C/mm (divides by a scalar,
+# like the parser does, so the floats are bit-for-bit the same as the full schema's)
+def scaled_value(value='value', element='element'):
+    value = pl.col(value).cast(pl.Float64)
+    return (
+        pl.when(pl.col(element) == 'prcp')
+        .then(value / value_scale('prcp'))
+        .otherwise(value / value_scale('tmax'))
+    )
+
+# Function to view a fixed-width text block as a (lines x width) byte matrix
+def byte_matrix(data, width):
+    buf = np.frombuffer(data, dtype=np.uint8)
+
+    # Fast path: every line is exactly `width` characters plus '\n'
+    if len(buf) % (width + 1) == 0:
+        matrix = buf.reshape(-1, width + 1)
+        if (matrix[:, width] == ord('\n')).all():
+            return matrix[:, :width]
+
+    # Otherwise drop blank lines and pad short lines with spaces (covers '\r\n',
+    # stripped trailing blanks and a missing final newline)
+    if len(buf) and buf[-1] != ord('\n'):
+        buf = np.append(buf, np.uint8(ord('\n')))
+    ends = np.flatnonzero(buf == ord('\n'))
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    keep = ends > starts
+    starts, ends = starts[keep], ends[keep]
+    idx = starts[:, None] + np.arange(width)
+    padded = np.append(buf, np.uint8(ord(' ')))
+    matrix = padded[np.where(idx < ends[:, None], idx, len(buf))]
+    matrix[matrix == ord('\r')] = ord(' ')
+    return matrix
+
+# Function to parse right-aligned integer fields from a (..., width) byte array
+# (blanks and the sign sit left of the digits, so they just count as zeros)
+def parse_ints(fields):
+    fields = np.ascontiguousarray(fields)
+    digits = fields - np.uint8(ord('0'))  # wraps blanks and '-' above 9
+    digits *= digits <= 9
+    weights = 10 ** np.arange(fields.shape[-1] - 1, -1, -1, dtype=np.int32)
+    acc = digits.astype(np.int32) @ weights
+    negative = (fields == ord('-')).view(np.uint8) @ np.ones(fields.shape[-1], dtype=np.uint8)
+    return np.where(negative > 0, -acc, acc)
+
+# Function to build a nullable string column from single-byte flags (blank = null)
+def _flag_column(flags):
+    flags = flags.ravel()
+    present = flags != ord(' ')
+    offsets = np.zeros(len(flags) + 1, dtype=np.int32)
+    np.cumsum(present, out=offsets[1:])
+    array = pa.StringArray.from_buffers(
+        len(flags),
+        pa.py_buffer(offsets),
+        pa.py_buffer(np.ascontiguousarray(flags[present])),
+        pa.py_buffer(np.packbits(present, bitorder='little')),
+    )
+    return pl.from_arrow(array)
+
+# Function to parse the bytes of a data file
+def parse_element_bytes(data, element, dataset_type, compact=False):
+    with ushcn_metrics.stage('parse_fields', element=element, dataset_type=dataset_type) as record:
+        # Slice every fixed-width field out of the whole block at once
+        matrix = byte_matrix(data, 124)
+        n_lines = len(matrix)
+        months = matrix[:, 16:124].reshape(n_lines, 12, 9)
+        values = parse_ints(months[:, :, 0:6]).ravel()
+        value = pl.Series(values).set(pl.Series(values == -9999), None)
+
+        # coop_id is a 6 digit code, one per line; repeat it for each month
+        line_of_row = np.repeat(np.arange(n_lines), 12)
+        if compact:
+            coop_id = pl.Series(parse_ints(matrix[:, 5:11]).astype(np.uint32))
+        else:
+            coop_ids = np.ascontiguousarray(matrix[:, 5:11]).view('S6').ravel()
+            coop_id = pl.Series('coop_id', coop_ids).cast(pl.Utf8).str.strip_chars()
+            # Convert values to °C/mm (divide in polars, as before, so the floats come out bit-for-bit the same)
+            value = value.cast(pl.Float64) / value_scale(element)
+        record['bytes_in'] = len(data)
+        record['rows_out'] = n_lines * 12
+
+    with ushcn_metrics.stage('build_frame', element=element, dataset_type=dataset_type) as record:
+        df = pl.DataFrame({
+            'coop_id': coop_id.gather(line_of_row),
+            'year': np.repeat(parse_ints(matrix[:, 12:16]), 12).astype(np.uint16),
+            'month': np.tile(np.arange(1, 13, dtype=np.uint8), n_lines),
+            'element': pl.repeat(element, n_lines * 12, dtype=pl.Utf8, eager=True),
+            'dataset_type': pl.repeat(dataset_type, n_lines * 12, dtype=pl.Utf8, eager=True),
+            'value': value,
+            'dmflag': _flag_column(months[:, :, 6]),
+            'qcflag': _flag_column(months[:, :, 7]),
+            'dsflag': _flag_column(months[:, :, 8]),
+        }).cast(COMPACT_SCHEMA if compact else MONTHLY_SCHEMA)
+        record['rows_out'] = df.height
+        record['bytes_out'] = df.estimated_size()
+
     return df
 
+# Function to parse data file
+def parse_element_data(file_path, element, dataset_type, compact=False):
+    with open(file_path, 'rb') as f:
+        return parse_element_bytes(f.read(), element, dataset_type, compact)
+
+# Function to read data files as newline-terminated blocks
+# (every line carries its own coop_id, so the blocks can simply be concatenated)
+def iter_file_blocks(file_paths):
+    for file_path in file_paths:
+        with open(file_path, 'rb') as f:
+            block = f.read()
+        yield block if block.endswith(b'\n') else block + b'\n'
+
+# Function to stream the data files of one element/dataset type out of its tar.gz as blocks
+def iter_archive_blocks(file_path, element, dataset_type):
+    for name, block in iter_tar_members(file_path):
+        if name.endswith(f'.{dataset_type}.{element}'):
+            yield block if block.endswith(b'\n') else block + b'\n'
+
+# Function to parse many data files of one element/dataset type in a single pass
+def parse_element_files(file_paths, element, dataset_type, compact=False):
+    with ushcn_metrics.stage('read_files', element=element, dataset_type=dataset_type) as record:
+        data = b''.join(iter_file_blocks(file_paths))
+        record['bytes_in'] = record['bytes_out'] = len(data)
+    return parse_element_bytes(data, element, dataset_type, compact)
+
+# Function to parse the data files of one element/dataset type straight out of its tar.gz
+def parse_element_archive(file_path, element, dataset_type, compact=False):
+    with ushcn_metrics.stage('read_archive', element=element, dataset_type=dataset_type) as record:
+        blocks = list(iter_archive_blocks(file_path, element, dataset_type))
+        data = b''.join(blocks)
+        record['bytes_in'] = os.path.getsize(file_path)
+        record['bytes_out'] = len(data)
+    return parse_element_bytes(data, element, dataset_type, compact), len(blocks)
+
 # Process station data
 def process_stations():
     # Parse stations
-    data_dir = 'source-data/raw/20250419'
+    data_dir = RAW_DATA_DIR
     station_file = os.path.join(data_dir, 'ushcn-v2.5-stations.txt')
     if os.path.exists(station_file):
         print('Processing stations...')
@@ -117,10 +263,53 @@ def process_stations():
         print(f'Station file {station_file} not found.')
         return
     
-# Process element data
-def process_elements():
+# Function to run tasks, in a process pool when more than one worker is asked for.
+# Results come back in task order, so the output does not depend on scheduling.
+# When stages are being recorded, the workers' records are sent back and merged.
+def run_tasks(function, tasks, workers):
+    if workers > 1 and len(tasks) > 1:
+        # 'spawn' rather than 'fork': polars' thread pool does not survive a fork
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=min(workers, len(tasks)), mp_context=context) as pool:
+            metrics = ushcn_metrics.active()
+            if metrics is None:
+                return list(pool.map(function, tasks))
+            results = []
+            for result, records in pool.map(ushcn_metrics.instrumented_task, [(function, task) for task in tasks]):
+                metrics.extend(records)
+                results.append(result)
+            return results
+    return [function(task) for task in tasks]
+
+# Process pool task: parse one list of extracted files
+def _parse_files_task(task):
+    data_files, element, dataset_type, compact = task
+    return parse_element_files(data_files, element, dataset_type, compact)
+
+# Process pool task: parse one archive
+def _parse_archive_task(task):
+    archive, element, dataset_type, compact = task
+    return parse_element_archive(archive, element, dataset_type, compact)
+
+# Process pool task: stream one list of extracted files into its partition
+def _stream_files_task(task):
+    data_files, element, dataset_type, compact, batch_rows = task
+    return stream_partition(iter_file_blocks(data_files), element, dataset_type, batch_rows, compact)
+
+# Process pool task: stream one archive into its partition
+def _stream_archive_task(task):
+    archive, element, dataset_type, compact, batch_rows = task
+    return stream_partition(iter_archive_blocks(archive, element, dataset_type), element, dataset_type, batch_rows, compact)
+
+# Process element data extracted to disk (the original, slower path)
+def parse_extracted_elements(raw_data_dir, workers=1, compact=False):
+    tasks = extracted_element_tasks(raw_data_dir, compact)
+    return run_tasks(_parse_files_task, tasks, workers)
+
+# Function to extract the archives and list the files of each element/dataset type,
+# as (data_files, element, dataset_type, compact) tasks
+def extracted_element_tasks(raw_data_dir, compact=False):
     # Extract all .tar.gz files
-    raw_data_dir = 'source-data/raw/20250419'
     for file in glob.glob(f'{raw_data_dir}/ushcn.*.latest.*.tar.gz'):
         print(f'Extracting {file}...')
         extract_tar_gz(file, raw_data_dir)
@@ -129,35 +318,265 @@ def process_elements():
     extracted_dirs = glob.glob(f'{raw_data_dir}/ushcn.v2.5.5*')
     if not extracted_dirs:
         print('No extracted directories found.')
-        return
+        return []
     extracted_data_dir = extracted_dirs[0]
-    
 
-    # Parse and combine data for each element
-    data_dfs = []
+    # Find all files for each element and dataset type (sorted, so the row order is reproducible)
+    tasks = []
     for element in ELEMENTS:
         for dataset_type in DATASET_TYPES:
-            # Find all files for this element and dataset type
-            data_files = glob.glob(os.path.join(extracted_data_dir, f'*.{dataset_type}.{element}'))
+            with ushcn_metrics.stage('glob', element=element, dataset_type=dataset_type) as record:
+                data_files = sorted(glob.glob(os.path.join(extracted_data_dir, f'*.{dataset_type}.{element}')))
+                record['files'] = len(data_files)
             if data_files:
                 print(f'Processing {element}:{dataset_type} data ({len(data_files)} files)...')
-                for data_file in data_files:
-                    data_df = parse_element_data(data_file, element, dataset_type)
-                    data_dfs.append(data_df)
+                tasks.append((data_files, element, dataset_type, compact))
             else:
                 print(f'No data files found for {element} with dataset type {dataset_type}.')
-    
-    if data_dfs:
-        # Combine all data into a single DataFrame
-        combined_df = pl.concat(data_dfs)
-        combined_df.write_parquet('ushcn_monthly_data.parquet')
-        print('Saved monthly data to ushcn_monthly_data.parquet')
+    return tasks
+
+# Function to get the partition file for an element/dataset type
+def partition_path(element, dataset_type, data_dir=MONTHLY_DATA_DIR):
+    return os.path.join(data_dir, f'element={element}', f'dataset_type={dataset_type}', 'part-0.parquet')
+
+# Function to write one element/dataset type partition.
+# element and dataset_type live in the directory names, not the file. Rows are sorted
+# by month, then year, so each row group covers one month over a narrow span of years
+# and its min/max statistics let a month/year filter skip most row groups.
+def write_partition(data_df, element, dataset_type, data_dir=MONTHLY_DATA_DIR):
+    path = partition_path(element, dataset_type, data_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with ushcn_metrics.stage('write_partition', element=element, dataset_type=dataset_type) as record:
+        (
+            data_df
+            .drop(['element', 'dataset_type'])
+            .sort(['month', 'year', 'coop_id'])
+            .write_parquet(path, row_group_size=ROW_GROUP_SIZE, statistics=True)
+        )
+        record['rows_in'] = data_df.height
+        record['bytes_out'] = os.path.getsize(path)
+    return path
+
+# Function to group newline-terminated blocks into batches of about batch_rows monthly
+# rows (12 per line), whole blocks only. Yields (bytes, number of blocks).
+def _batches(blocks, batch_rows):
+    batch, n_rows = [], 0
+    for block in blocks:
+        batch.append(block)
+        n_rows += block.count(b'\n') * 12
+        if n_rows >= batch_rows:
+            yield b''.join(batch), len(batch)
+            batch, n_rows = [], 0
+    if batch:
+        yield b''.join(batch), len(batch)
+
+# Function to write one element/dataset type partition in bounded memory: the blocks
+# are parsed batch_rows at a time and each batch is flushed as row groups straight
+# away, so peak memory depends on batch_rows, not on the size of the data.
+# Unlike write_partition the rows stay in file order (station, year, month): sorting by
+# month would need the whole partition, so month filters skip fewer row groups here
+# and station filters skip more. Returns (path, rows, number of blocks).
+def stream_partition(blocks, element, dataset_type, batch_rows=BATCH_ROWS, compact=False, data_dir=MONTHLY_DATA_DIR):
+    path = partition_path(element, dataset_type, data_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    schema = parse_element_bytes(b'', element, dataset_type, compact).drop(['element', 'dataset_type']).to_arrow().schema
+    n_rows = n_blocks = 0
+    tmp_path = path + '.tmp'
+    with pq.ParquetWriter(tmp_path, schema) as writer:
+        for data, n_batch_blocks in _batches(blocks, batch_rows):
+            batch_df = parse_element_bytes(data, element, dataset_type, compact).drop(['element', 'dataset_type'])
+            with ushcn_metrics.stage('write_batch', element=element, dataset_type=dataset_type) as record:
+                writer.write_table(batch_df.to_arrow(), row_group_size=ROW_GROUP_SIZE)
+                record['rows_in'] = batch_df.height
+            n_rows += batch_df.height
+            n_blocks += n_batch_blocks
+    os.replace(tmp_path, path)
+    return path, n_rows, n_blocks
+
+# Function to lazily scan the monthly dataset; filters on element/dataset_type only
+# open the matching partitions, and filters on year/month skip row groups.
+# compact=True gives the COMPACT_SCHEMA (use scaled_value() for °C/mm), otherwise
+# MONTHLY_SCHEMA, whichever of the two the dataset was written with. The partition
+# columns come straight out of the paths in their final type (a cast would keep the
+# element/dataset_type filters from pruning partitions).
+def scan_monthly(data_dir=MONTHLY_DATA_DIR, compact=False):
+    schema = COMPACT_SCHEMA if compact else MONTHLY_SCHEMA
+    lf = pl.scan_parquet(
+        os.path.join(data_dir, '**', '*.parquet'),
+        hive_partitioning=True,
+        hive_schema={'element': schema['element'], 'dataset_type': schema['dataset_type']},
+    )
+    stored_compact = lf.collect_schema()['value'].is_integer()
+    flags = ['dmflag', 'qcflag', 'dsflag']
+
+    if compact and not stored_compact:
+        lf = lf.with_columns(
+            pl.col('coop_id').cast(pl.UInt32),
+            (pl.col('value') * pl.when(pl.col('element') == 'prcp').then(10).otherwise(100)).round().cast(pl.Int32),
+        )
+    elif not compact and stored_compact:
+        lf = lf.with_columns(
+            pl.col('coop_id').cast(pl.Utf8).str.zfill(6),
+            scaled_value().alias('value'),
+            pl.col(flags).cast(pl.Utf8),
+        )
+    return lf.select(list(MONTHLY_SCHEMA)).cast(schema)
+
+# Function to parse archive tasks into their partitions, each whole or, with batch_rows,
+# streamed (see stream_partition). Returns (path, rows, number of files) per task.
+def _write_archive_partitions(tasks, workers, batch_rows=None):
+    if batch_rows:
+        return run_tasks(_stream_archive_task, [task + (batch_rows,) for task in tasks], workers)
+    results = []
+    for (archive, element, dataset_type, _), (data_df, n_files) in zip(tasks, run_tasks(_parse_archive_task, tasks, workers)):
+        results.append((write_partition(data_df, element, dataset_type), data_df.height, n_files))
+    return results
+
+# Function to remove every partition file in data_dir but those in keep (their paths), so
+# the dataset holds only what one run wrote. Returns the number removed.
+def remove_other_partitions(keep, data_dir=MONTHLY_DATA_DIR):
+    keep = {os.path.normpath(path) for path in keep}
+    n_removed = 0
+    for path in sorted(glob.glob(os.path.join(data_dir, '**', '*.parquet'), recursive=True)):
+        if os.path.normpath(path) not in keep:
+            os.remove(path)
+            print(f'Removed {path} (not in the extracted data)')
+            n_removed += 1
+    return n_removed
+
+# Process element data streamed out of the .tar.gz files, one partition file per archive.
+# Archives whose bytes match the manifest are not reparsed; their partitions are reused.
+# Returns the number of partitions written and the number removed (their archive is gone).
+def update_partitions(raw_data_dir, workers=1, full=False, compact=False, batch_rows=None):
+    manifest = ushcn_manifest.load_manifest()
+    previous = {} if full else manifest['partitions']
+    partitions = {}
+    tasks = []
+    for element in ELEMENTS:
+        for dataset_type in DATASET_TYPES:
+            key = ushcn_manifest.partition_key(element, dataset_type)
+            archive = archive_path(raw_data_dir, element, dataset_type)
+            if not os.path.exists(archive):
+                print(f'No archive found for {element} with dataset type {dataset_type}.')
+                continue
+            with ushcn_metrics.stage('hash_archive', element=element, dataset_type=dataset_type) as record:
+                archive_sha256 = ushcn_manifest.file_sha256(archive)
+                record['bytes_in'] = os.path.getsize(archive)
+            entry = previous.get(key)
+            if entry is not None and entry.get('compact', False) == compact and ushcn_manifest.is_current(entry, archive_sha256):
+                print(f'Reusing {element}:{dataset_type} data (archive unchanged)')
+                partitions[key] = dict(entry, archive=archive)
+            else:
+                tasks.append((archive, element, dataset_type, compact))
+                partitions[key] = {'archive': archive, 'archive_sha256': archive_sha256, 'compact': compact}
+
+    for (archive, element, dataset_type, _), (path, n_rows, n_files) in zip(tasks, _write_archive_partitions(tasks, workers, batch_rows)):
+        print(f'Processed {element}:{dataset_type} data from {archive} ({n_files} files, {n_rows} rows)')
+        partitions[ushcn_manifest.partition_key(element, dataset_type)].update({
+            'path': path,
+            'sha256': ushcn_manifest.file_sha256(path),
+            'rows': n_rows,
+        })
+
+    # Partitions whose archive disappeared from the snapshot are dropped, same as a full rebuild
+    n_removed = 0
+    for key, entry in manifest['partitions'].items():
+        if key not in partitions and os.path.exists(entry['path']):
+            os.remove(entry['path'])
+            print(f'Removed {entry["path"]} (its archive is no longer in the snapshot)')
+            n_removed += 1
+
+    manifest['snapshot'] = raw_data_dir
+    manifest['partitions'] = partitions
+    ushcn_manifest.save_manifest(manifest)
+    return len(tasks), n_removed
+
+# Process element data. With batch_rows, each partition is streamed to disk batch_rows
+# rows at a time (see stream_partition) instead of being parsed whole, and the
+# adjustments, rollups and row hashes are built in station batches of about batch_rows
+# rows (see ushcn_batches). Peak memory then follows batch_rows, not the size of the
+# data: about batch_rows monthly rows per stage (up to three times that for the
+# adjustments, which join the raw, tob and final rows of the same stations), plus one
+# row per station and the per-batch year x month rollups.
+def process_elements(raw_data_dir=RAW_DATA_DIR, extract=False, workers=1, full=False, compact=False, batch_rows=None):
+    with ushcn_metrics.stage('process_elements', workers=workers) as record:
+        record['partitions_written'], record['partitions_removed'] = _process_elements(
+            raw_data_dir, extract, workers, full, compact, batch_rows)
+
+def _process_elements(raw_data_dir, extract, workers, full, compact, batch_rows):
+    if extract:
+        if batch_rows:
+            tasks = [task + (batch_rows,) for task in extracted_element_tasks(raw_data_dir, compact)]
+            written = [path for path, _, _ in run_tasks(_stream_files_task, tasks, workers)]
+        else:
+            written = [
+                write_partition(data_df, str(data_df['element'][0]), str(data_df['dataset_type'][0]))
+                for data_df in parse_extracted_elements(raw_data_dir, workers, compact)
+            ]
+        n_written = len(written)
+        # Partitions left by an earlier run (say, from archives this snapshot no longer
+        # has) would be mixed in with the extracted data; the extract is a full rebuild
+        n_removed = remove_other_partitions(written)
+        # The manifest only knows about archive-built partitions; start over next time
+        ushcn_manifest.save_manifest(ushcn_manifest.empty_manifest())
     else:
-        print('No data files processed.')
+        n_written, n_removed = update_partitions(raw_data_dir, workers, full, compact, batch_rows)
+
+    if n_written:
+        print(f'Saved monthly data to {MONTHLY_DATA_DIR}/ ({n_written} partitions written)')
+    if n_removed:
+        print(f'Removed {n_removed} partitions from {MONTHLY_DATA_DIR}/ (their source data is gone)')
+    if not n_written and not n_removed:
+        print(f'No archives changed; {MONTHLY_DATA_DIR}/ is up to date')
+
+    # Keep the raw-vs-adjusted table, the rollups and the row hashes in step with the partitions they are built from
+    partition_paths = {
+        (element, dataset_type): partition_path(element, dataset_type)
+        for element in ELEMENTS
+        for dataset_type in DATASET_TYPES
+    }
+    with ushcn_metrics.stage('adjustments'):
+        ushcn_adjustments.update_adjustments(scan_monthly(), partition_paths, ELEMENTS, full=full or extract,
+                                             batch_rows=batch_rows)
+    with ushcn_metrics.stage('rollups'):
+        ushcn_rollups.update_rollups(scan_monthly(), partition_paths, full=full or extract, batch_rows=batch_rows)
+    with ushcn_metrics.stage('row_hashes'):
+        ushcn_row_hashes.update_hashes(scan_monthly(compact=compact), partition_paths,
+                                       ushcn_row_hashes.snapshot_name(raw_data_dir), full=full or extract,
+                                       batch_rows=batch_rows)
+    return n_written, n_removed
+
+# Function to find the most recent dated snapshot directory (source-data/raw/<YYYYMMDD>)
+def latest_snapshot_dir(source_dir='source-data/raw'):
+    snapshots = sorted(glob.glob(os.path.join(source_dir, '[0-9]' * 8)))
+    return snapshots[-1] if snapshots else RAW_DATA_DIR
 
 def main():
+    parser = argparse.ArgumentParser(description='Convert the USHCN v2.5 archives to parquet.')
+    parser.add_argument('--raw-data-dir', default=latest_snapshot_dir(), help='snapshot directory containing the .tar.gz files (default: the latest one)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of parser processes')
+    parser.add_argument('--extract', action='store_true', help='extract the archives to disk before parsing')
+    parser.add_argument('--full', action='store_true', help='reparse every archive, ignoring the manifest')
+    parser.add_argument('--compact', action='store_true', help='store integer native-unit values, numeric station keys and enum flags')
+    parser.add_argument('--batch-rows', type=int, nargs='?', const=BATCH_ROWS, metavar='N',
+                        help=f'parse and build everything N rows at a time to bound memory (default N: {BATCH_ROWS})')
+    parser.add_argument('--metrics', metavar='FILE', help='write a JSON report of the time, CPU, memory and rows of each stage')
+    parser.add_argument('--progress', action='store_true', help='show each finished stage on a live progress line')
+    args = parser.parse_args()
+
+    if args.metrics or args.progress:
+        ushcn_metrics.start(progress=args.progress)
+
     # process_stations()
-    process_elements()
+    process_elements(args.raw_data_dir, extract=args.extract, workers=args.workers, full=args.full, compact=args.compact,
+                     batch_rows=args.batch_rows)
+
+    metrics = ushcn_metrics.stop()
+    if args.metrics:
+        metrics.write(args.metrics)
+        print(f'Saved metrics to {args.metrics}')
+    elif metrics is not None:
+        sys.stderr.write('\n')
 
 if __name__ == '__main__':
     main()
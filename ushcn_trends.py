@@ -0,0 +1,209 @@
+import argparse
+import numpy as np
+import polars as pl
+import ushcn_metrics
+from ushcn_adjustments import SOURCES
+from ushcn_to_polars import DATASET_TYPES, ELEMENTS, MONTHLY_DATA_DIR, run_tasks, scan_monthly, value_scale
+
+# Configuration
+METHODS = ['ols', 'theil_sen']
+MIN_YEARS = 30  # Fewest years with a value for a series to get a trend
+MIN_SPAN = 0  # Fewest years between a series' first and last value
+PAIR_CHUNK = 4_000_000  # Pairwise slopes held at a time by the Theil-Sen fit
+OUTPUT_FILE = 'ushcn_trends.parquet'
+
+# Linear trends of every station x month series of each element/dataset type, fitted for
+# all series of a partition at once on a dense [series, year] matrix (missing = NaN)
+# rather than one np.polyfit call per series. Slopes are per year in °C (mm for prcp) and
+# intercepts are at year 0, as calc_best_fit_line in replicate-ushcn-vid.ipynb gives them.
+# Partitions are fitted in parallel (workers), and the result is one tidy table:
+#
+#   element, dataset_type, coop_id, month, method, slope, intercept, stderr, n_years, first_year, last_year
+#
+#   python ushcn_trends.py --methods ols theil_sen --workers 4 --differences
+
+# Function to read one element/dataset type as a [station, month, year] matrix of
+# °C/mm values (NaN where missing). Returns (coop_ids, years, values).
+def series_matrix(element, dataset_type, years=None, exclude_estimated=False, data_dir=MONTHLY_DATA_DIR):
+    lf = scan_monthly(data_dir, compact=True).filter(pl.col('element') == element, pl.col('dataset_type') == dataset_type)
+    if years is not None:
+        lf = lf.filter(pl.col('year').is_between(years[0], years[-1]))
+    if exclude_estimated:
+        lf = lf.filter(pl.col('dmflag').ne_missing('E'))
+    df = lf.select('coop_id', 'year', 'month', 'value').drop_nulls('value').collect()
+    if df.is_empty():
+        return np.array([], dtype=np.uint32), np.array([], dtype=np.int64), np.empty((0, 12, 0))
+
+    coop_ids = np.unique(df['coop_id'].to_numpy())
+    year_values = df['year'].to_numpy().astype(np.int64)
+    first_year = year_values.min() if years is None else years[0]
+    last_year = year_values.max() if years is None else years[-1]
+    values = np.full((len(coop_ids), 12, last_year - first_year + 1), np.nan)
+    s = np.searchsorted(coop_ids, df['coop_id'].to_numpy())
+    m = df['month'].to_numpy().astype(np.intp) - 1
+    values[s, m, year_values - first_year] = df['value'].to_numpy() / value_scale(element)
+    return coop_ids, np.arange(first_year, last_year + 1), values
+
+# Function to count each series' values and get its first and last year (x is the year
+# of each column of the [series, year] matrix y)
+def coverage(x, y):
+    valid = ~np.isnan(y)
+    n = valid.sum(axis=1)
+    first = np.where(n > 0, x[np.argmax(valid, axis=1)], 0)
+    last = np.where(n > 0, x[len(x) - 1 - np.argmax(valid[:, ::-1], axis=1)], 0)
+    return n, first, last
+
+# Function to fit ordinary least squares lines to every row of y at once, skipping NaNs.
+# Returns (slope, intercept, stderr of the slope); rows with fewer than 3 values get NaN.
+def ols_trends(x, y):
+    valid = ~np.isnan(y)
+    w = valid.astype(np.float64)
+    y0 = np.where(valid, y, 0.0)
+    n = w.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x_mean = (w @ x) / n
+        y_mean = y0.sum(axis=1) / n
+        dx = (x[None, :] - x_mean[:, None]) * w
+        sxx = (dx * dx).sum(axis=1)
+        slope = (dx * y0).sum(axis=1) / sxx
+        intercept = y_mean - slope * x_mean
+        residuals = (y0 - y_mean[:, None] - slope[:, None] * dx) * w
+        stderr = np.sqrt((residuals * residuals).sum(axis=1) / (n - 2) / sxx)
+    enough = n >= 3
+    return np.where(enough, slope, np.nan), np.where(enough, intercept, np.nan), np.where(enough, stderr, np.nan)
+
+# Function to fit Theil-Sen lines to every row of y: the slope is the median of the slopes
+# between every pair of values, the intercept the median of y - slope * x. Rows are done a
+# chunk at a time so at most PAIR_CHUNK pairwise slopes are held. Every row needs at least
+# two values. Returns (slope, intercept).
+def theil_sen_trends(x, y, pair_chunk=PAIR_CHUNK):
+    i, j = np.triu_indices(len(x), k=1)
+    dx = (x[j] - x[i]).astype(np.float64)
+    slope = np.empty(len(y))
+    intercept = np.empty(len(y))
+    rows = max(1, pair_chunk // max(len(i), 1))
+    for start in range(0, len(y), rows):
+        chunk = y[start:start + rows]
+        slope[start:start + rows] = _row_medians((chunk[:, j] - chunk[:, i]) / dx)
+        intercept[start:start + rows] = _row_medians(chunk - slope[start:start + rows, None] * x)
+    return slope, intercept
+
+# Function to get the median of each row, skipping NaNs (a sort per row: much faster than
+# np.nanmedian, which falls back to one row at a time when there are NaNs)
+def _row_medians(values):
+    values = np.sort(values, axis=1)  # NaNs sort last
+    n = (~np.isnan(values)).sum(axis=1)
+    rows = np.arange(len(values))
+    low = values[rows, np.maximum(n - 1, 0) // 2]
+    high = values[rows, n // 2]
+    return np.where(n > 0, (low + high) / 2, np.nan)
+
+# Function to fit the trends of every station x month series of one element/dataset type.
+# Series with fewer than min_years values, or whose first and last values are fewer than
+# min_span years apart, are left out.
+def partition_trends(element, dataset_type, years=None, methods=('ols',), min_years=MIN_YEARS, min_span=MIN_SPAN,
+                     exclude_estimated=False, data_dir=MONTHLY_DATA_DIR):
+    with ushcn_metrics.stage('trends', element=element, dataset_type=dataset_type) as record:
+        coop_ids, x, values = series_matrix(element, dataset_type, years, exclude_estimated, data_dir)
+        if not len(coop_ids):
+            return None
+        y = values.reshape(-1, len(x))
+        n, first, last = coverage(x, y)
+        keep = np.nonzero((n >= max(min_years, 3)) & (last - first >= min_span))[0]
+        y = y[keep]
+        x = x.astype(np.float64)
+
+        frames = []
+        for method in methods:
+            if method == 'ols':
+                slope, intercept, stderr = ols_trends(x, y)
+            elif method == 'theil_sen':
+                slope, intercept = theil_sen_trends(x, y)
+                stderr = np.full(len(y), np.nan)
+            else:
+                raise ValueError(f'Unknown trend method {method!r} (expected one of {METHODS})')
+            frames.append(pl.DataFrame({
+                'element': element,
+                'dataset_type': dataset_type,
+                'coop_id': pl.Series(coop_ids[keep // 12]).cast(pl.Utf8).str.zfill(6),
+                'month': (keep % 12 + 1).astype(np.uint8),
+                'method': method,
+                'slope': slope,
+                'intercept': intercept,
+                'stderr': pl.Series(stderr).fill_nan(None),
+                'n_years': n[keep].astype(np.uint16),
+                'first_year': first[keep].astype(np.uint16),
+                'last_year': last[keep].astype(np.uint16),
+            }))
+        record['rows_in'] = int(n.sum())
+        record['rows_out'] = len(keep) * len(methods)
+        return pl.concat(frames) if frames else None
+
+# Process pool task: fit one partition
+def _partition_trends_task(task):
+    return partition_trends(*task)
+
+# Function to fit the trends of every element/dataset type partition, `workers` partitions
+# at a time. Returns the tidy trends table, sorted by element, dataset type, station, month.
+def station_trends(elements=ELEMENTS, dataset_types=DATASET_TYPES, years=None, methods=('ols',), min_years=MIN_YEARS,
+                   min_span=MIN_SPAN, exclude_estimated=False, data_dir=MONTHLY_DATA_DIR, workers=1):
+    tasks = [
+        (element, dataset_type, years, tuple(methods), min_years, min_span, exclude_estimated, data_dir)
+        for element in elements
+        for dataset_type in dataset_types
+    ]
+    frames = [df for df in run_tasks(_partition_trends_task, tasks, workers) if df is not None and df.height]
+    if not frames:
+        return None
+    return pl.concat(frames).sort(['element', 'dataset_type', 'coop_id', 'month', 'method'])
+
+# Function to set two dataset types' trends side by side (default raw and final), with
+# the slope change made by the adjustments. Each slope is over its own series' years;
+# pass the same `years` to station_trends for a like-for-like window.
+def trend_differences(trends, base='raw', other='FLs.52j'):
+    names = {dataset_type: suffix for suffix, dataset_type in SOURCES.items()}
+    keys = ['element', 'coop_id', 'month', 'method']
+
+    def side(dataset_type):
+        suffix = names.get(dataset_type, dataset_type)
+        return trends.filter(pl.col('dataset_type') == dataset_type).select(
+            keys + [pl.col(column).alias(f'{column}_{suffix}') for column in ['slope', 'stderr', 'n_years']]
+        )
+
+    base_name, other_name = names.get(base, base), names.get(other, other)
+    return (
+        side(base)
+        .join(side(other), on=keys, how='inner')
+        .with_columns((pl.col(f'slope_{other_name}') - pl.col(f'slope_{base_name}')).alias('slope_difference'))
+        .sort(keys)
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description='Fit linear trends to every station x month series of the monthly dataset.')
+    parser.add_argument('--elements', nargs='+', default=ELEMENTS, choices=ELEMENTS)
+    parser.add_argument('--dataset-types', nargs='+', default=DATASET_TYPES, choices=DATASET_TYPES)
+    parser.add_argument('--years', type=int, nargs=2, metavar=('FIRST', 'LAST'), help='only fit these years (inclusive)')
+    parser.add_argument('--methods', nargs='+', default=['ols'], choices=METHODS)
+    parser.add_argument('--min-years', type=int, default=MIN_YEARS, help='fewest years with a value')
+    parser.add_argument('--min-span', type=int, default=MIN_SPAN, help='fewest years between the first and last value')
+    parser.add_argument('--exclude-estimated', action='store_true', help="leave out values with an 'E' dmflag")
+    parser.add_argument('--data-dir', default=MONTHLY_DATA_DIR)
+    parser.add_argument('--workers', type=int, default=1, help='partitions fitted at a time')
+    parser.add_argument('--output', default=OUTPUT_FILE)
+    parser.add_argument('--differences', help='also write the raw vs final slope differences to this file')
+    args = parser.parse_args()
+
+    trends = station_trends(args.elements, args.dataset_types, args.years, args.methods, args.min_years, args.min_span,
+                            args.exclude_estimated, args.data_dir, args.workers)
+    if trends is None:
+        print('No series met the coverage rules.')
+        return
+    trends.write_parquet(args.output)
+    print(f'Saved {trends.height} trends to {args.output}')
+    if args.differences:
+        differences = trend_differences(trends)
+        differences.write_parquet(args.differences)
+        print(f'Saved {differences.height} slope differences to {args.differences}')
+
+if __name__ == '__main__':
+    main()